@@ -1,38 +1,571 @@
-from flask import Flask, render_template, request, jsonify, url_for
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask import (
+    Flask,
+    Request,
+    Response,
+    g,
+    render_template,
+    request,
+    jsonify,
+    send_file,
+    stream_with_context,
+    url_for,
+)
+from flask_socketio import SocketIO, emit, join_room
+import atexit
+import functools
+import hmac
+import logging
 import os
-from PIL import Image
-from werkzeug.utils import secure_filename
+import signal
 import uuid
+import threading
 import time
-import random
 import json
 from datetime import datetime
-from geopy.distance import geodesic
-
-# Import test_model only if needed for X-ray classification
+import math
+import multiprocessing
+from dispatch import DispatchEngine
+from event_log import EventLog
+from geo import distances_km, location_arrays
+from image_ingest import IngestError, read_image
+from inference_pool import InferenceBusy, InferencePool
+from location_fanout import LocationFanout
+from log_config import configure_logging
+from metrics import registry as metrics
+from prediction_cache import PredictionCache
+from prediction_jobs import PredictionJobs
+from queue_matcher import QueueMatcher
+from request_store import RequestStore
+from sampling_profiler import ProfilerBusy, SamplingProfiler
+from road_network import EtaEngine, format_eta
+from screening import (
+    CASCADE,
+    CHEST_MODEL_PATH,
+    COVID_MODEL_PATH,
+    FOUR_CLASS_MODEL_PATH,
+    MODEL_PATHS,
+    PREDICTION_FORMAT,
+    build_prediction,
+    is_chest_xray,
+)
+from spatial_index import DriverIndex
+from state_backend import Table, create_backend
+from upload_store import UploadStore
+
+logger = logging.getLogger(__name__)
+
+# Import the model registry only if needed for X-ray classification
 try:
-    from test_model import image_classification
+    from bulk_screening import (
+        BulkJobs,
+        iter_entries,
+        screen_batch,
+        screen_entries,
+        screen_file,
+    )
+    from model_registry import (
+        PreparedImage,
+        classify_prepared,
+        preload_models,
+        registry as model_registry,
+    )
 
     XRAY_CLASSIFICATION_AVAILABLE = True
 except ImportError as e:
-    print(f"Warning: X-ray classification not available: {e}")
+    logger.warning("X-ray classification not available: %s", e)
     XRAY_CLASSIFICATION_AVAILABLE = False
 
+
+class AppRequest(Request):
+    """Request with the larger upload limits of bulk screening on its endpoint"""
+
+    @property
+    def max_content_length(self):
+        if self.endpoint == "bulk_screening":
+            return app.config["BULK_SCREENING"]["max_content_length"]
+        return super().max_content_length
+
+    @property
+    def max_form_parts(self):
+        if self.endpoint == "bulk_screening":
+            return app.config["BULK_SCREENING"]["max_form_parts"]
+        return super().max_form_parts
+
+
 app = Flask(__name__)
+app.request_class = AppRequest
 app.config["SECRET_KEY"] = "your-secret-key-here"
 app.config["UPLOAD_FOLDER"] = "uploads"
+# Uploads are stored once per content in sharded directories; files not
+# uploaded again for max_age_seconds are deleted, then the least recent ones
+# while the store is over max_total_bytes
+app.config["UPLOAD_STORAGE"] = {
+    "max_age_seconds": 7 * 24 * 3600,
+    "max_total_bytes": 20 * 1024**3,
+    "gc_interval_seconds": 3600,
+}
 app.config["MAX_CONTENT_LENGTH"] = 10 * 1024 * 1024  # 10MB max file size
+# Uploads are rejected from their header, before decoding, when they are not
+# PNG/JPEG or exceed these dimensions
+app.config["IMAGE_INGEST"] = {"max_side": 10000, "max_pixels": 40_000_000}
+# Bulk screening accepts zip/tar archives or many files in one request and
+# classifies them batch_size images per forward pass
+app.config["BULK_SCREENING"] = {
+    "batch_size": 16,
+    "max_content_length": 2 * 1024 * 1024 * 1024,
+    "max_form_parts": 10000,
+    "max_entry_bytes": 10 * 1024 * 1024,
+}
+# Micro-batching per model: concurrent requests are stacked into one forward
+# pass of up to max_batch_size images, waiting at most max_wait_ms to fill it
+app.config["MODEL_BATCHING"] = {
+    CHEST_MODEL_PATH: {"max_batch_size": 8, "max_wait_ms": 5},
+    COVID_MODEL_PATH: {"max_batch_size": 8, "max_wait_ms": 5},
+    FOUR_CLASS_MODEL_PATH: {"max_batch_size": 8, "max_wait_ms": 5},
+}
+# Inference runtime: "eager" PyTorch, or "torchscript" / "onnx" exported once
+# next to each checkpoint (quantize=True for INT8 dynamic quantization). The
+# export is checked against eager on fixed parity images before it is used
+app.config["MODEL_BACKEND"] = {
+    "backend": os.environ.get("MODEL_BACKEND", "eager"),
+    "quantize": os.environ.get("MODEL_QUANTIZE") == "1",
+    "intra_op_threads": int(os.environ.get("MODEL_THREADS", 0)) or None,
+}
+# Shared dispatch state: empty keeps it in this process, a redis:// URL lets
+# several workers or nodes serve the same fleet
+app.config["STATE_BACKEND_URL"] = os.environ.get("STATE_BACKEND_URL")
+# Message queue relaying SocketIO emits to clients connected to other workers
+app.config["SOCKETIO_MESSAGE_QUEUE"] = (
+    os.environ.get("SOCKETIO_MESSAGE_QUEUE", app.config["STATE_BACKEND_URL"]) or None
+)
+# With a shared backend, how often each worker rebuilds its driver index
+app.config["DRIVER_INDEX_RESYNC_SECONDS"] = 2
+# Location updates forwarded to the tracking counterpart are coalesced: moves
+# under min_distance_m are dropped and each pair gets at most one update per
+# min_interval_ms, flushed for all pairs together every tick_ms
+app.config["LOCATION_FANOUT"] = {
+    "min_distance_m": 10,
+    "min_interval_ms": 1000,
+    "tick_ms": 200,
+}
+# Inference runs on a bounded pool off the request/event loop: "thread" shares
+# this process's models, "process" isolates them in worker processes ("thread"
+# needs real threads, so eventlet/gevent servers always use "process"). When
+# workers + max_queue jobs are in flight, requests get a 503 with Retry-After
+app.config["INFERENCE_POOL"] = {
+    "mode": os.environ.get("INFERENCE_POOL_MODE", "thread"),
+    "workers": 8,
+    "max_queue": 32,
+    "retry_after": 1,
+}
+# Results of asynchronous /predict jobs are kept this long after they finish
+app.config["PREDICTION_JOBS"] = {"ttl_seconds": 3600}
+# Emergency requests alert the k nearest available drivers within radius_km
+# at once; if nobody accepts within timeout_s (or all decline) the next round
+# widens the search. radius_km None means unlimited
+app.config["DISPATCH_ROUNDS"] = [
+    {"k": 3, "radius_km": 5, "timeout_s": 20},
+    {"k": 5, "radius_km": 15, "timeout_s": 30},
+    {"k": 10, "radius_km": None, "timeout_s": 60},
+]
+# Requests no driver took wait in a queue, most urgent emergency type first
+# (lower priority number) and then by arrival. Whenever drivers free up, queued
+# requests are assigned in batches minimizing total distance: "hungarian" is
+# optimal, "greedy" takes the closest pairs first
+app.config["DISPATCH_QUEUE"] = {
+    "priorities": {
+        "cardiac": 0,
+        "stroke": 0,
+        "respiratory": 1,
+        "trauma": 1,
+        "general": 2,
+    },
+    "default_priority": 2,
+    "method": "hungarian",
+    "tick_ms": 250,
+}
+# Driving time estimates for ranking drivers and telling patients their ETA.
+# path is a road graph precomputed with road_network.py (.npz) or a raw .osm
+# extract; without one, ETAs are straight-line distance x detour_factor at
+# fallback_speed_kmh
+app.config["ROAD_NETWORK"] = {
+    "path": os.environ.get("ROAD_GRAPH_PATH"),
+    "landmarks": 8,
+    "cache_size": 10000,
+    "fallback_speed_kmh": 40,
+    "detour_factor": 1.3,
+}
+# Number of finished emergency requests kept for status lookups
+app.config["REQUEST_ARCHIVE_SIZE"] = 1000
+# Write-ahead log of request state transitions, replayed at startup so a
+# restart keeps in-flight emergencies. Events are fsynced in batches every
+# flush_interval_ms; unused with a shared state backend, which outlives the
+# workers already. Set EVENT_LOG_DIR to "" to turn it off
+app.config["EVENT_LOG"] = {
+    "directory": os.environ.get("EVENT_LOG_DIR", "eventlog"),
+    "flush_interval_ms": 50,
+    "segment_bytes": 4 * 2**20,
+    "keep_segments": 2,
+}
+# Set persist_path (e.g. "cache/predictions.sqlite3") to keep the cache across restarts
+app.config["PREDICTION_CACHE"] = {
+    "max_entries": 1024,
+    "ttl_seconds": 3600,
+    "persist_path": os.environ.get("PREDICTION_CACHE_PATH"),
+}
+# Log records are written by a background thread from a bounded queue; when
+# it is full records are dropped instead of stalling handlers
+app.config["LOGGING"] = {
+    "level": os.environ.get("LOG_LEVEL", "INFO"),
+    "queue_size": 10000,
+}
+log_handler = configure_logging(**app.config["LOGGING"])
+# On-demand sampling profiler (/admin/profiler and SIGUSR2), disabled unless
+# PROFILER_TOKEN is set; callers send it in the X-Profiler-Token header
+app.config["PROFILER"] = {
+    "token": os.environ.get("PROFILER_TOKEN"),
+    "output_dir": "profiles",
+    "interval_ms": 5,
+    "max_seconds": 120,
+}
 
 # Initialize SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*")
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    message_queue=app.config["SOCKETIO_MESSAGE_QUEUE"],
+)
+
+# Predictions for repeated uploads, keyed by content hash and model weights.
+# init_app() opens its SQLite mirror
+prediction_cache = PredictionCache(
+    **dict(app.config["PREDICTION_CACHE"], persist_path=None)
+)
+
+
+def wait_for_inference(future):
+    """Wait for an inference job without blocking a green-thread event loop"""
+    if socketio.async_mode == "threading":
+        return future.result()
+    while not future.done():
+        socketio.sleep(0.005)
+    return future.result()
+
+
+# Models run on inference_pool, created by init_app()
+inference_pool = None
+
+
+def start_inference_pool():
+    """Create the pool, loading and warming up the models now, not on first use"""
+    pool_config = dict(app.config["INFERENCE_POOL"])
+    if socketio.async_mode != "threading" and pool_config["mode"] == "thread":
+        # Under eventlet/gevent pool threads are green threads, and inference
+        # on them would hold the event loop for the whole forward pass
+        logger.warning(
+            "Inference pool mode 'thread' is not supported with async_mode %r; "
+            "using 'process'",
+            socketio.async_mode,
+        )
+        pool_config["mode"] = "process"
+    # Thread mode runs the initializer here; process mode in each worker
+    pool = InferencePool(
+        initializer=preload_models,
+        initargs=(
+            MODEL_PATHS,
+            app.config["MODEL_BACKEND"],
+            app.config["MODEL_BATCHING"],
+        ),
+        wait=wait_for_inference,
+        **pool_config,
+    )
+    if pool.mode == "process":
+        # Requests still read model identities and input sizes in this process
+        preload_models(MODEL_PATHS, app.config["MODEL_BACKEND"])
+    return pool
+
+
+# Storage for active users, in memory or shared through the state backend.
+# Records are written back with patch()/compare_and_set(), never mutated in place
+state_backend = create_backend(app.config["STATE_BACKEND_URL"])
+active_patients = Table(
+    state_backend, "patients"
+)  # {patient_id: {sid, location, request_id, status}}
+active_drivers = Table(
+    state_backend, "drivers"
+)  # {driver_id: {sid, location, status, current_request}}
+# {request_id: {patient_id, driver_id, status, timestamp, location}}, indexed by
+# status; arrived requests move to a bounded archive
+emergency_requests = RequestStore(
+    state_backend, archive_size=app.config["REQUEST_ARCHIVE_SIZE"]
+)
+
+# Durable log of request transitions, recovered and written by init_app()
+event_log = None
+if app.config["EVENT_LOG"]["directory"] and not state_backend.shared:
+    event_log = EventLog(**app.config["EVENT_LOG"])
+
+
+def log_event(event_type, request_id, **fields):
+    if event_log is not None:
+        event_log.append(event_type, request_id, **fields)
+
+
+# Asynchronous /predict jobs and their results
+prediction_jobs = PredictionJobs(state_backend, **app.config["PREDICTION_JOBS"])
+
+# Progress and results of bulk screening jobs, for resuming
+bulk_jobs = BulkJobs(state_backend) if XRAY_CLASSIFICATION_AVAILABLE else None
+
+# Spatial index over the locations of available drivers only
+driver_index = DriverIndex()
+
+# Reverse index from socket id to the users registered on it, so disconnects
+# don't scan every patient and driver
+session_users = Table(state_backend, "sessions")  # {sid: {"users": [[role, id]]}}
+session_lock = threading.Lock()
+
+
+def resync_driver_index():
+    """Rebuild this worker's driver index from the shared state backend.
+
+    Other workers update drivers directly in the backend, so the local index
+    is refreshed periodically; candidates it returns are always re-checked
+    against the backend before dispatch.
+    """
+    while True:
+        driver_index.rebuild(
+            (driver_id, driver_data["location"])
+            for driver_id, driver_data in active_drivers.items()
+            if driver_data["status"] == "available"
+        )
+        socketio.sleep(app.config["DRIVER_INDEX_RESYNC_SECONDS"])
+
+
+# Throttled fan-out of patient/driver positions to their counterpart
+location_fanout = LocationFanout(socketio.emit, **app.config["LOCATION_FANOUT"])
+
+# Road-network ETA engine with an LRU cache of recent routes; init_app() loads
+# the graph, straight-line estimates until then
+eta_engine = EtaEngine.from_config(**dict(app.config["ROAD_NETWORK"], path=None))
+
+# Queue of requests no driver took, assigned as drivers free up. The assign
+# callback is defined with the socket handlers below
+dispatch_queue = QueueMatcher(
+    emergency_requests,
+    active_drivers,
+    driver_index,
+    lambda request_id, driver_id: assign_queued_request(request_id, driver_id),
+    eta=eta_engine,
+    **app.config["DISPATCH_QUEUE"],
+)
+
+# Broadcast dispatch with first-accept-wins and escalation timers
+dispatch_engine = DispatchEngine(
+    emergency_requests,
+    active_drivers,
+    active_patients,
+    driver_index,
+    socketio.emit,
+    rounds=app.config["DISPATCH_ROUNDS"],
+    queue=dispatch_queue,
+    eta=eta_engine,
+    event_log=event_log,
+)
+
+# {(role, user_id): request_id} of recovered requests, handed back to their
+# patient and driver when they register again
+resumable_requests = {}
+
+
+def restore_requests(records):
+    """Put requests recovered from the event log back in the store.
+
+    Pending ones join the dispatch queue, to be assigned as drivers
+    reconnect; accepted ones wait for their driver to register again.
+    """
+    for request_id, record in sorted(
+        records.items(), key=lambda item: item[1]["created_lsn"]
+    ):
+        data = {
+            key: value
+            for key, value in record.items()
+            if key not in ("created_lsn", "sequence")
+        }
+        emergency_requests.create(request_id, data)
+        resumable_requests[("patient", data["patient_id"])] = request_id
+        if data["status"] == "pending":
+            dispatch_queue.enqueue(request_id)
+        elif data.get("driver_id"):
+            resumable_requests[("driver", data["driver_id"])] = request_id
+
+
+def resume_request(role, user_id):
+    """The recovered request of a re-registering patient or driver, or None"""
+    request_id = resumable_requests.pop((role, user_id), None)
+    if request_id is None or request_id not in emergency_requests:
+        return None
+    request_data = emergency_requests[request_id]
+    if role == "driver" and (
+        request_data["status"] != "accepted" or request_data["driver_id"] != user_id
+    ):
+        return None
+    return request_id
+
+
+# Content-addressed upload storage and its garbage collector
+upload_store = UploadStore(app.config["UPLOAD_FOLDER"], **app.config["UPLOAD_STORAGE"])
+
+# Metrics served at /metrics in the Prometheus text format. Sizes and cache
+# counts are read when scraped; latencies are recorded as they happen
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds",
+    "Time to handle an HTTP request (to the first byte for streamed responses)",
+    ["endpoint", "method"],
+)
+http_requests = metrics.counter(
+    "http_requests_total", "HTTP requests by response status", ["endpoint", "status"]
+)
+socket_event_seconds = metrics.histogram(
+    "socketio_event_duration_seconds", "Time to handle a socket event", ["event"]
+)
+socket_event_errors = metrics.counter(
+    "socketio_event_errors_total", "Socket event handlers that raised", ["event"]
+)
+inference_stage_seconds = metrics.histogram(
+    "inference_stage_duration_seconds",
+    "Time spent in each stage of classifying an upload",
+    ["model", "stage"],
+)
+time_to_accept_seconds = metrics.histogram(
+    "dispatch_time_to_accept_seconds",
+    "Time from an emergency request to a driver being assigned",
+    buckets=(1, 2, 5, 10, 15, 30, 60, 120, 300, 600, 1800),
+)
+metrics.gauge(
+    "active_patients", "Registered patients", collect=lambda: len(active_patients)
+)
+metrics.gauge(
+    "active_drivers", "Registered drivers", collect=lambda: len(active_drivers)
+)
+metrics.gauge(
+    "available_drivers",
+    "Drivers free to take a request",
+    collect=lambda: len(driver_index),
+)
+metrics.gauge(
+    "pending_requests",
+    "Emergency requests waiting for a driver",
+    collect=lambda: emergency_requests.count("pending"),
+)
+metrics.gauge(
+    "queued_requests",
+    "Pending requests in the dispatch queue",
+    collect=lambda: len(dispatch_queue),
+)
+metrics.counter(
+    "emergency_requests_total",
+    "Emergency requests created",
+    collect=lambda: emergency_requests.total_created,
+)
+metrics.counter(
+    "cache_hits_total",
+    "Cache lookups that found an entry",
+    ["cache"],
+    collect=lambda: {
+        ("prediction",): prediction_cache.hits,
+        ("eta_route",): eta_engine.hits,
+    },
+)
+metrics.counter(
+    "cache_misses_total",
+    "Cache lookups that found nothing",
+    ["cache"],
+    collect=lambda: {
+        ("prediction",): prediction_cache.misses,
+        ("eta_route",): eta_engine.misses,
+    },
+)
+metrics.gauge(
+    "cache_hit_ratio",
+    "Hits over lookups since startup",
+    ["cache"],
+    collect=lambda: {
+        ("prediction",): prediction_cache.stats()["hit_ratio"],
+        ("eta_route",): eta_engine.hits / max(eta_engine.hits + eta_engine.misses, 1),
+    },
+)
+metrics.counter(
+    "log_records_dropped_total",
+    "Log records dropped because the log queue was full",
+    collect=lambda: log_handler.dropped,
+)
+if event_log is not None:
+    metrics.counter(
+        "event_log_events_total",
+        "Request events written to the event log",
+        collect=lambda: event_log.written,
+    )
+    metrics.gauge(
+        "event_log_pending_events",
+        "Request events waiting for the next event log flush",
+        collect=lambda: event_log.stats()["pending_events"],
+    )
+    metrics.gauge(
+        "event_log_last_flush_seconds",
+        "Time the last event log write and fsync took",
+        collect=lambda: event_log.last_flush_ms / 1000,
+    )
+if XRAY_CLASSIFICATION_AVAILABLE:
+    metrics.gauge(
+        "inference_pool_depth",
+        "Inference jobs running or waiting",
+        collect=lambda: inference_pool.depth,
+    )
+    metrics.counter(
+        "inference_pool_rejected_total",
+        "Inference jobs turned away because the queue was full",
+        collect=lambda: inference_pool.rejected,
+    )
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Unmatched URLs share one label so scanners can't add series
+    endpoint = request.endpoint or "unmatched"
+    http_request_seconds.labels(endpoint, request.method).observe(
+        time.perf_counter() - g.request_started
+    )
+    http_requests.labels(endpoint, str(response.status_code)).inc()
+    return response
+
+
+def socket_event(event):
+    """socketio.on that also records the handler's latency and failures"""
+    latency = socket_event_seconds.labels(event)
+    errors = socket_event_errors.labels(event)
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def timed_handler(*args):
+            started = time.perf_counter()
+            try:
+                return handler(*args)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(time.perf_counter() - started)
+
+        return socketio.on(event)(timed_handler)
+
+    return decorator
 
-# In-memory storage for active users (in production, use Redis or database)
-active_patients = {}  # {patient_id: {sid, location, request_id, status}}
-active_drivers = {}  # {driver_id: {sid, location, status, current_request}}
-emergency_requests = (
-    {}
-)  # {request_id: {patient_id, driver_id, status, timestamp, location}}
 
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg"}
@@ -42,6 +575,15 @@ def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def read_upload():
+    """Return the bytes of the uploaded image, validated from its header first"""
+    file = request.files.get("file")
+    if file is None or file.filename == "":
+        raise IngestError("No file provided")
+    data, _ = read_image(file.stream, **app.config["IMAGE_INGEST"])
+    return data
+
+
 @app.route("/")
 def index():
     return render_template("index.html")
@@ -70,14 +612,19 @@ def api_documentation():
                     "GET /api/driver/status/<driver_id>": "Get driver status",
                 },
                 "system_apis": {
-                    "GET /api/system/status": "Get system status and statistics"
+                    "GET /api/system/status": "Get system status and statistics",
+                    "GET /metrics": "Metrics in the Prometheus text format",
                 },
                 "medical_apis": {
                     "POST /upload": "Upload X-ray image",
                     "POST /chest": "Check if image is chest X-ray",
                     "POST /image": "4-class classification (COVID/Normal/Pneumonia/Other)",
                     "POST /iscovid": "2-class COVID detection",
-                    "POST /predict": "Mock prediction endpoint",
+                    "POST /analyze": "Chest check, COVID detection and 4-class classification in one call",
+                    "POST /predict": "Queue screening of an uploaded image; returns a job ID at once",
+                    "GET /predict/<job_id>": "Status and result of a prediction job",
+                    "POST /api/screening/bulk": "Screen an archive or many files, streaming NDJSON results",
+                    "GET /api/screening/bulk/<job_id>": "Progress of a bulk screening job",
                 },
             },
             "websocket_events": {
@@ -89,19 +636,26 @@ def api_documentation():
                     "decline_request",
                     "update_location",
                     "arrived",
+                    "watch_prediction",
                 ],
                 "server_to_client": [
                     "connected",
                     "patient_registered",
                     "driver_registered",
+                    "request_sent",
                     "emergency_alert",
+                    "alert_withdrawn",
                     "driver_assigned",
                     "request_accepted",
+                    "request_assigned",
                     "patient_location_update",
                     "driver_location_update",
+                    "arrival_confirmed",
                     "ambulance_arrived",
                     "driver_disconnected",
                     "no_drivers_available",
+                    "prediction_complete",
+                    "error",
                 ],
             },
             "example_usage": {
@@ -195,16 +749,23 @@ def driver_api():
         if action == "get_available_requests":
             # Return pending emergency requests for this driver's area
             available_requests = []
-            for request_id, req_data in emergency_requests.items():
-                if req_data["status"] == "pending":
-                    available_requests.append(
-                        {
-                            "request_id": request_id,
-                            "emergency_type": req_data["emergency_type"],
-                            "location": req_data["location"],
-                            "timestamp": req_data["timestamp"],
-                        }
-                    )
+            for request_id, req_data in emergency_requests.with_status("pending"):
+                available_requests.append(
+                    {
+                        "request_id": request_id,
+                        "emergency_type": req_data["emergency_type"],
+                        "location": req_data["location"],
+                        "timestamp": req_data["timestamp"],
+                    }
+                )
+
+            # Rank nearest first when the driver's position is known
+            origin = request.json.get("location")
+            driver_id = request.json.get("driver_id")
+            if origin is None and driver_id in active_drivers:
+                origin = active_drivers[driver_id]["location"]
+            if origin is not None:
+                rank_by_distance(origin, available_requests)
 
             return jsonify({"success": True, "available_requests": available_requests})
 
@@ -267,11 +828,9 @@ def emergency_request_api():
 
     # Find nearest driver (simplified for API)
     nearest_driver_distance = None
-    for driver_id, driver_data in active_drivers.items():
-        if driver_data["status"] == "available":
-            distance = calculate_distance(location, driver_data["location"])
-            if nearest_driver_distance is None or distance < nearest_driver_distance:
-                nearest_driver_distance = distance
+    nearest = driver_index.nearest(location, k=1)
+    if nearest:
+        nearest_driver_distance = nearest[0][1]
 
     return jsonify(
         {
@@ -295,11 +854,8 @@ def get_patient_status(patient_id):
         patient_data = active_patients[patient_id]
         request_data = None
 
-        if (
-            patient_data.get("request_id")
-            and patient_data["request_id"] in emergency_requests
-        ):
-            request_data = emergency_requests[patient_data["request_id"]]
+        if patient_data.get("request_id"):
+            request_data = emergency_requests.get(patient_data["request_id"])
 
         return jsonify(
             {
@@ -353,17 +909,16 @@ def get_driver_requests():
     """Get all pending emergency requests"""
     pending_requests = []
 
-    for request_id, req_data in emergency_requests.items():
-        if req_data["status"] == "pending":
-            pending_requests.append(
-                {
-                    "request_id": request_id,
-                    "patient_id": req_data["patient_id"],
-                    "location": req_data["location"],
-                    "emergency_type": req_data["emergency_type"],
-                    "timestamp": req_data["timestamp"],
-                }
-            )
+    for request_id, req_data in emergency_requests.with_status("pending"):
+        pending_requests.append(
+            {
+                "request_id": request_id,
+                "patient_id": req_data["patient_id"],
+                "location": req_data["location"],
+                "emergency_type": req_data["emergency_type"],
+                "timestamp": req_data["timestamp"],
+            }
+        )
 
     return jsonify(
         {
@@ -380,11 +935,8 @@ def get_driver_status(driver_id):
         driver_data = active_drivers[driver_id]
         current_request = None
 
-        if (
-            driver_data.get("current_request")
-            and driver_data["current_request"] in emergency_requests
-        ):
-            current_request = emergency_requests[driver_data["current_request"]]
+        if driver_data.get("current_request"):
+            current_request = emergency_requests.get(driver_data["current_request"])
 
         return jsonify(
             {
@@ -408,10 +960,12 @@ def get_system_status():
             "system_status": "online",
             "active_patients": len(active_patients),
             "active_drivers": len(active_drivers),
-            "pending_requests": len(
-                [r for r in emergency_requests.values() if r["status"] == "pending"]
-            ),
-            "total_requests": len(emergency_requests),
+            "pending_requests": emergency_requests.count("pending"),
+            "queued_requests": len(dispatch_queue),
+            "total_requests": emergency_requests.total_created,
+            "prediction_cache": prediction_cache.stats(),
+            "eta": eta_engine.stats(),
+            "event_log": event_log.stats() if event_log is not None else None,
             "websocket_url": f"ws://{request.host}",
             "api_endpoints": {
                 "patient": {
@@ -424,12 +978,83 @@ def get_system_status():
                     "requests": "/api/driver/requests",
                     "status": "/api/driver/status/<driver_id>",
                 },
-                "system": {"status": "/api/system/status"},
+                "system": {"status": "/api/system/status", "metrics": "/metrics"},
             },
         }
     )
 
 
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+profiler_options = dict(app.config["PROFILER"])
+profiler_token = profiler_options.pop("token")
+profiler = SamplingProfiler(**profiler_options)
+
+
+def profiler_admin(view):
+    """Hide a profiler endpoint (404) unless it is enabled and the token matches"""
+
+    @functools.wraps(view)
+    def guarded(*args, **kwargs):
+        supplied = request.headers.get("X-Profiler-Token", "")
+        if not profiler_token or not hmac.compare_digest(
+            supplied.encode(), profiler_token.encode()
+        ):
+            return jsonify({"error": "Not found"}), 404
+        return view(*args, **kwargs)
+
+    return guarded
+
+
+@app.route("/admin/profiler", methods=["GET"])
+@profiler_admin
+def profiler_status():
+    return jsonify(dict(profiler.status(), success=True))
+
+
+@app.route("/admin/profiler/start", methods=["POST"])
+@profiler_admin
+def start_profiler():
+    """Sample every thread for "seconds" (capped); the profile is written when done"""
+    data = request.get_json(silent=True) or {}
+    try:
+        status = profiler.start(data.get("seconds"), data.get("interval_ms"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except ProfilerBusy as e:
+        return jsonify({"error": str(e)}), 409
+    logger.warning("Sampling profiler started for %ss", status.get("seconds"))
+    return jsonify(dict(status, success=True)), 202
+
+
+@app.route("/admin/profiler/stop", methods=["POST"])
+@profiler_admin
+def stop_profiler():
+    """End the running window early and return the written profile"""
+    profile = profiler.stop()
+    if profile is None:
+        return jsonify({"error": "No profile has been taken"}), 404
+    logger.warning("Sampling profiler wrote %s", profile["path"])
+    return jsonify({"success": True, "profile": profile})
+
+
+def toggle_profiler(signum, frame):
+    """SIGUSR2 starts a profiling window, or ends the running one early"""
+    if profiler.running:
+        # Joining the sampler from a signal handler could deadlock on its lock
+        threading.Thread(target=profiler.stop, daemon=True).start()
+        return
+    try:
+        profiler.start()
+    except ProfilerBusy:
+        # Another window started (over HTTP) since the check above
+        logger.warning("Sampling profiler is already running")
+
+
 # Keep web interfaces for testing/demo purposes
 @app.route("/patient")
 def patient_interface():
@@ -442,71 +1067,123 @@ def driver_interface():
 
 
 # WebSocket event handlers
-@socketio.on("connect")
-def handle_connect():
-    print(f"Client connected: {request.sid}")
+@socket_event("connect")
+def handle_connect(auth=None):
+    logger.debug("Client connected: %s", request.sid)
     emit("connected", {"message": "Connected to ambulance dispatch system"})
 
 
-@socketio.on("disconnect")
+@socket_event("disconnect")
 def handle_disconnect():
-    print(f"Client disconnected: {request.sid}")
+    logger.debug("Client disconnected: %s", request.sid)
     # Remove user from active lists
-    for patient_id, patient_data in list(active_patients.items()):
-        if patient_data["sid"] == request.sid:
-            del active_patients[patient_id]
-            break
-
-    for driver_id, driver_data in list(active_drivers.items()):
-        if driver_data["sid"] == request.sid:
-            # If driver was on a request, notify patient
-            if driver_data.get("current_request"):
-                request_id = driver_data["current_request"]
-                if request_id in emergency_requests:
-                    patient_id = emergency_requests[request_id]["patient_id"]
-                    if patient_id in active_patients:
-                        socketio.emit(
-                            "driver_disconnected",
-                            {"message": "Driver disconnected, finding new driver"},
-                            room=active_patients[patient_id]["sid"],
-                        )
-            del active_drivers[driver_id]
-            break
-
-
-@socketio.on("register_patient")
+    disconnected_drivers = []
+    with session_lock:
+        session = session_users.get(request.sid, {"users": []})
+        if session["users"]:
+            del session_users[request.sid]
+        for role, user_id in session["users"]:
+            users = active_patients if role == "patient" else active_drivers
+            user_data = users.get(user_id)
+            # Skip users that re-registered on another socket since
+            if user_data is None or user_data["sid"] != request.sid:
+                continue
+            del users[user_id]
+            if role == "driver":
+                driver_index.remove(user_id)
+                disconnected_drivers.append(user_data)
+
+    for driver_data in disconnected_drivers:
+        # If driver was on a request, notify patient
+        if driver_data.get("current_request"):
+            request_id = driver_data["current_request"]
+            if request_id in emergency_requests:
+                patient_id = emergency_requests[request_id]["patient_id"]
+                if patient_id in active_patients:
+                    socketio.emit(
+                        "driver_disconnected",
+                        {"message": "Driver disconnected, finding new driver"},
+                        room=active_patients[patient_id]["sid"],
+                    )
+
+
+def bind_session(sid, role, user_id, users):
+    """Record that user_id registered on sid, forgetting its previous socket.
+
+    Must be called with session_lock held, before users[user_id] is replaced.
+    """
+    previous = users.get(user_id)
+    if previous is not None and previous["sid"] != sid:
+        previous_session = session_users.get(previous["sid"])
+        if previous_session is not None:
+            remaining = [u for u in previous_session["users"] if u != [role, user_id]]
+            if remaining:
+                session_users[previous["sid"]] = {"users": remaining}
+            else:
+                del session_users[previous["sid"]]
+
+    session = session_users.get(sid, {"users": []})
+    if [role, user_id] not in session["users"]:
+        session_users[sid] = {"users": session["users"] + [[role, user_id]]}
+
+
+@socket_event("register_patient")
 def handle_register_patient(data):
     patient_id = data.get("patient_id", str(uuid.uuid4()))
     location = data.get("location")
 
-    active_patients[patient_id] = {
-        "sid": request.sid,
-        "location": location,
-        "request_id": None,
-        "status": "available",
-    }
+    # A request recovered after a restart continues where it left off
+    request_id = resume_request("patient", patient_id)
+    status = "available"
+    if request_id is not None:
+        accepted = emergency_requests[request_id]["status"] == "accepted"
+        status = "driver_assigned" if accepted else "requesting"
+
+    with session_lock:
+        bind_session(request.sid, "patient", patient_id, active_patients)
+        active_patients[patient_id] = {
+            "sid": request.sid,
+            "location": location,
+            "request_id": request_id,
+            "status": status,
+        }
 
-    emit("patient_registered", {"patient_id": patient_id, "status": "registered"})
-    print(f"Patient registered: {patient_id}")
+    registered = {"patient_id": patient_id, "status": "registered"}
+    if request_id is not None:
+        registered["request_id"] = request_id
+    emit("patient_registered", registered)
+    logger.info("Patient registered: %s", patient_id)
 
 
-@socketio.on("register_driver")
+@socket_event("register_driver")
 def handle_register_driver(data):
     driver_id = data.get("driver_id", str(uuid.uuid4()))
     location = data.get("location")
 
-    active_drivers[driver_id] = {
-        "sid": request.sid,
-        "location": location,
-        "status": "available",
-        "current_request": None,
-    }
+    request_id = resume_request("driver", driver_id)
+
+    with session_lock:
+        bind_session(request.sid, "driver", driver_id, active_drivers)
+        active_drivers[driver_id] = {
+            "sid": request.sid,
+            "location": location,
+            "status": "available" if request_id is None else "en_route",
+            "current_request": request_id,
+        }
+        if request_id is None:
+            driver_index.upsert(driver_id, location)
+    if request_id is None:
+        dispatch_queue.availability_changed()
 
-    emit("driver_registered", {"driver_id": driver_id, "status": "registered"})
-    print(f"Driver registered: {driver_id}")
+    registered = {"driver_id": driver_id, "status": "registered"}
+    if request_id is not None:
+        registered["request_id"] = request_id
+        registered["patient_location"] = emergency_requests[request_id]["location"]
+    emit("driver_registered", registered)
+    logger.info("Driver registered: %s", driver_id)
 
 
-@socketio.on("emergency_request")
+@socket_event("emergency_request")
 def handle_emergency_request(data):
     patient_id = data.get("patient_id")
     location = data.get("location")
@@ -518,7 +1195,7 @@ def handle_emergency_request(data):
 
     # Create emergency request
     request_id = str(uuid.uuid4())
-    emergency_requests[request_id] = {
+    request_data = {
         "patient_id": patient_id,
         "driver_id": None,
         "status": "pending",
@@ -526,34 +1203,23 @@ def handle_emergency_request(data):
         "location": location,
         "emergency_type": emergency_type,
     }
+    log_event("created", request_id, data=dict(request_data))
+    emergency_requests.create(request_id, request_data)
 
     # Update patient status
-    active_patients[patient_id]["request_id"] = request_id
-    active_patients[patient_id]["status"] = "requesting"
-    active_patients[patient_id]["location"] = location
-
-    # Find nearest available driver
-    nearest_driver = find_nearest_driver(location)
+    active_patients.patch(
+        patient_id, request_id=request_id, status="requesting", location=location
+    )
 
-    if nearest_driver:
-        driver_id, driver_data = nearest_driver
-        # Notify driver about emergency request
-        socketio.emit(
-            "emergency_alert",
-            {
-                "request_id": request_id,
-                "patient_location": location,
-                "emergency_type": emergency_type,
-                "distance": calculate_distance(location, driver_data["location"]),
-            },
-            room=driver_data["sid"],
-        )
+    # Alert the nearest available drivers; the first to accept wins
+    alerted = dispatch_engine.dispatch(request_id)
 
+    if alerted:
         emit(
             "request_sent",
             {
                 "request_id": request_id,
-                "message": "Emergency request sent to nearest driver",
+                "message": f"Emergency request sent to {alerted} nearby drivers",
                 "driver_found": True,
             },
         )
@@ -564,11 +1230,12 @@ def handle_emergency_request(data):
                 "request_id": request_id,
                 "message": "No drivers available, you are in queue",
                 "driver_found": False,
+                "queue_position": dispatch_queue.position(request_id),
             },
         )
 
 
-@socketio.on("accept_request")
+@socket_event("accept_request")
 def handle_accept_request(data):
     driver_id = data.get("driver_id")
     request_id = data.get("request_id")
@@ -577,114 +1244,146 @@ def handle_accept_request(data):
         emit("error", {"message": "Invalid driver or request"})
         return
 
-    request_data = emergency_requests[request_id]
-    if request_data["status"] != "pending":
+    if active_drivers[driver_id]["status"] != "available":
+        emit("error", {"message": "Finish your current request first"})
+        return
+
+    assigned = assign_driver(request_id, driver_id)
+    if assigned is None:
         emit("error", {"message": "Request no longer available"})
         return
 
-    # Update request and driver status
-    emergency_requests[request_id]["driver_id"] = driver_id
-    emergency_requests[request_id]["status"] = "accepted"
+    # Confirm to driver
+    request_data, _ = assigned
+    emit(
+        "request_accepted",
+        {"request_id": request_id, "patient_location": request_data["location"]},
+    )
+
+
+def assign_driver(request_id, driver_id):
+    """Give a pending request to an available driver and notify the patient.
+
+    Both the driver and the request are claimed atomically, so neither two
+    drivers nor a driver and the queue matcher can both win the same request.
+    Returns (request_data, driver_data), or None if either was taken first.
+    """
+    driver_data = active_drivers.compare_and_set(
+        driver_id, "status", "available", status="en_route", current_request=request_id
+    )
+    if driver_data is None:
+        return None
+    request_data = emergency_requests.transition(
+        request_id, "pending", "accepted", driver_id=driver_id
+    )
+    if request_data is None:
+        set_driver_status(driver_id, "available", current_request=None)
+        return None
+    log_event("accepted", request_id, driver_id=driver_id)
+
+    time_to_accept_seconds.observe(
+        (
+            datetime.now() - datetime.fromisoformat(request_data["timestamp"])
+        ).total_seconds()
+    )
 
-    active_drivers[driver_id]["current_request"] = request_id
-    active_drivers[driver_id]["status"] = "en_route"
+    # Take the alert back from the other drivers and out of the queue
+    driver_index.remove(driver_id)
+    dispatch_engine.accepted(request_id, driver_id)
+    dispatch_queue.remove(request_id)
 
     patient_id = request_data["patient_id"]
-    active_patients[patient_id]["status"] = "driver_assigned"
+    patient_data = active_patients.patch(patient_id, status="driver_assigned")
 
     # Notify patient
-    patient_sid = active_patients[patient_id]["sid"]
+    if patient_data is not None:
+        eta_seconds = eta_engine.seconds(
+            driver_data["location"], request_data["location"]
+        )
+        socketio.emit(
+            "driver_assigned",
+            {
+                "driver_id": driver_id,
+                "driver_location": driver_data["location"],
+                "estimated_arrival": format_eta(eta_seconds),
+                "estimated_arrival_seconds": eta_seconds,
+            },
+            room=patient_data["sid"],
+        )
+    return request_data, driver_data
+
+
+def assign_queued_request(request_id, driver_id):
+    """Queue matcher callback: assign a queued request and tell the driver"""
+    assigned = assign_driver(request_id, driver_id)
+    if assigned is None:
+        return False
+    request_data, driver_data = assigned
     socketio.emit(
-        "driver_assigned",
+        "request_assigned",
         {
-            "driver_id": driver_id,
-            "driver_location": active_drivers[driver_id]["location"],
-            "estimated_arrival": "5-10 minutes",  # This could be calculated based on distance
+            "request_id": request_id,
+            "patient_location": request_data["location"],
+            "emergency_type": request_data["emergency_type"],
         },
-        room=patient_sid,
-    )
-
-    # Confirm to driver
-    emit(
-        "request_accepted",
-        {"request_id": request_id, "patient_location": request_data["location"]},
+        room=driver_data["sid"],
     )
+    return True
 
 
-@socketio.on("decline_request")
+@socket_event("decline_request")
 def handle_decline_request(data):
     driver_id = data.get("driver_id")
     request_id = data.get("request_id")
 
-    # Find next nearest driver
+    # Escalate to more drivers once everyone alerted has declined
     if request_id in emergency_requests:
-        request_data = emergency_requests[request_id]
-        patient_location = request_data["location"]
-
-        # Find next nearest driver (excluding current driver)
-        next_driver = find_nearest_driver(patient_location, exclude_driver=driver_id)
+        log_event("declined", request_id, driver_id=driver_id)
+        dispatch_engine.declined(request_id, driver_id)
 
-        if next_driver:
-            next_driver_id, next_driver_data = next_driver
-            socketio.emit(
-                "emergency_alert",
-                {
-                    "request_id": request_id,
-                    "patient_location": patient_location,
-                    "emergency_type": request_data["emergency_type"],
-                    "distance": calculate_distance(
-                        patient_location, next_driver_data["location"]
-                    ),
-                },
-                room=next_driver_data["sid"],
-            )
-        else:
-            # No more drivers available
-            patient_id = request_data["patient_id"]
-            if patient_id in active_patients:
-                socketio.emit(
-                    "no_drivers_available",
-                    {"message": "No drivers available at the moment, please try again"},
-                    room=active_patients[patient_id]["sid"],
-                )
 
-
-@socketio.on("update_location")
+@socket_event("update_location")
 def handle_location_update(data):
     user_id = data.get("user_id")
     location = data.get("location")
     user_type = data.get("user_type")  # 'patient' or 'driver'
 
     if user_type == "patient" and user_id in active_patients:
-        active_patients[user_id]["location"] = location
+        patient_data = active_patients.patch(user_id, location=location)
 
         # If patient has an assigned driver, update driver with new location
-        request_id = active_patients[user_id].get("request_id")
+        request_id = patient_data.get("request_id")
         if request_id and request_id in emergency_requests:
+            log_event("location", request_id, role="patient", location=location)
             driver_id = emergency_requests[request_id].get("driver_id")
             if driver_id and driver_id in active_drivers:
-                socketio.emit(
+                location_fanout.submit(
+                    active_drivers[driver_id]["sid"],
                     "patient_location_update",
-                    {"patient_location": location},
-                    room=active_drivers[driver_id]["sid"],
+                    "patient_location",
+                    location,
                 )
 
     elif user_type == "driver" and user_id in active_drivers:
-        active_drivers[user_id]["location"] = location
+        driver_data = active_drivers.patch(user_id, location=location)
+        if driver_data["status"] == "available":
+            driver_index.upsert(user_id, location)
 
         # If driver has a current request, update patient with driver location
-        request_id = active_drivers[user_id].get("current_request")
+        request_id = driver_data.get("current_request")
         if request_id and request_id in emergency_requests:
+            log_event("location", request_id, role="driver", location=location)
             patient_id = emergency_requests[request_id]["patient_id"]
             if patient_id in active_patients:
-                socketio.emit(
+                location_fanout.submit(
+                    active_patients[patient_id]["sid"],
                     "driver_location_update",
-                    {"driver_location": location},
-                    room=active_patients[patient_id]["sid"],
+                    "driver_location",
+                    location,
                 )
 
 
-@socketio.on("arrived")
+@socket_event("arrived")
 def handle_arrived(data):
     driver_id = data.get("driver_id")
 
@@ -696,10 +1395,11 @@ def handle_arrived(data):
     if request_id and request_id in emergency_requests:
         patient_id = emergency_requests[request_id]["patient_id"]
 
-        # Update status
-        emergency_requests[request_id]["status"] = "arrived"
-        active_drivers[driver_id]["status"] = "arrived"
-        active_patients[patient_id]["status"] = "ambulance_arrived"
+        # Update status; the driver is free for the next request
+        emergency_requests.update(request_id, status="arrived")
+        log_event("arrived", request_id, driver_id=driver_id)
+        set_driver_status(driver_id, "available", current_request=None)
+        active_patients.patch(patient_id, status="ambulance_arrived")
 
         # Notify patient
         socketio.emit(
@@ -711,34 +1411,32 @@ def handle_arrived(data):
         emit("arrival_confirmed", {"message": "Arrival confirmed"})
 
 
-def find_nearest_driver(patient_location, exclude_driver=None):
-    """Find the nearest available driver to the patient location"""
-    nearest_driver = None
-    min_distance = float("inf")
+def set_driver_status(driver_id, status, **fields):
+    """Update a driver's status, keeping the index of available drivers in sync"""
+    driver_data = active_drivers.patch(driver_id, status=status, **fields)
+    if driver_data is not None and status == "available":
+        driver_index.upsert(driver_id, driver_data["location"])
+        dispatch_queue.availability_changed()
+    else:
+        driver_index.remove(driver_id)
+    return driver_data
 
-    for driver_id, driver_data in active_drivers.items():
-        if driver_id == exclude_driver:
-            continue
 
-        if driver_data["status"] == "available":
-            distance = calculate_distance(patient_location, driver_data["location"])
-            if distance < min_distance:
-                min_distance = distance
-                nearest_driver = (driver_id, driver_data)
+def rank_by_distance(origin, items):
+    """Sort dicts with a "location" by distance from origin, adding "distance".
 
-    return nearest_driver
+    Distances for all items are computed in one vectorized pass; items with
+    an invalid location get a distance of None and sort last.
+    """
+    if not items:
+        return items
 
+    lats, lngs, _ = location_arrays([item["location"] for item in items])
+    for item, distance in zip(items, distances_km(origin, lats, lngs).tolist()):
+        item["distance"] = None if math.isnan(distance) else distance
 
-def calculate_distance(loc1, loc2):
-    """Calculate distance between two locations in kilometers"""
-    try:
-        if isinstance(loc1, dict) and isinstance(loc2, dict):
-            point1 = (loc1["lat"], loc1["lng"])
-            point2 = (loc2["lat"], loc2["lng"])
-            return geodesic(point1, point2).kilometers
-        return 0
-    except:
-        return 0
+    items.sort(key=lambda item: (item["distance"] is None, item["distance"] or 0))
+    return items
 
 
 @app.route("/upload", methods=["POST"])
@@ -752,10 +1450,11 @@ def upload_file():
         return jsonify({"error": "No file selected"}), 400
 
     if file and allowed_file(file.filename):
-        # Generate unique filename
-        filename = str(uuid.uuid4()) + "." + file.filename.rsplit(".", 1)[1].lower()
-        filepath = os.path.join(app.config["UPLOAD_FOLDER"], filename)
-        file.save(filepath)
+        # Reject files that aren't really images before writing anything
+        data, header = read_image(file.stream, **app.config["IMAGE_INGEST"])
+        # Named by content, so re-uploading the same image stores nothing new
+        extension = "png" if header.format == "PNG" else "jpg"
+        filename = upload_store.save(data, extension)
 
         return jsonify(
             {
@@ -773,213 +1472,421 @@ def upload_file():
     )
 
 
-@app.route("/chest", methods=["POST"])
-def chest_check():
-    if not XRAY_CLASSIFICATION_AVAILABLE:
-        return jsonify({"error": "X-ray classification not available"}), 503
+def prediction_key(digest, model_path):
+    """Cache key of a model's prediction for the upload with content hash digest"""
+    model_identity = model_registry.get(model_path).identity
+    return prediction_cache.key(digest, f"{model_identity}/v{PREDICTION_FORMAT}")
 
-    image = request.files["file"]
-    # Model to check if image is a chest X-ray
-    model_path = "models/only_chest.pt"
-    image_data = Image.open(image.stream)
 
-    # Get classification results
-    clasification_result = image_classification(model_path=model_path, image=image_data)
+def predict_upload(upload_data, model_path, prepared=None, digest=None):
+    """Return the prediction dict for an upload, served from the cache when possible.
 
-    # Parse the JSON string returned by image_classification
-    import json
+    On a cache hit the upload is neither decoded nor run through the model.
+    digest, the upload's content hash, is computed here unless given.
+    """
+    if digest is None:
+        digest = prediction_cache.digest(upload_data)
+    cache_key = prediction_key(digest, model_path)
+    prediction = prediction_cache.get(cache_key)
+    if prediction is not None:
+        return prediction
 
-    classification_data = json.loads(clasification_result)
+    if prepared is None:
+        prepared = PreparedImage(
+            upload_data, draft_size=model_registry.get(model_path).imgsz
+        )
 
-    # Transform to match predict endpoint format
-    if classification_data and len(classification_data) > 0:
-        top_prediction = classification_data[0]  # Get the highest confidence prediction
+    # Class probabilities from the inference pool, straight into the prediction
+    started = time.perf_counter()
+    classification = inference_pool.run(classify_prepared, model_path, prepared)
+    returned = time.perf_counter()
+    prediction = build_prediction(classification)
+    if prediction is not None:
+        prediction_cache.put(cache_key, prediction)
 
-        # Create prediction object matching predict endpoint format
-        prediction = {
-            "class": top_prediction["label"],
-            "confidence": int(
-                top_prediction["confidence"] * 100
-            ),  # Convert to percentage
-        }
+    # Stage timings come back from the worker; the rest of the round trip
+    # was spent waiting in (or travelling through) the pool
+    timings = dict(classification.timings or {})
+    timings["queue"] = max(returned - started - sum(timings.values()), 0.0)
+    timings["postprocess"] = time.perf_counter() - returned
+    for stage, seconds in timings.items():
+        inference_stage_seconds.labels(model_path, stage).observe(seconds)
+    return prediction
 
-        # For chest validation, we don't need covid/normal/pneumonia breakdown
-        # Just return whether it's chest or not
-        prediction["covid"] = 0
-        prediction["normal"] = 0
-        prediction["pneumonia"] = 0
 
-        return jsonify({"success": True, "prediction": prediction})
-    else:
-        return jsonify({"error": "No classification results"}), 500
+@app.errorhandler(IngestError)
+def ingest_error(e):
+    return jsonify({"error": e.message}), e.status
 
 
-@app.route("/image", methods=["POST"])
-def image():
-    if not XRAY_CLASSIFICATION_AVAILABLE:
-        return jsonify({"error": "X-ray classification not available"}), 503
+@app.errorhandler(InferenceBusy)
+def inference_busy(e):
+    response = jsonify({"error": "Inference queue is full, please retry later"})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, 503
 
-    image = request.files["file"]
-    # Your  model trained with 4 classes is path
-    model_path = "models/four_classes.pt"
-    image_data = Image.open(image.stream)
 
-    # Get classification results
-    clasification_result = image_classification(model_path=model_path, image=image_data)
+def classify_upload(model_path):
+    """Shared body of the single-model endpoints: classify the uploaded image"""
+    if not XRAY_CLASSIFICATION_AVAILABLE:
+        return jsonify({"error": "X-ray classification not available"}), 503
 
-    # Parse the JSON string returned by image_classification
-    import json
+    prediction = predict_upload(read_upload(), model_path)
+    if prediction is None:
+        return jsonify({"error": "No classification results"}), 500
 
-    classification_data = json.loads(clasification_result)
+    return jsonify({"success": True, "prediction": prediction})
 
-    # Transform to match predict endpoint format
-    if classification_data and len(classification_data) > 0:
-        top_prediction = classification_data[0]  # Get the highest confidence prediction
 
-        # Create prediction object matching predict endpoint format
-        prediction = {
-            "class": top_prediction["label"],
-            "confidence": int(
-                top_prediction["confidence"] * 100
-            ),  # Convert to percentage
-        }
+@app.route("/chest", methods=["POST"])
+def chest_check():
+    # Model to check if image is a chest X-ray
+    return classify_upload(CHEST_MODEL_PATH)
 
-        # Add individual class confidences (initialize to 0)
-        prediction["covid"] = 0
-        prediction["normal"] = 0
-        prediction["pneumonia"] = 0
-
-        # Set the confidence for the predicted class
-        class_name = top_prediction["label"].lower()
-        if "covid" in class_name:
-            prediction["covid"] = prediction["confidence"]
-        elif "normal" in class_name:
-            prediction["normal"] = prediction["confidence"]
-        elif "pneumonia" in class_name:
-            prediction["pneumonia"] = prediction["confidence"]
-
-        # Distribute remaining confidence among other classes based on other predictions
-        remaining_confidence = 100 - prediction["confidence"]
-        other_predictions = (
-            classification_data[1:3] if len(classification_data) > 1 else []
-        )
 
-        for pred in other_predictions:
-            pred_class = pred["label"].lower()
-            pred_conf = int(pred["confidence"] * 100)
-            if "covid" in pred_class and prediction["covid"] == 0:
-                prediction["covid"] = min(pred_conf, remaining_confidence)
-                remaining_confidence -= prediction["covid"]
-            elif "normal" in pred_class and prediction["normal"] == 0:
-                prediction["normal"] = min(pred_conf, remaining_confidence)
-                remaining_confidence -= prediction["normal"]
-            elif "pneumonia" in pred_class and prediction["pneumonia"] == 0:
-                prediction["pneumonia"] = min(pred_conf, remaining_confidence)
-                remaining_confidence -= prediction["pneumonia"]
-
-        return jsonify({"success": True, "prediction": prediction})
-    else:
-        return jsonify({"error": "No classification results"}), 500
+@app.route("/image", methods=["POST"])
+def image():
+    # Model trained with 4 classes (COVID, lung opacity, normal, pneumonia)
+    return classify_upload(FOUR_CLASS_MODEL_PATH)
 
 
 @app.route("/iscovid", methods=["POST"])
 def iscovid_check():
+    # Model trained with 2 classes (check Covid)
+    return classify_upload(COVID_MODEL_PATH)
+
+
+@app.route("/analyze", methods=["POST"])
+def analyze():
+    """Run the chest -> COVID -> 4-class cascade on a single upload"""
     if not XRAY_CLASSIFICATION_AVAILABLE:
         return jsonify({"error": "X-ray classification not available"}), 503
 
-    image = request.files["file"]
-    # Your  model trained with 2 classes is path (check Covid).
-    model_path = "models/is_covid.pt"
-    image_data = Image.open(image.stream)
-
-    # Get classification results
-    clasification_result = image_classification(model_path=model_path, image=image_data)
+    # Hashed once; every stage's cache key derives from the same digest
+    upload_data = read_upload()
+    digest = prediction_cache.digest(upload_data)
+    if inference_pool.mode == "process":
+        return jsonify(analyze_in_worker(upload_data, digest))
+
+    # Decode at most once (and only on a cache miss), at a reduced JPEG scale
+    # that still covers the largest model input; models with the same input
+    # size share one tensor
+    prepared = PreparedImage(
+        upload_data,
+        draft_size=max(model_registry.get(path).imgsz for path in MODEL_PATHS),
+    )
 
-    # Parse the JSON string returned by image_classification
-    import json
+    result = {
+        "success": True,
+        "is_chest_xray": False,
+        "chest": None,
+        "covid": None,
+        "prediction": None,
+    }
 
-    classification_data = json.loads(clasification_result)
+    for stage, model_path in CASCADE:
+        prediction = predict_upload(
+            upload_data, model_path, prepared=prepared, digest=digest
+        )
+        if prediction is None:
+            return jsonify({"error": "No classification results"}), 500
+        result[stage] = prediction
+
+        # Stop early when the upload is not a chest X-ray
+        if stage == "chest":
+            result["is_chest_xray"] = is_chest_xray(prediction)
+            if not result["is_chest_xray"]:
+                break
+
+    return jsonify(result)
+
+
+def analyze_in_worker(upload_data, digest):
+    """The /analyze result, with the stages not cached run as one pool job.
+
+    A worker process gets its arguments pickled, so sending the cascade a
+    stage at a time would ship and decode the upload once per model.
+    """
+    result = {
+        "success": True,
+        "is_chest_xray": False,
+        "chest": None,
+        "covid": None,
+        "prediction": None,
+    }
+    for index, (stage, model_path) in enumerate(CASCADE):
+        prediction = prediction_cache.get(prediction_key(digest, model_path))
+        if prediction is None:
+            remaining = CASCADE[index:]
+            screened = inference_pool.run(
+                screen_batch, [("upload", upload_data)], remaining
+            )[0]
+            if not screened["success"]:
+                raise IngestError(screened["error"])
+            for screened_stage, screened_path in remaining:
+                if screened[screened_stage] is not None:
+                    result[screened_stage] = screened[screened_stage]
+                    prediction_cache.put(
+                        prediction_key(digest, screened_path), screened[screened_stage]
+                    )
+            if stage == "chest":
+                result["is_chest_xray"] = screened["is_chest_xray"]
+            return result
+
+        result[stage] = prediction
+        # Stop early when the upload is not a chest X-ray
+        if stage == "chest":
+            result["is_chest_xray"] = is_chest_xray(prediction)
+            if not result["is_chest_xray"]:
+                break
+    return result
+
+
+def run_screening_batch(batch):
+    """Screen a batch on the inference pool, waiting for room when it is full"""
+    while True:
+        try:
+            return inference_pool.run(screen_batch, batch)
+        except InferenceBusy as e:
+            socketio.sleep(e.retry_after)
+
+
+@app.route("/api/screening/bulk", methods=["POST"], endpoint="bulk_screening")
+def bulk_screening():
+    """Screen every image in uploaded archives or files, streaming NDJSON results.
+
+    The first line carries the job ID; pass it back as ?job_id= with the same
+    upload to resume an interrupted job without re-running finished entries.
+    """
+    if not XRAY_CLASSIFICATION_AVAILABLE:
+        return jsonify({"error": "X-ray classification not available"}), 503
 
-    # Transform to match predict endpoint format
-    if classification_data and len(classification_data) > 0:
-        top_prediction = classification_data[0]  # Get the highest confidence prediction
+    uploads = [file for file in request.files.values() if file.filename]
+    if not uploads:
+        return jsonify({"error": "No file provided"}), 400
 
-        # Create prediction object matching predict endpoint format
-        prediction = {
-            "class": top_prediction["label"],
-            "confidence": int(
-                top_prediction["confidence"] * 100
-            ),  # Convert to percentage
-        }
+    job_id = request.args.get("job_id")
+    if job_id and bulk_jobs.get(job_id) is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    config = app.config["BULK_SCREENING"]
+    batch_size = request.args.get("batch_size", config["batch_size"], type=int)
+    if batch_size < 1:
+        return jsonify({"error": "batch_size must be a positive integer"}), 400
+    batch_size = min(batch_size, 64)
+    job = bulk_jobs.start(job_id)
+
+    def generate():
+        yield json.dumps({"job_id": job["job_id"], "status": "running"}) + "\n"
+        entries = (
+            entry
+            for upload in uploads
+            for entry in iter_entries(
+                upload.stream, upload.filename, config["max_entry_bytes"]
+            )
+        )
+        status = "interrupted"
+        try:
+            for result in screen_entries(
+                entries,
+                batch_size=batch_size,
+                run_batch=run_screening_batch,
+                previous=lambda name: bulk_jobs.result(job["job_id"], name),
+            ):
+                bulk_jobs.record(job, result)
+                yield json.dumps(result) + "\n"
+                # Save progress once per batch for the status endpoint
+                if (job["processed"] + job["resumed"]) % batch_size == 0:
+                    bulk_jobs.update(job)
+            status = "completed"
+        except Exception as e:
+            logger.exception("Bulk screening job %s failed", job["job_id"])
+            status = "failed"
+            yield json.dumps({"job_id": job["job_id"], "error": str(e)}) + "\n"
+        finally:
+            bulk_jobs.update(job, status)
+        yield json.dumps(job) + "\n"
+
+    response = Response(
+        stream_with_context(generate()), mimetype="application/x-ndjson"
+    )
+    response.headers["X-Job-Id"] = job["job_id"]
+    return response
 
-        # For COVID detection model, set COVID vs Normal
-        prediction["covid"] = 0
-        prediction["normal"] = 0
-        prediction["pneumonia"] = 0  # Keep for consistency
-
-        # Set the confidence for the predicted class
-        class_name = top_prediction["label"].lower()
-        if "covid" in class_name:
-            prediction["covid"] = prediction["confidence"]
-            # Set normal as the complement for binary classification
-            if len(classification_data) > 1:
-                prediction["normal"] = int(classification_data[1]["confidence"] * 100)
-            else:
-                prediction["normal"] = 100 - prediction["confidence"]
-        else:
-            prediction["normal"] = prediction["confidence"]
-            # Set covid as the complement for binary classification
-            if len(classification_data) > 1:
-                prediction["covid"] = int(classification_data[1]["confidence"] * 100)
-            else:
-                prediction["covid"] = 100 - prediction["confidence"]
 
-        return jsonify({"success": True, "prediction": prediction})
-    else:
-        return jsonify({"error": "No classification results"}), 500
+@app.route("/api/screening/bulk/<job_id>")
+def bulk_screening_status(job_id):
+    job = bulk_jobs.get(job_id) if bulk_jobs else None
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
 
 
 @app.route("/predict", methods=["POST"])
 def predict():
-    data = request.get_json()
+    """Queue a screening job for a file from /upload and return its ID at once.
+
+    Poll /predict/<job_id>, or join its room with the watch_prediction socket
+    event (or pass "sid" here) to receive prediction_complete when done.
+    """
+    data = request.get_json(silent=True) or {}
     filename = data.get("filename")
 
     if not filename:
         return jsonify({"error": "No filename provided"}), 400
 
-    # Simulate processing time
-    time.sleep(2)
+    if not XRAY_CLASSIFICATION_AVAILABLE:
+        return jsonify({"error": "X-ray classification not available"}), 503
 
-    # Mock prediction results (replace with actual AI model)
-    mock_results = [
-        {"class": "Normal", "confidence": 94, "covid": 3, "normal": 94, "pneumonia": 3},
-        {
-            "class": "COVID-19",
-            "confidence": 87,
-            "covid": 87,
-            "normal": 8,
-            "pneumonia": 5,
-        },
-        {
-            "class": "Pneumonia",
-            "confidence": 91,
-            "covid": 4,
-            "normal": 5,
-            "pneumonia": 91,
-        },
-    ]
+    filepath = upload_store.path(filename)
+    if filepath is None:
+        return jsonify({"error": "File not found"}), 404
 
-    result = random.choice(mock_results)
+    job = prediction_jobs.create(filename)
+    try:
+        future = inference_pool.submit(screen_file, filepath, filename)
+    except InferenceBusy:
+        prediction_jobs.delete(job["job_id"])
+        raise
+    future.add_done_callback(
+        lambda future: finish_prediction_job(job["job_id"], future, data.get("sid"))
+    )
+
+    return (
+        jsonify(
+            {
+                "success": True,
+                "job_id": job["job_id"],
+                "status": job["status"],
+                "status_url": url_for("prediction_status", job_id=job["job_id"]),
+            }
+        ),
+        202,
+    )
 
-    return jsonify({"success": True, "prediction": result})
+
+def finish_prediction_job(job_id, future, sid=None):
+    """Store a finished job's result and notify clients watching it"""
+    try:
+        result = future.result()
+        if result["success"]:
+            job = prediction_jobs.complete(job_id, result)
+        else:
+            job = prediction_jobs.fail(job_id, result["error"])
+    except Exception as e:
+        logger.exception("Prediction job %s failed", job_id)
+        job = prediction_jobs.fail(job_id, str(e))
+    if job is None:
+        return
+
+    payload = prediction_job_payload(job)
+    socketio.emit("prediction_complete", payload, room=f"prediction_{job_id}")
+    if sid:
+        socketio.emit("prediction_complete", payload, room=sid)
+
+
+def prediction_job_payload(job):
+    payload = {"job_id": job["job_id"], "status": job["status"]}
+    if job["status"] == "completed":
+        payload["result"] = job["result"]
+    elif job["status"] == "failed":
+        payload["error"] = job["error"]
+    return payload
+
+
+@app.route("/predict/<job_id>")
+def prediction_status(job_id):
+    job = prediction_jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found or expired"}), 404
+    return jsonify(dict(prediction_job_payload(job), success=True))
+
+
+@socket_event("watch_prediction")
+def handle_watch_prediction(data):
+    job_id = data.get("job_id")
+    job = prediction_jobs.get(job_id)
+    if job is None:
+        emit("error", {"message": "Prediction job not found"})
+        return
+
+    join_room(f"prediction_{job_id}")
+    # The job may have finished before the client started watching
+    if job["status"] != "queued":
+        emit("prediction_complete", prediction_job_payload(job))
 
 
 @app.route("/uploads/<filename>")
 def uploaded_file(filename):
-    return url_for("static", filename="uploads/" + filename)
+    filepath = upload_store.path(filename)
+    if filepath is None:
+        return jsonify({"error": "File not found"}), 404
+
+    # Stored files never change, so the content hash is the ETag and clients
+    # may cache them indefinitely; conditional and range requests get 304/206
+    response = send_file(
+        filepath,
+        conditional=True,
+        etag=upload_store.etag(filename),
+        max_age=365 * 24 * 3600,
+    )
+    response.headers["Cache-Control"] += ", immutable"
+    return response
+
+
+def init_app():
+    """Start this server process: load models and data, replay the event log
+    and start the background loops.
+
+    Called once, below, by the process that serves requests. Inference
+    workers spawned in process mode re-import this module as their main
+    module and must skip it: they only need what the pool initializer loads,
+    and only one process may own the event log.
+    """
+    global inference_pool
+    if app.config["PREDICTION_CACHE"]["persist_path"]:
+        prediction_cache.open(app.config["PREDICTION_CACHE"]["persist_path"])
+    if app.config["ROAD_NETWORK"]["path"]:
+        eta_engine.load_graph(
+            app.config["ROAD_NETWORK"]["path"], app.config["ROAD_NETWORK"]["landmarks"]
+        )
+    if XRAY_CLASSIFICATION_AVAILABLE:
+        inference_pool = start_inference_pool()
+
+    if event_log is not None:
+        restore_requests(event_log.recover())
+        socketio.start_background_task(event_log.run, socketio.sleep)
+        atexit.register(event_log.close)
+    if state_backend.shared:
+        socketio.start_background_task(resync_driver_index)
+    socketio.start_background_task(location_fanout.run, socketio.sleep)
+    socketio.start_background_task(dispatch_queue.run, socketio.sleep)
+    socketio.start_background_task(dispatch_engine.run, socketio.sleep)
+    socketio.start_background_task(upload_store.run, socketio.sleep)
+
+    if (
+        profiler_token
+        and hasattr(signal, "SIGUSR2")
+        and threading.current_thread() is threading.main_thread()
+    ):
+        signal.signal(signal.SIGUSR2, toggle_profiler)
+
+
+# Imported by a WSGI server or a test. Spawned inference workers import this
+# module too and must skip it: as __mp_main__ when it is the main script
+# (before parent_process() is set), by name when a job refers to it
+if (
+    __name__ not in ("__main__", "__mp_main__")
+    and multiprocessing.parent_process() is None
+):
+    init_app()
 
 
 if __name__ == "__main__":
     # Create uploads directory if it doesn't exist
     os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+    # The debug reloader re-runs this script in a child process that serves
+    # (WERKZEUG_RUN_MAIN set); this one only watches for changes
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        init_app()
     socketio.run(app, debug=True, host="0.0.0.0", port=5656)
@@ -0,0 +1,72 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+class MicroBatcher:
+    """Coalesce concurrent single-image requests into stacked forward passes.
+
+    Request threads call submit() with a 1xCxHxW tensor and block until their
+    row of the batch is ready. A single worker thread takes the first queued
+    item, keeps collecting until max_batch_size items are waiting or
+    max_wait_ms has passed, then runs one forward pass for all of them.
+    """
+
+    def __init__(self, forward, max_batch_size=8, max_wait_ms=5, name="batcher"):
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, tensor):
+        """Queue a 1xCxHxW tensor and return its probabilities once computed"""
+        if self.max_batch_size <= 1:
+            return self.forward(tensor)[0]
+
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((tensor, future))
+        return future.result()
+
+    def _ensure_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name=self.name, daemon=True
+                )
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            futures = [future for _, future in batch]
+            try:
+                output = self.forward(torch.cat([tensor for tensor, _ in batch]))
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            for row, future in zip(output, futures):
+                future.set_result(row)
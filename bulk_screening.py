@@ -0,0 +1,300 @@
+"""Bulk screening: run the screening cascade over archives or directories of films.
+
+Entries are streamed out of zip/tar archives (or multipart uploads, or a
+local directory) and classified in stacked batches, one forward pass per
+model per batch, with one result per entry produced as each batch finishes.
+
+A job can be resumed: entries that already have a result from an earlier
+run of the same job are passed through without being decoded again.
+
+Usage:
+    python bulk_screening.py films/ films.zip [--output results.ndjson]
+
+Re-running with the same --output skips entries already written to it.
+"""
+
+import argparse
+import io
+import json
+import os
+import sys
+import tarfile
+import uuid
+import zipfile
+from datetime import datetime
+
+import torch
+
+from image_ingest import IngestError, read_image
+from log_config import configure_logging
+from model_registry import Classification, PreparedImage, registry
+from screening import CASCADE, MODEL_PATHS, build_prediction, is_chest_xray
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+ARCHIVE_EXTENSIONS = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+
+
+def _is_image_name(name):
+    return name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(
+        name
+    ).startswith(".")
+
+
+def _archive_kind(head):
+    """Archive type ("zip" or "tar"), or None, from the first 512 bytes of a file"""
+    if head.startswith(b"PK\x03\x04"):
+        return "zip"
+    # gzip, bzip2 and xz compressed tars, or a plain tar's ustar magic
+    if head.startswith((b"\x1f\x8b", b"BZh", b"\xfd7zXZ\x00")):
+        return "tar"
+    if head[257:262] == b"ustar":
+        return "tar"
+    return None
+
+
+def iter_entries(fileobj, name, max_entry_bytes=10 * 1024 * 1024):
+    """Yield (name, data) for every image in an uploaded file.
+
+    Archives are expanded entry by entry; any other file is taken to be a
+    single image. data is None for entries over max_entry_bytes, which are
+    never read (so a zip bomb costs nothing).
+    """
+    head = fileobj.read(512)
+    fileobj.seek(0)
+    kind = _archive_kind(head)
+
+    if kind == "zip":
+        with zipfile.ZipFile(fileobj) as archive:
+            for info in archive.infolist():
+                if info.is_dir() or not _is_image_name(info.filename):
+                    continue
+                if info.file_size > max_entry_bytes:
+                    yield info.filename, None
+                    continue
+                yield info.filename, archive.read(info)
+    elif kind == "tar":
+        # Stream mode reads members in order without seeking back
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or not _is_image_name(member.name):
+                    continue
+                if member.size > max_entry_bytes:
+                    yield member.name, None
+                    continue
+                yield member.name, archive.extractfile(member).read()
+    else:
+        data = fileobj.read(max_entry_bytes + 1)
+        yield name, None if len(data) > max_entry_bytes else data
+
+
+def iter_directory(root, max_entry_bytes=10 * 1024 * 1024):
+    """Yield (name, data) for images and archived images under root, in name order"""
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(directory, filename)
+            name = os.path.relpath(path, root)
+            if filename.lower().endswith(ARCHIVE_EXTENSIONS):
+                yield from iter_path(path, name, max_entry_bytes)
+            elif _is_image_name(filename):
+                with open(path, "rb") as f:
+                    yield from iter_entries(f, name, max_entry_bytes)
+
+
+def iter_path(path, name=None, max_entry_bytes=10 * 1024 * 1024):
+    """Yield (name, data) for a directory, an archive or a single image on disk"""
+    name = name or os.path.basename(path)
+    if os.path.isdir(path):
+        yield from iter_directory(path, max_entry_bytes)
+        return
+    with open(path, "rb") as f:
+        for entry_name, data in iter_entries(f, name, max_entry_bytes):
+            if entry_name != name:
+                entry_name = f"{name}/{entry_name}"
+            yield entry_name, data
+
+
+def screen_batch(items, stages=CASCADE):
+    """Run the screening cascade over [(name, data)] in stacked forward passes.
+
+    Returns one result per item, in order, shaped like the /analyze response
+    plus the entry name. Unreadable entries get success False and an error
+    instead of failing the batch.
+    """
+    draft_size = max(registry.get(model_path).imgsz for _, model_path in stages)
+    results = []
+    active = []
+    for name, data in items:
+        result = {"name": name, "success": True, "is_chest_xray": False}
+        result.update((stage, None) for stage, _ in stages)
+        results.append(result)
+        try:
+            if data is None:
+                raise IngestError("File is too large", 413)
+            read_image(io.BytesIO(data))
+        except IngestError as e:
+            result.update(success=False, error=e.message)
+            continue
+        active.append((result, PreparedImage(data, draft_size=draft_size)))
+
+    for stage, model_path in stages:
+        model = registry.get(model_path)
+        tensors = []
+        decoded = []
+        for result, prepared in active:
+            try:
+                tensors.append(prepared.tensor(model.imgsz))
+            except IngestError as e:
+                result.update(success=False, error=e.message)
+                continue
+            decoded.append((result, prepared))
+        if not decoded:
+            break
+
+        probs = model.forward(torch.cat(tensors))
+        active = []
+        for (result, prepared), row in zip(decoded, probs):
+            result[stage] = build_prediction(Classification.from_model(model, row))
+            # Only chest X-rays go on to the diagnostic models
+            if stage == "chest":
+                result["is_chest_xray"] = is_chest_xray(result[stage])
+                if not result["is_chest_xray"]:
+                    continue
+            active.append((result, prepared))
+
+    return results
+
+
+def screen_file(path, name=None):
+    """Screen one image file on disk; returns its result"""
+    with open(path, "rb") as f:
+        data = f.read()
+    return screen_batch([(name or os.path.basename(path), data)])[0]
+
+
+def screen_entries(entries, batch_size=16, run_batch=screen_batch, previous=None):
+    """Yield a result for every (name, data) entry, batch by batch.
+
+    previous(name) may return the stored result of an earlier run of the
+    same job; such entries are yielded with "resumed": True and skipped.
+    run_batch lets the server route batches through its inference pool.
+    """
+    batch = []
+    for name, data in entries:
+        result = previous(name) if previous else None
+        if result is not None:
+            yield dict(result, resumed=True)
+            continue
+        batch.append((name, data))
+        if len(batch) >= batch_size:
+            yield from run_batch(batch)
+            batch = []
+    if batch:
+        yield from run_batch(batch)
+
+
+class BulkJobs:
+    """Progress and per-entry results of bulk jobs, kept in the state backend.
+
+    Both tables are capped (oldest first) so finished jobs don't accumulate.
+    """
+
+    def __init__(self, backend, max_jobs=1000, max_results=100_000):
+        self.backend = backend
+        self.max_jobs = max_jobs
+        self.max_results = max_results
+
+    def get(self, job_id):
+        return self.backend.get("bulk_jobs", job_id)
+
+    def start(self, job_id=None):
+        """Create a job, or reopen an existing one for resuming; returns the job"""
+        job = self.get(job_id) if job_id else None
+        now = datetime.now().isoformat()
+        if job is None:
+            job = {
+                "job_id": job_id or str(uuid.uuid4()),
+                "processed": 0,
+                "errors": 0,
+                "created_at": now,
+            }
+        job.update(status="running", resumed=0, updated_at=now)
+        self._save(job)
+        return job
+
+    def result(self, job_id, name):
+        return self.backend.get("bulk_results", f"{job_id}:{name}")
+
+    def record(self, job, result):
+        """Store one entry's result and count it towards job"""
+        if result.get("resumed"):
+            job["resumed"] += 1
+            return
+        self.backend.capped_put(
+            "bulk_results",
+            f"{job['job_id']}:{result['name']}",
+            result,
+            self.max_results,
+        )
+        job["processed"] += 1
+        if not result["success"]:
+            job["errors"] += 1
+
+    def update(self, job, status=None):
+        if status:
+            job["status"] = status
+        job["updated_at"] = datetime.now().isoformat()
+        self._save(job)
+
+    def _save(self, job):
+        self.backend.capped_put("bulk_jobs", job["job_id"], job, self.max_jobs)
+
+
+def _previous_results(output):
+    """Results already written to an NDJSON output file, by entry name"""
+    results = {}
+    if output and os.path.exists(output):
+        with open(output) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result["name"]] = result
+    return results
+
+
+def main():
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Screen directories or archives")
+    parser.add_argument("paths", nargs="+", help="image files, archives, directories")
+    parser.add_argument("--output", help="NDJSON file to append results to")
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args()
+
+    registry.preload(MODEL_PATHS)
+    previous = _previous_results(args.output)
+    output = open(args.output, "a") if args.output else sys.stdout
+
+    entries = (entry for path in args.paths for entry in iter_path(path))
+    processed = errors = 0
+    try:
+        for result in screen_entries(
+            entries, batch_size=args.batch_size, previous=previous.get
+        ):
+            if result.get("resumed"):
+                continue
+            processed += 1
+            errors += not result["success"]
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(
+        f"Screened {processed} images ({errors} errors, {len(previous)} already done)",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+import heapq
+import threading
+import time
+
+DEFAULT_ROUNDS = [
+    {"k": 3, "radius_km": 5, "timeout_s": 20},
+    {"k": 5, "radius_km": 15, "timeout_s": 30},
+    {"k": 10, "radius_km": None, "timeout_s": 60},
+]
+
+
+class DispatchEngine:
+    """Broadcast emergency requests to several drivers, escalating until one accepts.
+
+    Each request goes through dispatch rounds. A round alerts the k nearest
+    available drivers within radius_km that haven't been alerted for the
+    request yet, all at once. Whoever accepts first wins the request (the
+    request store's pending -> accepted transition is atomic), and every
+    other alerted driver gets an alert_withdrawn event.
+
+    If nobody accepts within the round's timeout_s, or every alerted driver
+    declines, the next round widens the radius and k. Drivers alerted in
+    earlier rounds may still accept. When the last round runs out the
+    patient is told no driver is available and the request stays pending,
+    handed to queue (a QueueMatcher) if given, to be assigned as soon as a
+    driver frees up.
+
+    With an eta engine, each round takes eta_pool times k of the nearest
+    drivers by straight line and alerts the k with the shortest driving time,
+    so a driver across a river doesn't beat one down the road.
+
+    Every round that alerts drivers is recorded in event_log (an EventLog),
+    if given.
+
+    The alerted/declined drivers and the current round are kept on the
+    request record; the escalation timers are checked by run() every tick_ms.
+    """
+
+    def __init__(
+        self,
+        requests,
+        drivers,
+        patients,
+        driver_index,
+        emit,
+        rounds=None,
+        tick_ms=500,
+        queue=None,
+        eta=None,
+        eta_pool=3,
+        event_log=None,
+    ):
+        self.requests = requests
+        self.drivers = drivers
+        self.patients = patients
+        self.driver_index = driver_index
+        self.emit = emit
+        self.rounds = rounds or DEFAULT_ROUNDS
+        self.tick = tick_ms / 1000.0
+        self.queue = queue
+        self.eta = eta
+        self.eta_pool = eta_pool
+        self.event_log = event_log
+        self._timers = []  # heap of (deadline, request_id, round)
+        self._lock = threading.Lock()
+
+    def dispatch(self, request_id):
+        """Start dispatching a new request; returns the number of drivers alerted"""
+        self.requests.update(request_id, alerted=[], declined=[], dispatch_round=-1)
+        # The caller tells the patient when nobody could be alerted at all
+        return self._escalate(request_id, -1, notify=False)
+
+    def accepted(self, request_id, driver_id):
+        """Withdraw the alerts of everyone else once driver_id has won the request"""
+        request_data = self.requests.get(request_id)
+        if request_data is None:
+            return
+        declined = set(request_data.get("declined", []))
+        for other_id in request_data.get("alerted", []):
+            if other_id == driver_id or other_id in declined:
+                continue
+            other = self.drivers.get(other_id)
+            if other is not None:
+                self.emit(
+                    "alert_withdrawn",
+                    {"request_id": request_id, "reason": "accepted_by_another_driver"},
+                    room=other["sid"],
+                )
+
+    def declined(self, request_id, driver_id):
+        """Record a decline; escalate at once if every alerted driver declined"""
+        with self._lock:
+            request_data = self.requests.get(request_id)
+            if request_data is None or request_data["status"] != "pending":
+                return
+            declined = request_data.get("declined", [])
+            if driver_id not in declined:
+                declined = declined + [driver_id]
+            request_data = self.requests.update(request_id, declined=declined)
+
+        if set(request_data.get("alerted", [])) <= set(declined):
+            self._escalate(request_id, request_data.get("dispatch_round", -1))
+
+    def run(self, sleep):
+        """Escalation timer loop; sleep is the server's cooperative sleep function"""
+        while True:
+            sleep(self.tick)
+            self.check_timeouts()
+
+    def check_timeouts(self, now=None):
+        """Escalate every request whose current round timed out"""
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self._lock:
+            while self._timers and self._timers[0][0] <= now:
+                expired.append(heapq.heappop(self._timers))
+
+        for _, request_id, round_index in expired:
+            self._escalate(request_id, round_index)
+
+    def _escalate(self, request_id, from_round, notify=True):
+        """Run the next round after from_round that finds anyone to alert.
+
+        Returns the number of drivers alerted. Does nothing if the request
+        was accepted or moved past from_round since the caller looked: the
+        timers of accepted requests and superseded rounds are stale, and a
+        decline may race a timeout into escalating the same round.
+        """
+        with self._lock:
+            request_data = self.requests.get(request_id)
+            if not self._at_round(request_data, from_round):
+                return 0
+            location = request_data["location"]
+            alerted = list(request_data.get("alerted", []))
+
+        # Driving times are computed without the lock, so a slow ETA search
+        # never holds up accepts, declines or other requests' rounds
+        round_index = from_round
+        candidates = []
+        while not candidates and round_index + 1 < len(self.rounds):
+            round_index += 1
+            round_config = self.rounds[round_index]
+            with self._lock:
+                nearby = self._nearby(location, round_config, alerted)
+            candidates = self._rank(location, round_config["k"], nearby)
+
+        with self._lock:
+            # Accepted or escalated by someone else in the meantime
+            request_data = self.requests.get(request_id)
+            if not self._at_round(request_data, from_round):
+                return 0
+            if candidates:
+                request_data = self.requests.update(
+                    request_id,
+                    alerted=alerted + [driver_id for driver_id, _, _, _ in candidates],
+                    dispatch_round=round_index,
+                )
+                timeout = self.rounds[round_index]["timeout_s"]
+                heapq.heappush(
+                    self._timers,
+                    (time.monotonic() + timeout, request_id, round_index),
+                )
+            elif round_index != from_round:
+                # Rounds exhausted; later timeouts of earlier rounds are stale
+                self.requests.update(request_id, dispatch_round=round_index)
+
+        if not candidates:
+            if self.queue is not None:
+                self.queue.enqueue(request_id)
+            if notify:
+                self._notify_no_drivers(request_id)
+            return 0
+
+        if self.event_log is not None:
+            self.event_log.append(
+                "alerted",
+                request_id,
+                drivers=[driver_id for driver_id, _, _, _ in candidates],
+                round=round_index,
+            )
+        for driver_id, driver_data, distance, eta_seconds in candidates:
+            self.emit(
+                "emergency_alert",
+                {
+                    "request_id": request_id,
+                    "patient_location": request_data["location"],
+                    "emergency_type": request_data["emergency_type"],
+                    "distance": distance,
+                    "eta_seconds": eta_seconds,
+                    "expires_in": timeout,
+                },
+                room=driver_data["sid"],
+            )
+        return len(candidates)
+
+    def _at_round(self, request_data, round_index):
+        return (
+            request_data is not None
+            and request_data["status"] == "pending"
+            and request_data.get("dispatch_round", -1) == round_index
+        )
+
+    def _nearby(self, location, round_config, exclude):
+        """[(driver_id, driver_data, distance)] of available drivers to rank"""
+        k = round_config["k"]
+        nearest = self.driver_index.nearest(
+            location,
+            k=k * self.eta_pool if self.eta is not None else k,
+            exclude=set(exclude),
+            max_radius_km=round_config.get("radius_km"),
+        )
+        records = self.drivers.get_many([driver_id for driver_id, _ in nearest])
+        return [
+            (driver_id, driver_data, distance)
+            for (driver_id, distance), driver_data in zip(nearest, records)
+            if driver_data is not None and driver_data["status"] == "available"
+        ]
+
+    def _rank(self, location, k, nearby):
+        """[(driver_id, driver_data, distance, eta_seconds)] of the k to alert"""
+        if self.eta is None:
+            return [candidate + (None,) for candidate in nearby]
+
+        etas = self.eta.seconds_many(
+            [driver_data["location"] for _, driver_data, _ in nearby], location
+        )
+        ranked = [
+            candidate + (eta_seconds,)
+            for candidate, eta_seconds in zip(nearby, etas)
+            if eta_seconds is not None
+        ]
+        ranked.sort(key=lambda candidate: candidate[3])
+        return ranked[:k]
+
+    def _notify_no_drivers(self, request_id):
+        request_data = self.requests.get(request_id)
+        if request_data is None or request_data["status"] != "pending":
+            return
+        patient_data = self.patients.get(request_data["patient_id"])
+        if patient_data is None:
+            return
+        if self.queue is None:
+            payload = {
+                "message": "No drivers available at the moment, please try again"
+            }
+        else:
+            payload = {
+                "message": "No drivers available at the moment, you are in queue",
+                "queue_position": self.queue.position(request_id),
+            }
+        self.emit("no_drivers_available", payload, room=patient_data["sid"])
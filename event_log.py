@@ -0,0 +1,292 @@
+"""Write-ahead log of emergency request state transitions.
+
+Handlers append events (created, alerted, accepted, declined, location,
+arrived) to an in-memory buffer and return at once; a background writer
+appends everything buffered to the current segment file every
+flush_interval_ms with a single fsync, so the disk is never on the path of
+accept_request. A crash loses at most the last flush interval of events.
+
+Each event is one line, "<crc32> <json>", so a write torn by a crash is
+detected and the log is replayed up to it. The writer folds every event it
+writes into a copy of the live requests; when a segment reaches
+segment_bytes that copy is written out as a snapshot, a new segment is
+started and older segments are deleted (keeping keep_segments of them as a
+short audit trail). Recovery loads the newest snapshot and replays at most
+the segments written after it, so startup stays fast however long the
+server has been running.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+try:
+    import fcntl
+except ImportError:  # Windows: no advisory locks, one server per directory is on you
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class EventLogLocked(Exception):
+    """Raised when another process already writes the event log directory"""
+
+
+def encode_event(event):
+    payload = json.dumps(event, separators=(",", ":")).encode()
+    return b"%08x %s\n" % (zlib.crc32(payload), payload)
+
+
+def decode_event(line):
+    """The event on a log line, or None if the line is torn or corrupt"""
+    if not line.endswith(b"\n"):
+        return None
+    checksum, _, payload = line.rstrip(b"\n").partition(b" ")
+    try:
+        if int(checksum, 16) != zlib.crc32(payload):
+            return None
+        return json.loads(payload)
+    except ValueError:
+        return None
+
+
+def apply_event(requests, event):
+    """Fold one event into {request_id: record} of live requests"""
+    request_id = event["id"]
+    if event["type"] == "created":
+        requests[request_id] = dict(event["data"], created_lsn=event["lsn"])
+        return
+    record = requests.get(request_id)
+    if record is None:
+        return
+
+    if event["type"] == "alerted":
+        record["alerted"] = record.get("alerted", []) + event["drivers"]
+        record["dispatch_round"] = event["round"]
+    elif event["type"] == "declined":
+        record["declined"] = record.get("declined", []) + [event["driver_id"]]
+    elif event["type"] == "accepted":
+        record.update(status="accepted", driver_id=event["driver_id"])
+    elif event["type"] == "location":
+        field = "location" if event["role"] == "patient" else "driver_location"
+        record[field] = event["location"]
+    elif event["type"] == "arrived":
+        del requests[request_id]
+
+
+class EventLog:
+    def __init__(
+        self,
+        directory,
+        flush_interval_ms=50,
+        segment_bytes=4 * 2**20,
+        keep_segments=2,
+    ):
+        self.directory = directory
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.segment_bytes = segment_bytes
+        self.keep_segments = keep_segments
+        self.written = 0
+        self.last_flush_ms = 0.0
+        self._pending = []
+        self._lsn = 0
+        self._written_lsn = 0
+        self._lock = threading.Lock()  # guards _pending and _lsn
+        self._write_lock = threading.Lock()  # one writer for files and _requests
+        self._requests = {}
+        self._file = None
+        self._segment_size = 0
+        self._lock_file = None
+
+    def recover(self):
+        """Rebuild the live requests from disk and start a fresh segment.
+
+        Returns {request_id: record}; each record has the fields it was
+        created with, the latest state the log knows of and created_lsn.
+        Must be called once, before any append(). Raises EventLogLocked if
+        another process has the directory: two writers would each snapshot
+        and compact the other's segments away.
+        """
+        started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_directory()
+        requests, lsn = self._load_snapshot()
+        replayed = 0
+        segments = self._files("events-", ".log")
+        for path, next_path in zip(segments, segments[1:] + [None]):
+            # Segments kept for audit only hold events the snapshot covers
+            if next_path is not None and self._first_lsn(next_path) <= lsn + 1:
+                continue
+            with open(path, "rb") as f:
+                for line in f:
+                    event = decode_event(line)
+                    if event is None:
+                        logger.warning("Event log %s ends in a torn record", path)
+                        break
+                    if event["lsn"] <= lsn:
+                        continue
+                    apply_event(requests, event)
+                    lsn = event["lsn"]
+                    replayed += 1
+
+        with self._write_lock:
+            self._requests = requests
+            self._lsn = self._written_lsn = lsn
+            # Start over from a snapshot, leaving any torn tail behind
+            self._rotate()
+        logger.info(
+            "Recovered %d live requests (%d events replayed) in %.1f ms",
+            len(requests),
+            replayed,
+            (time.perf_counter() - started) * 1000,
+        )
+        return {request_id: dict(record) for request_id, record in requests.items()}
+
+    def append(self, event_type, request_id, **fields):
+        """Buffer an event; it is on disk after the next flush"""
+        with self._lock:
+            self._lsn += 1
+            self._pending.append(
+                dict(
+                    fields,
+                    lsn=self._lsn,
+                    type=event_type,
+                    id=request_id,
+                    at=time.time(),
+                )
+            )
+
+    def run(self, sleep):
+        """Writer loop; sleep is the server's cooperative sleep function"""
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error("Event log flush failed: %s", e)
+
+    def flush(self):
+        """Write and fsync everything buffered; returns the number of events"""
+        with self._write_lock:
+            with self._lock:
+                events, self._pending = self._pending, []
+            if not events or self._file is None:
+                return 0
+
+            started = time.perf_counter()
+            data = b"".join(encode_event(event) for event in events)
+            self._file.write(data)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._segment_size += len(data)
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+            for event in events:
+                apply_event(self._requests, event)
+            self._written_lsn = events[-1]["lsn"]
+            self.written += len(events)
+            if self._segment_size >= self.segment_bytes:
+                self._rotate()
+            return len(events)
+
+    def close(self):
+        """Flush what is buffered and close the segment"""
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
+
+    def stats(self):
+        return {
+            "live_requests": len(self._requests),
+            "events_written": self.written,
+            "pending_events": len(self._pending),
+            "segment_bytes": self._segment_size,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+        }
+
+    def _rotate(self):
+        """Snapshot the live requests, start a new segment and compact old files.
+
+        Called with _write_lock held. The snapshot covers every event
+        written so far, so older segments are only kept as an audit trail.
+        """
+        written_lsn = self._written_lsn
+        snapshot_path = self._path("snapshot-", written_lsn, ".json")
+        temporary = snapshot_path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(json.dumps({"lsn": written_lsn, "requests": self._requests}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, snapshot_path)
+
+        if self._file is not None:
+            self._file.close()
+        # A segment already named so holds no intact events (recovery stopped
+        # before any), at most a torn record
+        segment_path = self._path("events-", written_lsn + 1, ".log")
+        self._file = open(segment_path, "wb")
+        self._segment_size = 0
+        self._sync_directory()
+
+        for path in self._files("snapshot-", ".json")[:-1]:
+            os.remove(path)
+        old_segments = [
+            path for path in self._files("events-", ".log") if path != segment_path
+        ]
+        for path in old_segments[: max(len(old_segments) - self.keep_segments, 0)]:
+            os.remove(path)
+
+    def _lock_directory(self):
+        """Hold an exclusive lock on the directory until close()"""
+        if fcntl is None:
+            return
+        lock_file = open(os.path.join(self.directory, "LOCK"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise EventLogLocked(
+                f"Event log {self.directory} is in use by another process"
+            )
+        self._lock_file = lock_file
+
+    def _load_snapshot(self):
+        """({request_id: record}, lsn) of the newest readable snapshot"""
+        for path in reversed(self._files("snapshot-", ".json")):
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+                return snapshot["requests"], snapshot["lsn"]
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Skipping unreadable snapshot %s: %s", path, e)
+        return {}, 0
+
+    def _path(self, prefix, lsn, suffix):
+        return os.path.join(self.directory, f"{prefix}{lsn:012d}{suffix}")
+
+    def _first_lsn(self, path):
+        return int(os.path.basename(path).split("-")[1].split(".")[0])
+
+    def _files(self, prefix, suffix):
+        """Paths of the log's files of one kind, oldest first"""
+        return sorted(
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.startswith(prefix) and name.endswith(suffix)
+        )
+
+    def _sync_directory(self):
+        """Make the creation and renaming of files in the directory durable"""
+        descriptor = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
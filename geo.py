@@ -0,0 +1,112 @@
+"""Vectorized distance computations for dispatch.
+
+Two formulas are provided, both operating on NumPy arrays (or scalars) with
+broadcasting:
+
+- haversine_km: great-circle distance on a sphere of mean Earth radius. Within
+  0.57% of the WGS-84 geodesic (geopy's geodesic) for any pair of points; used
+  as a cheap prefilter.
+- lambert_km: Lambert's formula on the WGS-84 ellipsoid. Within 1.5e-6
+  relative error of the geodesic (about 1 mm per km) for pairs under
+  10,000 km apart, which covers everything a city dispatch sees. The error
+  grows for nearly antipodal pairs, up to about 3.3e-4.
+"""
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+WGS84_A_KM = 6378.137
+WGS84_F = 1 / 298.257223563
+
+# Worst-case relative error of haversine_km against the WGS-84 geodesic. A
+# candidate whose haversine distance exceeds another's by more than
+# HAVERSINE_SLACK can't be geodesically closer.
+HAVERSINE_TOLERANCE = 0.0057
+HAVERSINE_SLACK = (1 + HAVERSINE_TOLERANCE) / (1 - HAVERSINE_TOLERANCE)
+
+
+def parse_location(location):
+    """Return (lat, lng) floats for a {"lat", "lng"} dict, or None if invalid"""
+    try:
+        lat = float(location["lat"])
+        lng = float(location["lng"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+def location_arrays(locations):
+    """Split {"lat", "lng"} dicts into lat/lng arrays plus a validity mask.
+
+    Invalid locations get NaN coordinates, so their distances come out NaN.
+    """
+    lats = np.full(len(locations), np.nan)
+    lngs = np.full(len(locations), np.nan)
+    for i, location in enumerate(locations):
+        point = parse_location(location)
+        if point is not None:
+            lats[i], lngs[i] = point
+    return lats, lngs, ~np.isnan(lats)
+
+
+def _central_angle(phi1, phi2, delta_lng):
+    h = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lng / 2) ** 2
+    )
+    return 2 * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Spherical great-circle distance in kilometers"""
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    delta_lng = np.radians(np.subtract(lng2, lng1))
+    return EARTH_RADIUS_KM * _central_angle(phi1, phi2, delta_lng)
+
+
+def lambert_km(lat1, lng1, lat2, lng2):
+    """Ellipsoidal (WGS-84) distance in kilometers via Lambert's formula"""
+    # Reduced latitudes
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sigma = _central_angle(beta1, beta2, np.radians(np.subtract(lng2, lng1)))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2
+        x = x / np.cos(sigma / 2) ** 2
+        y = (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2
+        y = y / np.sin(sigma / 2) ** 2
+        distance = WGS84_A_KM * (sigma - WGS84_F / 2 * (x + y))
+    return np.where(sigma == 0, 0.0, distance)
+
+
+def distances_km(origin, lats, lngs, formula=lambert_km):
+    """Distances from one {"lat", "lng"} origin to arrays of coordinates.
+
+    Returns an array of NaN when the origin is not a valid location.
+    """
+    point = parse_location(origin)
+    if point is None:
+        return np.full(np.shape(lats), np.nan)
+    return formula(point[0], point[1], np.asarray(lats), np.asarray(lngs))
+
+
+def pairwise_km(lats1, lngs1, lats2, lngs2, formula=lambert_km):
+    """len(lats1) x len(lats2) matrix of distances between two point sets"""
+    lats1 = np.asarray(lats1)[:, np.newaxis]
+    lngs1 = np.asarray(lngs1)[:, np.newaxis]
+    return formula(lats1, lngs1, np.asarray(lats2), np.asarray(lngs2))
+
+
+def distance_km(loc1, loc2):
+    """Distance between two {"lat", "lng"} dicts, or None if either is invalid"""
+    point1 = parse_location(loc1)
+    point2 = parse_location(loc2)
+    if point1 is None or point2 is None:
+        return None
+    return float(lambert_km(point1[0], point1[1], point2[0], point2[1]))
@@ -0,0 +1,130 @@
+"""Upload ingest: validate images from their header before touching the body.
+
+The format is sniffed from magic bytes and the dimensions are parsed from the
+PNG IHDR chunk or the JPEG SOF segment, so uploads that aren't PNG/JPEG or
+are too large to decode are rejected after reading a few kilobytes, without
+decoding anything and without reading a spooled upload into memory.
+"""
+
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+HEADER_CHUNK = 64 * 1024
+# JPEG metadata (EXIF, ICC profiles, thumbnails) may push the SOF segment
+# past the first chunk; give up looking after this many bytes
+MAX_HEADER_BYTES = 1024 * 1024
+
+# Start-of-frame markers carrying the dimensions (SOF0-SOF15 minus DHT,
+# JPG and DAC, which share the range)
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = set(range(0xD0, 0xDA)) | {0x01}
+
+
+class IngestError(Exception):
+    """An upload rejected before decoding; status is the HTTP status to return"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class ImageHeader:
+    """Format and dimensions read from an image header"""
+
+    def __init__(self, format, width, height):
+        self.format = format
+        self.width = width
+        self.height = height
+
+    @property
+    def pixels(self):
+        return self.width * self.height
+
+
+def sniff_image(data):
+    """Parse the format and size from the start of an encoded image.
+
+    Returns an ImageHeader, None if data is too short to tell, and raises
+    IngestError for anything that is not a well-formed PNG or JPEG header.
+    """
+    if data.startswith(PNG_SIGNATURE):
+        return _png_header(data)
+    if data.startswith(JPEG_SIGNATURE):
+        return _jpeg_header(data)
+    if len(data) < len(PNG_SIGNATURE):
+        return None
+    raise IngestError("Unsupported image format. Please upload JPG or PNG", 415)
+
+
+def _png_header(data):
+    # Signature, then IHDR: length, type, width, height
+    if len(data) < 24:
+        return None
+    if data[12:16] != b"IHDR":
+        raise IngestError("Corrupt PNG image")
+    width, height = struct.unpack(">II", data[16:24])
+    return ImageHeader("PNG", width, height)
+
+
+def _jpeg_header(data):
+    position = 2
+    while True:
+        # Skip fill bytes between segments
+        while position < len(data) and data[position] == 0xFF:
+            position += 1
+        if position >= len(data):
+            return None
+        marker = data[position]
+        position += 1
+
+        if marker in _JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):  # End of image / start of scan before any SOF
+            raise IngestError("Corrupt JPEG image")
+        if position + 2 > len(data):
+            return None
+        (length,) = struct.unpack(">H", data[position : position + 2])
+        if length < 2:
+            raise IngestError("Corrupt JPEG image")
+
+        if marker in _JPEG_SOF_MARKERS:
+            if position + 7 > len(data):
+                return None
+            height, width = struct.unpack(">HH", data[position + 3 : position + 7])
+            return ImageHeader("JPEG", width, height)
+        position += length
+
+
+def read_image(stream, max_side=10000, max_pixels=40_000_000):
+    """Read an uploaded image from stream after validating its header.
+
+    Returns (data, header). Raises IngestError for unsupported formats,
+    corrupt headers and images over max_side or max_pixels.
+    """
+    head = stream.read(HEADER_CHUNK)
+    header = sniff_image(head)
+    while header is None:
+        chunk = stream.read(HEADER_CHUNK)
+        if not chunk or len(head) >= MAX_HEADER_BYTES:
+            raise IngestError("Truncated or unreadable image")
+        head += chunk
+        header = sniff_image(head)
+
+    if header.width == 0 or header.height == 0:
+        raise IngestError("Corrupt image: zero width or height")
+    if max(header.width, header.height) > max_side or header.pixels > max_pixels:
+        raise IngestError(
+            f"Image is too large ({header.width}x{header.height}); "
+            f"the maximum is {max_side}px per side",
+            413,
+        )
+
+    # Re-read from the start in one piece rather than concatenating chunks
+    if getattr(stream, "seekable", lambda: False)():
+        stream.seek(0)
+        return stream.read(), header
+    return head + stream.read(), header
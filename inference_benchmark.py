@@ -0,0 +1,202 @@
+"""Benchmark of the classification path behind /chest, /image and /iscovid.
+
+Each bundled model classifies synthetic X-rays of several sizes (and sample
+films from --images), encoded as JPEG and/or PNG, at every combination of
+batch size and torch thread count. Every batch is timed stage by stage,
+exactly as the endpoints run it:
+
+- decode: Image.open + load (with the JPEG draft the endpoints use)
+- preprocess: resize, crop and tensor conversion
+- forward: the model's forward pass (eager or exported runtime)
+- postprocess: building the prediction dicts from the class probabilities
+
+The report holds per-stage latency percentiles (ms per batch), images/sec
+and peak RSS for every configuration; --compare fails the run when any of
+them regressed against a saved baseline.
+
+Usage:
+    python inference_benchmark.py --output baseline.json
+    python inference_benchmark.py --sizes 512,2048 --batch-sizes 1,8 --threads 1,4
+    python inference_benchmark.py --compare baseline.json --tolerance 0.15
+"""
+
+import argparse
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+from log_config import configure_logging
+from model_registry import Classification, PreparedImage, registry
+from model_runtime import BACKENDS, synthetic_xray
+from perf_report import (
+    ResourceSampler,
+    compare,
+    load_report,
+    percentiles,
+    print_comparison,
+    write_report,
+)
+from screening import MODEL_PATHS, build_prediction
+
+STAGES = ("decode", "preprocess", "forward", "postprocess")
+
+
+def encode(image, image_format):
+    buffer = io.BytesIO()
+    if image_format == "jpeg":
+        image.save(buffer, "JPEG", quality=90)
+    else:
+        image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def synthetic_sources(sizes, formats, count=4, seed=0):
+    """{"synthetic-<side>-<format>": [encoded images]} of X-ray-like films"""
+    rng = np.random.RandomState(seed)
+    sources = {}
+    for side in sizes:
+        # Films are a little taller than wide
+        images = [synthetic_xray(side, int(side * 1.2), rng) for _ in range(count)]
+        for image_format in formats:
+            sources[f"synthetic-{side}-{image_format}"] = [
+                encode(image, image_format) for image in images
+            ]
+    return sources
+
+
+def sample_sources(image_dir):
+    """{"sample": [file bytes]} for the images in image_dir"""
+    images = []
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith((".png", ".jpg", ".jpeg")):
+            with open(os.path.join(image_dir, name), "rb") as f:
+                images.append(f.read())
+    return {"sample": images} if images else {}
+
+
+def run_config(model_path, images, batch_size, repeats, warmup=2):
+    """Time every stage of classifying batches of images; returns the metrics.
+
+    rss_mb is the peak resident memory sampled while this config ran; the
+    process-wide peak (ru_maxrss) would only ever report the largest config
+    run so far.
+    """
+    model = registry.get(model_path)
+    sampler = ResourceSampler(interval=0.05).start()
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    for iteration in range(warmup + repeats):
+        batch = [
+            images[(iteration * batch_size + i) % len(images)]
+            for i in range(batch_size)
+        ]
+        started = time.perf_counter()
+        prepared = [PreparedImage(data, draft_size=model.imgsz) for data in batch]
+        for image in prepared:
+            image.image
+        decoded = time.perf_counter()
+        tensor = torch.cat([image.tensor(model.imgsz) for image in prepared])
+        preprocessed = time.perf_counter()
+        probs = model.forward(tensor)
+        forwarded = time.perf_counter()
+        for row in probs:
+            build_prediction(Classification.from_model(model, row))
+        finished = time.perf_counter()
+
+        if iteration < warmup:
+            continue
+        timings["decode"].append(decoded - started)
+        timings["preprocess"].append(preprocessed - decoded)
+        timings["forward"].append(forwarded - preprocessed)
+        timings["postprocess"].append(finished - forwarded)
+        totals.append(finished - started)
+
+    metrics = {f"{stage}_ms": percentiles(timings[stage], 1000) for stage in STAGES}
+    metrics["total_ms"] = percentiles(totals, 1000)
+    metrics["images_per_s"] = round(batch_size * len(totals) / sum(totals), 2)
+    sampler.stop()
+    metrics["rss_mb"] = sampler.summary()["rss_mb_peak"]
+    return metrics
+
+
+def main():
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Benchmark model inference stages")
+    parser.add_argument("--models", nargs="+", help="default: the screening models")
+    parser.add_argument("--images", help="directory of sample X-rays to include")
+    parser.add_argument("--sizes", default="512,1024,2048", help="synthetic sides")
+    parser.add_argument("--formats", default="jpeg,png")
+    parser.add_argument("--batch-sizes", default="1,8")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()))
+    parser.add_argument("--repeats", type=int, default=20, help="batches per config")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager")
+    parser.add_argument("--quantize", action="store_true", help="INT8 dynamic")
+    parser.add_argument("--output", default="inference_benchmark.json")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    model_paths = args.models or MODEL_PATHS
+    sizes = [int(size) for size in args.sizes.split(",")]
+    batch_sizes = [int(size) for size in args.batch_sizes.split(",")]
+    thread_counts = [int(count) for count in args.threads.split(",")]
+
+    registry.configure_backend(args.backend, quantize=args.quantize)
+    registry.preload(model_paths)
+    sources = synthetic_sources(sizes, args.formats.split(","))
+    if args.images:
+        sources.update(sample_sources(args.images))
+
+    sampler = ResourceSampler().start()
+    results = {}
+    for model_path in model_paths:
+        model_name = os.path.splitext(os.path.basename(model_path))[0]
+        for threads in thread_counts:
+            torch.set_num_threads(threads)
+            for source, images in sources.items():
+                for batch_size in batch_sizes:
+                    name = f"{model_name}/{source}/b{batch_size}/t{threads}"
+                    results[name] = run_config(
+                        model_path, images, batch_size, args.repeats
+                    )
+                    stages = "  ".join(
+                        f"{stage} {results[name][f'{stage}_ms']['p50']:.2f}"
+                        for stage in STAGES
+                    )
+                    print(
+                        f"{name:<40} {results[name]['images_per_s']:>8.1f} img/s  "
+                        f"p50 ms: {stages}"
+                    )
+    sampler.stop()
+
+    metrics = {"configs": results, "process": sampler.summary()}
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("output", "compare", "tolerance")
+    }
+    config["models"] = model_paths
+    config["torch"] = torch.__version__
+    report = write_report(args.output, "inference_benchmark", config, metrics)
+    print(f"Report in {args.output}")
+
+    if args.compare:
+        rows = compare(
+            load_report(args.compare),
+            report,
+            args.tolerance,
+            higher_is_better=("images_per_s",),
+            ignore=("process.cpu_percent",),
+        )
+        regressions = print_comparison(rows)
+        if regressions:
+            print(f"{regressions} metrics regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+
+class InferenceBusy(Exception):
+    """Raised when the inference queue is full; callers should retry later"""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """Bounded worker pool that keeps model calls off the request/event loop.
+
+    At most workers jobs run at once and at most max_queue more may wait;
+    beyond that submit() fails fast with InferenceBusy instead of letting
+    requests pile up behind slow inference.
+
+    mode="thread" runs jobs on dedicated threads of this process (the heavy
+    parts of decoding and the forward pass release the GIL), sharing the
+    resident models and micro-batchers; these must be OS threads, so a server
+    monkey-patched by eventlet or gevent should use process mode instead, or
+    its green threads would run inference on the event loop. mode="process"
+    runs them in spawned worker processes that load their own copy of the
+    models, isolating inference CPU completely from the dispatch server; job
+    functions and arguments must then be picklable.
+    """
+
+    def __init__(
+        self,
+        workers=8,
+        max_queue=32,
+        mode="thread",
+        retry_after=1,
+        initializer=None,
+        initargs=(),
+        wait=None,
+    ):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.rejected = 0
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._depth = 0
+        self._depth_lock = threading.Lock()
+        self._wait = wait or (lambda future: future.result())
+
+        self.mode = mode
+        self._initializer = initializer
+        self._initargs = initargs
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+        if mode == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="inference"
+            )
+            if initializer is not None:
+                initializer(*initargs)
+        elif mode != "process":
+            raise ValueError(f"Unknown inference pool mode: {mode}")
+
+    def _process_executor(self):
+        """Start worker processes on first use.
+
+        Spawned children re-import the main module, so starting them while
+        that module is still being imported would recurse.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=self._initializer,
+                    initargs=self._initargs,
+                )
+                # Start every worker (and load its models) now, not one per request
+                for _ in range(self.workers):
+                    self._executor.submit(int)
+        return self._executor
+
+    @property
+    def depth(self):
+        """Jobs running or waiting"""
+        return self._depth
+
+    def submit(self, fn, *args):
+        """Queue fn(*args) and return its Future, or raise InferenceBusy"""
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise InferenceBusy(self.retry_after)
+
+        with self._depth_lock:
+            self._depth += 1
+        try:
+            executor = self._executor or self._process_executor()
+            future = executor.submit(fn, *args)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release())
+        return future
+
+    def run(self, fn, *args):
+        """Run fn(*args) on the pool and wait for its result"""
+        return self._wait(self.submit(fn, *args))
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _release(self):
+        with self._depth_lock:
+            self._depth -= 1
+        self._slots.release()
@@ -0,0 +1,479 @@
+"""Load test of the websocket dispatch flow with simulated patients and drivers.
+
+N drivers register, wander between random waypoints sending update_location,
+accept (or decline) the alerts they get, drive to the patient and report
+arrived. M patients raise emergency_request at a Poisson arrival rate and
+wait for driver_assigned. The run measures how long each event's handler
+takes, event throughput, time from request to assignment and to arrival, and
+CPU/memory of the server, and writes them to a JSON report that can be
+compared with one from another commit.
+
+By default the real app runs in-process (through SocketIO test clients,
+whose emits run the handlers synchronously); --url drives a running server
+over the network instead.
+
+Usage:
+    python loadtest.py --drivers 500 --patients 200 --rate 5 --output load.json
+    python loadtest.py --url http://localhost:8080 --server-pid 1234 ...
+    python loadtest.py ... --compare baseline.json
+"""
+
+import argparse
+import heapq
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+from perf_report import (
+    ResourceSampler,
+    compare,
+    load_report,
+    percentiles,
+    print_comparison,
+    write_report,
+)
+
+KM_PER_DEGREE = 111.32
+
+
+class InProcessConnection:
+    """A SocketIO test client of the app imported into this process"""
+
+    def __init__(self, server):
+        self.client = server.socketio.test_client(server.app)
+
+    def emit(self, event, data):
+        self.client.emit(event, data)
+
+    def received(self):
+        return [
+            (event["name"], event["args"][0] if event["args"] else None)
+            for event in self.client.get_received()
+        ]
+
+    def close(self):
+        self.client.disconnect()
+
+
+class RemoteConnection:
+    """A SocketIO client connected to a server at url"""
+
+    def __init__(self, url):
+        import socketio
+
+        self._events = []
+        self._lock = threading.Lock()
+        self.client = socketio.Client(reconnection=False)
+        self.client.on("*", self._record)
+        self.client.connect(url, wait_timeout=10)
+
+    def _record(self, event, *args):
+        with self._lock:
+            self._events.append((event, args[0] if args else None))
+
+    def emit(self, event, data):
+        self.client.emit(event, data)
+
+    def received(self):
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def close(self):
+        self.client.disconnect()
+
+
+def _random_point(center, radius_km, rng):
+    """Uniform random {"lat", "lng"} within radius_km of center"""
+    distance = radius_km * math.sqrt(rng.random())
+    bearing = rng.random() * 2 * math.pi
+    lat = center[0] + distance * math.cos(bearing) / KM_PER_DEGREE
+    lng = center[1] + distance * math.sin(bearing) / (
+        KM_PER_DEGREE * math.cos(math.radians(center[0]))
+    )
+    return {"lat": lat, "lng": lng}
+
+
+def _move(location, target, km):
+    """Move up to km towards target; returns (new location, reached)"""
+    scale = math.cos(math.radians(location["lat"]))
+    dlat = (target["lat"] - location["lat"]) * KM_PER_DEGREE
+    dlng = (target["lng"] - location["lng"]) * KM_PER_DEGREE * scale
+    distance = math.hypot(dlat, dlng)
+    if distance <= km:
+        return dict(target), True
+    fraction = km / distance
+    return {
+        "lat": location["lat"] + (target["lat"] - location["lat"]) * fraction,
+        "lng": location["lng"] + (target["lng"] - location["lng"]) * fraction,
+    }, False
+
+
+class SimulatedDriver:
+    def __init__(self, driver_id, connection, location, waypoint):
+        self.driver_id = driver_id
+        self.connection = connection
+        self.location = location
+        self.waypoint = waypoint
+        self.status = "available"  # available, accepting, en_route
+        self.request_id = None
+        self.accept_at = None
+        self.next_update = 0.0
+
+
+class SimulatedPatient:
+    def __init__(self, patient_id, connection, location, emergency_type):
+        self.patient_id = patient_id
+        self.connection = connection
+        self.location = location
+        self.emergency_type = emergency_type
+        self.requested_at = None
+        self.assigned_at = None
+
+
+class LoadTest:
+    """One load test run; see the module docstring"""
+
+    def __init__(
+        self,
+        connect,
+        drivers=100,
+        patients=50,
+        rate=2.0,
+        duration=60.0,
+        drain=15.0,
+        center=(40.7128, -74.0060),
+        radius_km=10.0,
+        speed_kmh=40.0,
+        time_scale=10.0,
+        update_interval=1.0,
+        accept_delay=0.5,
+        decline_rate=0.1,
+        seed=0,
+    ):
+        self.connect = connect
+        self.driver_count = drivers
+        self.patient_count = patients
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.center = center
+        self.radius_km = radius_km
+        self.speed_kmh = speed_kmh
+        self.time_scale = time_scale
+        self.update_interval = update_interval
+        self.accept_delay = accept_delay
+        self.decline_rate = decline_rate
+        self.rng = random.Random(seed)
+
+        self.sent = Counter()
+        self.received = Counter()
+        self.emit_seconds = defaultdict(list)
+        self.assignment_seconds = []
+        self.arrival_seconds = []
+        self.drivers = []
+        self.patients = {}
+        self.requested = 0
+
+    def emit(self, connection, event, data):
+        started = time.perf_counter()
+        connection.emit(event, data)
+        self.emit_seconds[event].append(time.perf_counter() - started)
+        self.sent[event] += 1
+
+    def run(self):
+        """Run the scenario; returns the metrics dict"""
+        started = time.perf_counter()
+        for _ in range(self.driver_count):
+            self._add_driver()
+        registration = time.perf_counter() - started
+
+        start = time.monotonic()
+        arrivals = self._arrival_times(start)
+        end = start + self.duration
+        while True:
+            now = time.monotonic()
+            while arrivals and arrivals[0] <= now:
+                heapq.heappop(arrivals)
+                self._add_patient(now)
+            for driver in self.drivers:
+                self._step_driver(driver, now)
+            for patient in list(self.patients.values()):
+                self._poll_patient(patient, now)
+            if now >= end and (not self.patients or now >= end + self.drain):
+                break
+            time.sleep(0.01)
+        elapsed = time.monotonic() - start
+
+        unassigned = sum(p.assigned_at is None for p in self.patients.values())
+        for connection in [d.connection for d in self.drivers] + [
+            p.connection for p in self.patients.values()
+        ]:
+            connection.close()
+
+        return {
+            "registration": {
+                "drivers_per_s": round(self.driver_count / registration, 1)
+            },
+            "events": {
+                "sent": dict(self.sent),
+                "received": dict(self.received),
+                "sent_per_s": round(sum(self.sent.values()) / elapsed, 1),
+                "received_per_s": round(sum(self.received.values()) / elapsed, 1),
+            },
+            "emit_ms": {
+                event: percentiles(samples, 1000)
+                for event, samples in sorted(self.emit_seconds.items())
+            },
+            "time_to_assignment_ms": percentiles(self.assignment_seconds, 1000),
+            "time_to_arrival_ms": percentiles(self.arrival_seconds, 1000),
+            "patients": {
+                "requested": self.requested,
+                "assigned": len(self.assignment_seconds),
+                "arrived": len(self.arrival_seconds),
+                "unassigned": unassigned,
+            },
+            "elapsed_s": round(elapsed, 1),
+        }
+
+    def _arrival_times(self, start):
+        """Poisson arrival times of all patients within the run"""
+        times = []
+        at = start
+        for _ in range(self.patient_count):
+            at += self.rng.expovariate(self.rate)
+            if at > start + self.duration:
+                break
+            times.append(at)
+        heapq.heapify(times)
+        return times
+
+    def _add_driver(self):
+        driver = SimulatedDriver(
+            f"load-driver-{uuid.uuid4().hex[:12]}",
+            self.connect(),
+            _random_point(self.center, self.radius_km, self.rng),
+            _random_point(self.center, self.radius_km, self.rng),
+        )
+        # Spread location updates evenly over the interval
+        driver.next_update = time.monotonic() + self.rng.random() * self.update_interval
+        self.emit(
+            driver.connection,
+            "register_driver",
+            {"driver_id": driver.driver_id, "location": driver.location},
+        )
+        self.drivers.append(driver)
+
+    def _add_patient(self, now):
+        patient = SimulatedPatient(
+            f"load-patient-{uuid.uuid4().hex[:12]}",
+            self.connect(),
+            _random_point(self.center, self.radius_km, self.rng),
+            self.rng.choice(["general", "cardiac", "trauma"]),
+        )
+        self.emit(
+            patient.connection,
+            "register_patient",
+            {"patient_id": patient.patient_id, "location": patient.location},
+        )
+        self.patients[patient.patient_id] = patient
+        self._poll_patient(patient, now)
+
+    def _poll_patient(self, patient, now):
+        for event, data in patient.connection.received():
+            self.received[event] += 1
+            if event == "patient_registered" and patient.requested_at is None:
+                # Over the network, requesting before the registration is
+                # processed would race it
+                patient.requested_at = time.monotonic()
+                self.emit(
+                    patient.connection,
+                    "emergency_request",
+                    {
+                        "patient_id": patient.patient_id,
+                        "location": patient.location,
+                        "emergency_type": patient.emergency_type,
+                    },
+                )
+                self.requested += 1
+            elif event == "driver_assigned" and patient.assigned_at is None:
+                patient.assigned_at = time.monotonic()
+                self.assignment_seconds.append(
+                    patient.assigned_at - patient.requested_at
+                )
+            elif event == "ambulance_arrived":
+                self.arrival_seconds.append(time.monotonic() - patient.requested_at)
+                patient.connection.close()
+                del self.patients[patient.patient_id]
+                return
+
+    def _step_driver(self, driver, now):
+        for event, data in driver.connection.received():
+            self.received[event] += 1
+            self._handle_driver_event(driver, event, data or {}, now)
+
+        if (
+            driver.status == "accepting"
+            and driver.accept_at is not None
+            and now >= driver.accept_at
+        ):
+            # Sent once; the driver stays "accepting" until the server answers,
+            # which over --url may take several ticks
+            driver.accept_at = None
+            self.emit(
+                driver.connection,
+                "accept_request",
+                {"driver_id": driver.driver_id, "request_id": driver.request_id},
+            )
+            for event, data in driver.connection.received():
+                self.received[event] += 1
+                self._handle_driver_event(driver, event, data or {}, now)
+
+        if now < driver.next_update:
+            return
+        elapsed = self.update_interval + (now - driver.next_update)
+        driver.next_update = now + self.update_interval
+        km = self.speed_kmh * self.time_scale * elapsed / 3600
+        driver.location, reached = _move(driver.location, driver.waypoint, km)
+        self.emit(
+            driver.connection,
+            "update_location",
+            {
+                "user_id": driver.driver_id,
+                "user_type": "driver",
+                "location": driver.location,
+            },
+        )
+        if not reached:
+            return
+        if driver.status == "en_route":
+            self.emit(driver.connection, "arrived", {"driver_id": driver.driver_id})
+            driver.status = "available"
+            driver.request_id = None
+        driver.waypoint = _random_point(self.center, self.radius_km, self.rng)
+
+    def _handle_driver_event(self, driver, event, data, now):
+        if event == "emergency_alert" and driver.status == "available":
+            if self.rng.random() < self.decline_rate:
+                self.emit(
+                    driver.connection,
+                    "decline_request",
+                    {"driver_id": driver.driver_id, "request_id": data["request_id"]},
+                )
+                return
+            driver.status = "accepting"
+            driver.request_id = data["request_id"]
+            driver.accept_at = now + self.accept_delay
+        elif event == "alert_withdrawn" and driver.request_id == data["request_id"]:
+            if driver.status == "accepting":
+                driver.status = "available"
+                driver.request_id = None
+        elif event in ("request_accepted", "request_assigned"):
+            driver.status = "en_route"
+            driver.request_id = data["request_id"]
+            driver.waypoint = data["patient_location"]
+        elif event == "error" and driver.status == "accepting":
+            # Lost the race for the request
+            driver.status = "available"
+            driver.request_id = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the dispatch websocket")
+    parser.add_argument("--url", help="server to test; default: the app in-process")
+    parser.add_argument("--server-pid", type=int, help="pid to sample with --url")
+    parser.add_argument("--drivers", type=int, default=100)
+    parser.add_argument("--patients", type=int, default=50)
+    parser.add_argument("--rate", type=float, default=2.0, help="patients per second")
+    parser.add_argument("--duration", type=float, default=60.0, help="seconds")
+    parser.add_argument("--drain", type=float, default=15.0, help="seconds after")
+    parser.add_argument("--center", default="40.7128,-74.0060", help="lat,lng")
+    parser.add_argument("--radius-km", type=float, default=10.0)
+    parser.add_argument("--speed-kmh", type=float, default=40.0)
+    parser.add_argument(
+        "--time-scale", type=float, default=10.0, help="simulated seconds per second"
+    )
+    parser.add_argument("--update-interval", type=float, default=1.0)
+    parser.add_argument("--accept-delay", type=float, default=0.5)
+    parser.add_argument("--decline-rate", type=float, default=0.1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest_report.json")
+    parser.add_argument("--compare", help="baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("output", "compare", "tolerance", "server_pid")
+    }
+    lat, lng = (float(part) for part in args.center.split(","))
+
+    if args.url:
+        connect = lambda: RemoteConnection(args.url)
+        sampler = ResourceSampler(args.server_pid) if args.server_pid else None
+    else:
+        import app as server
+
+        connect = lambda: InProcessConnection(server)
+        sampler = ResourceSampler()
+
+    test = LoadTest(
+        connect,
+        drivers=args.drivers,
+        patients=args.patients,
+        rate=args.rate,
+        duration=args.duration,
+        drain=args.drain,
+        center=(lat, lng),
+        radius_km=args.radius_km,
+        speed_kmh=args.speed_kmh,
+        time_scale=args.time_scale,
+        update_interval=args.update_interval,
+        accept_delay=args.accept_delay,
+        decline_rate=args.decline_rate,
+        seed=args.seed,
+    )
+    if sampler is not None:
+        sampler.start()
+    metrics = test.run()
+    if sampler is not None:
+        sampler.stop()
+        metrics["server"] = sampler.summary()
+
+    report = write_report(args.output, "loadtest", config, metrics)
+    patients = metrics["patients"]
+    assignment = metrics["time_to_assignment_ms"]
+    print(
+        f"{patients['requested']} requests, {patients['assigned']} assigned "
+        f"(p50 {assignment.get('p50')} ms, p95 {assignment.get('p95')} ms), "
+        f"{metrics['events']['sent_per_s']} events/s sent; report in {args.output}"
+    )
+
+    if args.compare:
+        rows = compare(
+            load_report(args.compare),
+            report,
+            args.tolerance,
+            higher_is_better=("per_s",),
+            ignore=(
+                "events.sent.",
+                "events.received.",
+                "patients.requested",
+                "patients.assigned",
+                "patients.arrived",
+                "elapsed_s",
+            ),
+        )
+        regressions = print_comparison(rows)
+        if regressions:
+            print(f"{regressions} metrics regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
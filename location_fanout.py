@@ -0,0 +1,97 @@
+import threading
+import time
+
+import numpy as np
+
+from geo import haversine_km, parse_location
+
+
+class LocationFanout:
+    """Coalesce location updates and forward them to tracking clients in ticks.
+
+    submit() only records the latest position for a (room, event) pair, so a
+    client flooding GPS ticks costs one dict write each. Every tick_ms the
+    scheduler takes all pairs with a pending position, drops the ones that
+    moved less than min_distance_m since the last forwarded position (one
+    vectorized distance pass for all pairs), holds back pairs forwarded less
+    than min_interval_ms ago, and emits the rest.
+    """
+
+    def __init__(
+        self, emit, min_distance_m=10, min_interval_ms=1000, tick_ms=200, idle_s=600
+    ):
+        self.emit = emit
+        self.min_distance_km = min_distance_m / 1000.0
+        self.min_interval = min_interval_ms / 1000.0
+        self.tick = tick_ms / 1000.0
+        self.idle = idle_s
+        self.emitted = 0
+        self.dropped = 0
+        self._pending = {}  # {(room, event): (payload_key, location)}
+        self._sent = {}  # {(room, event): (lat, lng, sent_at)}
+        self._next_eviction = 0
+        self._lock = threading.Lock()
+
+    def submit(self, room, event, payload_key, location):
+        """Queue location for room; replaces any position not yet forwarded"""
+        if parse_location(location) is None:
+            return
+        with self._lock:
+            self._pending[(room, event)] = (payload_key, location)
+
+    def run(self, sleep):
+        """Scheduler loop; sleep is the server's cooperative sleep function"""
+        while True:
+            sleep(self.tick)
+            self.flush()
+
+    def flush(self, now=None):
+        """Forward every due pending position; returns the number emitted"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            due = []
+            for key, pending in self._pending.items():
+                sent = self._sent.get(key)
+                if sent is None or now - sent[2] >= self.min_interval:
+                    due.append((key, pending, sent))
+            for key, _, _ in due:
+                del self._pending[key]
+
+            if not due:
+                self._evict_idle(now)
+                return 0
+
+            points = np.array([parse_location(pending[1]) for _, pending, _ in due])
+            previous = np.array(
+                [(sent[0], sent[1]) if sent else (np.nan, np.nan) for _, _, sent in due]
+            )
+            moved = haversine_km(
+                previous[:, 0], previous[:, 1], points[:, 0], points[:, 1]
+            )
+            # Pairs never forwarded before have NaN distance and always go out
+            forward = np.isnan(moved) | (moved >= self.min_distance_km)
+
+            outgoing = []
+            for (key, pending, _), point, send in zip(due, points, forward.tolist()):
+                if send:
+                    self._sent[key] = (point[0], point[1], now)
+                    outgoing.append((key, pending))
+            self.dropped += len(due) - len(outgoing)
+            self.emitted += len(outgoing)
+            self._evict_idle(now)
+
+        for (room, event), (payload_key, location) in outgoing:
+            self.emit(event, {payload_key: location}, room=room)
+        return len(outgoing)
+
+    def _evict_idle(self, now):
+        """Forget pairs that have been quiet for idle_s, at most once a minute"""
+        if now < self._next_eviction:
+            return
+        self._next_eviction = now + 60
+        for key in [
+            key
+            for key, sent in self._sent.items()
+            if now - sent[2] > self.idle and key not in self._pending
+        ]:
+            del self._sent[key]
@@ -0,0 +1,67 @@
+"""Leveled logging that never blocks the caller on stdout.
+
+Records go onto a bounded in-memory queue and a listener thread formats and
+writes them, so a slow terminal or log collector cannot stall socket
+handlers. When the queue is full, records are dropped (and counted) rather
+than waited for. Modules log through ``logging.getLogger(__name__)``.
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import sys
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def configure_logging(level="INFO", queue_size=10000, stream=None):
+    """Route the root logger through a background writer; returns its handler.
+
+    Safe to call more than once: the previous listener is flushed and
+    replaced.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(logging.Formatter(FORMAT))
+    handler = DroppingQueueHandler(queue.Queue(queue_size))
+    _listener = logging.handlers.QueueListener(handler.queue, output)
+    _listener.start()
+
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        if isinstance(previous, DroppingQueueHandler):
+            root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+
+def flush_logging():
+    """Write out queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(flush_logging)
@@ -0,0 +1,259 @@
+"""In-process metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are registered once at import time and
+updated from the hot paths (route handlers, socket events, inference), so
+updates only take a dict lookup and a short lock. Values owned by other
+components (table sizes, cache hit counts) are read through a collect
+callback when /metrics is scraped instead of being pushed on every change.
+
+    requests = registry.counter("things_total", "Things done", ["kind"])
+    requests.labels("big").inc()
+    with latency.labels("/image").time():
+        ...
+"""
+
+import bisect
+import math
+import threading
+import time
+
+# Seconds; covers sub-millisecond socket handlers up to slow inference
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class _Timer:
+    """Context manager observing its elapsed seconds into a histogram child"""
+
+    __slots__ = ("_child", "_started")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._child.observe(time.perf_counter() - self._started)
+
+
+class _CounterChild:
+    __slots__ = ("value", "_lock")
+
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "_lock")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class Metric:
+    """A named metric family; labels(*values) returns the series to update.
+
+    With collect, the values are read from collect() at scrape time instead:
+    a number for an unlabelled metric, or {label values tuple: number}.
+    """
+
+    kind = None
+    _child_class = None
+
+    def __init__(self, name, documentation, labelnames=(), collect=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        return self._child_class()
+
+    def samples(self):
+        """[(name suffix, label names, label values, value)] of every series"""
+        if self.collect is not None:
+            values = self.collect()
+            if not isinstance(values, dict):
+                values = {(): values}
+            return [
+                ("", self.labelnames, labels, value)
+                for labels, value in values.items()
+                if value is not None
+            ]
+        return [
+            ("", self.labelnames, labels, child.value)
+            for labels, child in list(self._children.items())
+        ]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for suffix, names, values, value in self.samples():
+            lines.append(
+                f"{self.name}{suffix}{_label_text(names, values)} {_format_value(value)}"
+            )
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+    _child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+    _child_class = _GaugeChild
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def samples(self):
+        samples = []
+        bucket_names = self.labelnames + ("le",)
+        for labels, child in list(self._children.items()):
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                samples.append(
+                    (
+                        "_bucket",
+                        bucket_names,
+                        labels + (_format_value(bound),),
+                        cumulative,
+                    )
+                )
+            samples.append(("_sum", self.labelnames, labels, total))
+            samples.append(("_count", self.labelnames, labels, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), collect=None):
+        return self._register(Counter(name, documentation, labelnames, collect))
+
+    def gauge(self, name, documentation, labelnames=(), collect=None):
+        return self._register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """Every metric in the text exposition format; a failing collect is skipped"""
+        blocks = []
+        for metric in list(self._metrics.values()):
+            try:
+                blocks.append(metric.render())
+            except Exception:
+                continue
+        return "\n".join(blocks) + "\n"
+
+
+registry = MetricsRegistry()
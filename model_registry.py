@@ -0,0 +1,359 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+from ultralytics import YOLO
+
+from batching import MicroBatcher
+from image_ingest import IngestError
+from model_runtime import BACKENDS, check_parity, load_runtime, parity_batch
+
+logger = logging.getLogger(__name__)
+
+
+class LoadedModel:
+    """A classification network resident in memory together with its metadata"""
+
+    def __init__(self, path, network, names, imgsz, mtime, weights_hash):
+        self.path = path
+        self.network = network
+        self.names = names
+        # Class names by index, the label table of every Classification
+        self.labels = tuple(names[index] for index in sorted(names))
+        self.imgsz = imgsz
+        self.mtime = mtime
+        self.weights_hash = weights_hash
+        self.backend = "eager"
+        self.runtime = None
+
+    @property
+    def identity(self):
+        """Path plus weights hash (and runtime), stable across restarts and reloads"""
+        identity = f"{self.path}@{self.weights_hash[:16]}"
+        if self.runtime is not None:
+            identity += f"+{self.backend}"
+        return identity
+
+    def forward(self, batch):
+        """Run a preprocessed NCHW float batch and return class probabilities"""
+        if self.runtime is not None:
+            return self.runtime(batch)
+        return self.eager_forward(batch)
+
+    def eager_forward(self, batch):
+        with torch.inference_mode():
+            output = self.network(batch)
+        # Classify heads return (probs, logits) outside of export mode
+        if isinstance(output, (tuple, list)):
+            output = output[0]
+        return output
+
+
+class ModelRegistry:
+    """Process-wide cache of classification models keyed by checkpoint path.
+
+    Each checkpoint is deserialized once and shared by every request thread.
+    Inference only reads the weights, so the lock guards loading and swapping,
+    not the forward pass. When a checkpoint's mtime changes on disk the model
+    is reloaded on the next lookup and swapped in atomically.
+
+    Models configured with configure_batching() get a MicroBatcher in front
+    of them so concurrent requests share stacked forward passes.
+
+    With configure_backend() models run through an exported TorchScript or
+    ONNX runtime instead of eager PyTorch. A runtime that doesn't match the
+    eager model on the parity images is discarded and eager is used instead.
+    """
+
+    def __init__(self, warmup=True):
+        self.warmup = warmup
+        self.backend = "eager"
+        self.quantize = False
+        self.intra_op_threads = None
+        self.parity_tolerance = 0.02
+        self._models = {}
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def configure_backend(
+        self,
+        backend="eager",
+        quantize=False,
+        intra_op_threads=None,
+        parity_tolerance=0.02,
+    ):
+        """Choose the runtime for models loaded from now on"""
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown model backend: {backend}")
+        self.backend = backend
+        self.quantize = quantize
+        self.intra_op_threads = intra_op_threads
+        self.parity_tolerance = parity_tolerance
+        if intra_op_threads:
+            torch.set_num_threads(intra_op_threads)
+
+    def configure_batching(self, path, max_batch_size=8, max_wait_ms=5):
+        """Put a micro-batching queue in front of the model at path"""
+        self._batchers[path] = MicroBatcher(
+            lambda batch: self.get(path).forward(batch),
+            max_batch_size=max_batch_size,
+            max_wait_ms=max_wait_ms,
+            name=f"batcher:{path}",
+        )
+
+    def predict(self, path, tensor):
+        """Return class probabilities for a 1xCxHxW tensor"""
+        batcher = self._batchers.get(path)
+        if batcher is None:
+            return self.get(path).forward(tensor)[0]
+        return batcher.submit(tensor)
+
+    def preload(self, paths):
+        """Load and warm up every model in paths"""
+        for path in paths:
+            self.get(path)
+
+    def get(self, path):
+        """Return the resident model for path, (re)loading it if needed"""
+        model = self._models.get(path)
+        mtime = os.stat(path).st_mtime_ns
+        if model is not None and model.mtime == mtime:
+            return model
+
+        with self._lock:
+            model = self._models.get(path)
+            if model is None or model.mtime != mtime:
+                if model is not None:
+                    logger.info("Reloading model %s: checkpoint changed on disk", path)
+                model = self._load(path, mtime)
+                self._models[path] = model
+            return model
+
+    def loaded_paths(self):
+        return list(self._models)
+
+    def _load(self, path, mtime):
+        yolo = YOLO(path, task="classify")
+        network = yolo.model.float().eval()
+        for parameter in network.parameters():
+            parameter.requires_grad_(False)
+
+        imgsz = getattr(network, "args", {}).get("imgsz", 224)
+        if isinstance(imgsz, (tuple, list)):
+            imgsz = max(imgsz)
+
+        with open(path, "rb") as f:
+            weights_hash = hashlib.sha256(f.read()).hexdigest()
+
+        model = LoadedModel(
+            path, network, dict(yolo.names), int(imgsz), mtime, weights_hash
+        )
+        if self.backend != "eager":
+            self._attach_runtime(model)
+        if self.warmup:
+            model.forward(torch.zeros(1, 3, model.imgsz, model.imgsz))
+        return model
+
+    def _attach_runtime(self, model):
+        """Switch model to the configured runtime if it passes the parity check"""
+        try:
+            runtime = load_runtime(
+                model.path,
+                model.network,
+                model.imgsz,
+                model.weights_hash,
+                self.backend,
+                self.quantize,
+                intra_op_threads=self.intra_op_threads,
+            )
+            report = check_parity(
+                model.eager_forward, runtime, parity_batch(model.imgsz)
+            )
+        except Exception as e:
+            logger.warning(
+                "Using eager inference for %s: %s failed: %s",
+                model.path,
+                self.backend,
+                e,
+            )
+            return
+
+        if (
+            report["top1_agreement"] < 1
+            or report["max_abs_diff"] > self.parity_tolerance
+        ):
+            logger.warning(
+                "Using eager inference for %s: %s parity check failed (%s)",
+                model.path,
+                self.backend,
+                report,
+            )
+            return
+        model.backend = self.backend
+        model.runtime = runtime
+
+
+def preprocess(image, size):
+    """Resize shortest edge, center crop and convert a PIL image to a 1xCxHxW tensor.
+
+    Mirrors the eval transforms baked into the Ultralytics classify checkpoints
+    (Resize, CenterCrop, ToTensor with zero mean / unit std). Grayscale images
+    are resized as a single channel and broadcast to RGB in the final write.
+    """
+    if image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    width, height = image.size
+    scale = size / min(width, height)
+    if scale != 1:
+        image = image.resize(
+            (max(size, round(width * scale)), max(size, round(height * scale))),
+            Image.BILINEAR,
+        )
+        width, height = image.size
+    left = (width - size) // 2
+    top = (height - size) // 2
+    image = image.crop((left, top, left + size, top + size))
+
+    pixels = np.asarray(image)
+    pixels = pixels[np.newaxis] if pixels.ndim == 2 else pixels.transpose(2, 0, 1)
+    # Scale uint8 HWC straight into the contiguous CHW float buffer
+    array = np.empty((3, size, size), dtype=np.float32)
+    np.divide(pixels, np.float32(255), out=array)
+    return torch.from_numpy(array).unsqueeze(0)
+
+
+class PreparedImage:
+    """An image decoded once, with its model input tensors memoized per size.
+
+    Lets several models classify the same upload without decoding or
+    resizing it again; models sharing an input size share one tensor.
+    The source may be a PIL image or raw encoded bytes, which are only
+    decoded when a tensor is first needed.
+
+    With draft_size, JPEGs are decoded at the smallest DCT scale (1/2, 1/4,
+    1/8) that still covers draft_size pixels on both sides, so a 4000px film
+    feeding a 256px model never gets decoded at full resolution.
+    """
+
+    def __init__(self, source, draft_size=None):
+        self._source = source
+        self._draft_size = draft_size
+        self._image = None
+        self._tensors = {}
+
+    @property
+    def image(self):
+        if self._image is None:
+            image = self._source
+            if isinstance(image, (bytes, bytearray)):
+                try:
+                    image = Image.open(io.BytesIO(image))
+                    if self._draft_size and image.format == "JPEG":
+                        image.draft(image.mode, (self._draft_size, self._draft_size))
+                    image.load()
+                except OSError as e:
+                    raise IngestError(f"Corrupt or truncated image: {e}") from e
+            self._image = image if image.mode in ("RGB", "L") else image.convert("RGB")
+        return self._image
+
+    def tensor(self, size):
+        tensor = self._tensors.get(size)
+        if tensor is None:
+            tensor = self._tensors[size] = preprocess(self.image, size)
+        return tensor
+
+
+registry = ModelRegistry()
+
+
+def preload_models(paths, backend_options=None, batching=None):
+    """Load models into this process's registry (also a pool initializer).
+
+    batching maps model paths to configure_batching() options.
+    """
+    if backend_options:
+        registry.configure_backend(**backend_options)
+    registry.preload(paths)
+    for path, options in (batching or {}).items():
+        registry.configure_batching(path, **options)
+
+
+class Classification:
+    """Class probabilities of one image, with the label table they index into.
+
+    The probabilities stay a compact float32 array (cheap to pass back from
+    a worker process) and post-processing reads what it needs from them.
+    timings, when set, holds the seconds each inference stage took.
+    """
+
+    __slots__ = ("probs", "labels", "timings")
+
+    def __init__(self, probs, labels, timings=None):
+        self.probs = np.asarray(probs, dtype=np.float32)
+        self.labels = labels
+        self.timings = timings
+
+    @classmethod
+    def from_model(cls, model, probs):
+        """Classification for one row of a model's output probabilities"""
+        return cls(probs, model.labels)
+
+    def __len__(self):
+        return len(self.probs)
+
+    @property
+    def top(self):
+        return int(np.argmax(self.probs))
+
+    @property
+    def label(self):
+        return self.labels[self.top]
+
+    @property
+    def confidence(self):
+        return float(self.probs[self.top])
+
+    def scores(self):
+        """{label: probability} for every class"""
+        return dict(zip(self.labels, self.probs.tolist()))
+
+    def ranked(self):
+        """[{"label", "confidence"}] for every class, best first"""
+        return [
+            {"label": self.labels[index], "confidence": float(self.probs[index])}
+            for index in np.argsort(-self.probs, kind="stable").tolist()
+        ]
+
+
+def classify_prepared(model_path, prepared):
+    """Classify a PreparedImage with the resident model at model_path.
+
+    Stage timings are measured here, where the work runs, so they survive
+    the trip back from a worker process. forward includes any wait for a
+    micro-batch to fill.
+    """
+    model = registry.get(model_path)
+    started = time.perf_counter()
+    prepared.image
+    decoded = time.perf_counter()
+    tensor = prepared.tensor(model.imgsz)
+    preprocessed = time.perf_counter()
+    probs = registry.predict(model_path, tensor)
+    classification = Classification.from_model(model, probs)
+    classification.timings = {
+        "decode": decoded - started,
+        "preprocess": preprocessed - decoded,
+        "forward": time.perf_counter() - preprocessed,
+    }
+    return classification
+
+
+def image_classification(model_path, image):
+    """Classify a PIL image with the resident model at model_path"""
+    return classify_prepared(model_path, PreparedImage(image))
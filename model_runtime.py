@@ -0,0 +1,235 @@
+"""Optimized CPU runtimes for the classification checkpoints.
+
+Each Ultralytics checkpoint can be exported once to TorchScript or ONNX,
+optionally with INT8 dynamic quantization, and the artifact is cached next
+to the .pt file under a name that includes the weights hash, so a changed
+checkpoint is re-exported instead of silently served stale.
+
+Exported runtimes are checked against the eager model on a fixed image set
+before they are used; see check_parity().
+
+Usage:
+    python model_runtime.py --backend torchscript [--quantize] models/*.pt
+"""
+
+import argparse
+import logging
+import os
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+try:
+    import onnxruntime
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    onnxruntime = None
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ("eager", "torchscript", "onnx")
+ARTIFACT_EXTENSIONS = {"torchscript": ".torchscript", "onnx": ".onnx"}
+
+
+class _ProbabilityHead(torch.nn.Module):
+    """Wraps a classify network so it returns only the probability tensor"""
+
+    def __init__(self, network):
+        super().__init__()
+        self.network = network
+
+    def forward(self, images):
+        output = self.network(images)
+        if isinstance(output, (tuple, list)):
+            output = output[0]
+        return output
+
+
+def artifact_path(model_path, weights_hash, backend, quantize=False):
+    """Where the exported artifact for a checkpoint is cached"""
+    root, _ = os.path.splitext(model_path)
+    suffix = ".int8" if quantize else ""
+    return f"{root}.{weights_hash[:16]}{suffix}{ARTIFACT_EXTENSIONS[backend]}"
+
+
+def export(network, imgsz, path, backend, quantize=False):
+    """Export network to path; written to a temp file and renamed into place"""
+    module = _ProbabilityHead(network).eval()
+    example = torch.zeros(1, 3, imgsz, imgsz)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+
+    if backend == "torchscript":
+        if quantize:
+            module = torch.ao.quantization.quantize_dynamic(
+                module, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        with torch.inference_mode():
+            traced = torch.jit.freeze(torch.jit.trace(module, example))
+        torch.jit.save(traced, tmp_path)
+    elif backend == "onnx":
+        _require_onnxruntime()
+        fp32_path = f"{tmp_path}.fp32" if quantize else tmp_path
+        torch.onnx.export(
+            module,
+            example,
+            fp32_path,
+            input_names=["images"],
+            output_names=["probs"],
+            dynamic_axes={"images": {0: "batch"}, "probs": {0: "batch"}},
+            opset_version=17,
+        )
+        if quantize:
+            quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+            os.remove(fp32_path)
+    else:
+        raise ValueError(f"Cannot export to backend: {backend}")
+
+    os.replace(tmp_path, path)
+
+
+class TorchScriptRuntime:
+    """Frozen TorchScript module; threads follow torch.set_num_threads"""
+
+    def __init__(self, path):
+        self.module = torch.jit.load(path).eval()
+
+    def __call__(self, batch):
+        with torch.inference_mode():
+            return self.module(batch)
+
+
+class OnnxRuntime:
+    """ONNX Runtime CPU session with its own intra-op thread pool"""
+
+    def __init__(self, path, intra_op_threads=None):
+        _require_onnxruntime()
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = (
+            onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        )
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+
+    def __call__(self, batch):
+        (probs,) = self.session.run(["probs"], {"images": batch.numpy()})
+        return torch.from_numpy(probs)
+
+
+def _require_onnxruntime():
+    if onnxruntime is None:
+        raise RuntimeError("The onnx and onnxruntime packages are required")
+
+
+def load_runtime(
+    model_path, network, imgsz, weights_hash, backend, quantize=False, **options
+):
+    """Return a runtime for the checkpoint, exporting it first if not cached"""
+    path = artifact_path(model_path, weights_hash, backend, quantize)
+    if not os.path.exists(path):
+        logger.info("Exporting %s to %s", model_path, path)
+        export(network, imgsz, path, backend, quantize)
+
+    if backend == "torchscript":
+        return TorchScriptRuntime(path)
+    return OnnxRuntime(path, intra_op_threads=options.get("intra_op_threads"))
+
+
+def synthetic_xray(width, height, rng):
+    """Grayscale X-ray-like test image: dark background, bright "lung fields", noise"""
+    image = Image.new("L", (int(width), int(height)), int(rng.randint(0, 60)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(2):
+        x, y = rng.randint(0, width // 2), rng.randint(0, height // 2)
+        box = (x, y, x + width // 3, y + height // 2)
+        draw.ellipse(box, fill=int(rng.randint(120, 255)))
+    noise = rng.normal(0, 20, size=(int(height), int(width)))
+    array = np.clip(np.asarray(image, dtype=np.float64) + noise, 0, 255)
+    return Image.fromarray(array.astype(np.uint8), "L")
+
+
+def parity_images(count=8, seed=0):
+    """Fixed, deterministic set of X-ray-like test images of varied size and mode"""
+    rng = np.random.RandomState(seed)
+    images = []
+    for index in range(count):
+        width, height = rng.randint(200, 1200, size=2)
+        image = synthetic_xray(width, height, rng)
+        images.append(image.convert("RGB") if index % 2 else image)
+    return images
+
+
+def check_parity(reference, candidate, batch):
+    """Compare two runtimes on a preprocessed NCHW batch.
+
+    Returns the largest absolute difference in any class probability and the
+    fraction of images whose top-1 class agrees.
+    """
+    with torch.inference_mode():
+        expected = reference(batch)
+        actual = candidate(batch)
+    return {
+        "max_abs_diff": float((expected - actual).abs().max()),
+        "top1_agreement": float(
+            (expected.argmax(dim=1) == actual.argmax(dim=1)).float().mean()
+        ),
+    }
+
+
+def parity_batch(imgsz, image_dir=None):
+    """Preprocessed parity images, from image_dir if given, else synthetic"""
+    from model_registry import PreparedImage
+
+    if image_dir:
+        images = [
+            Image.open(os.path.join(image_dir, name))
+            for name in sorted(os.listdir(image_dir))
+            if name.lower().endswith((".png", ".jpg", ".jpeg"))
+        ]
+    else:
+        images = parity_images()
+    return torch.cat([PreparedImage(image).tensor(imgsz) for image in images])
+
+
+def main():
+    from log_config import configure_logging
+    from model_registry import ModelRegistry
+
+    configure_logging()
+
+    parser = argparse.ArgumentParser(description="Export models and check parity")
+    parser.add_argument("models", nargs="+", help="Ultralytics .pt checkpoints")
+    parser.add_argument("--backend", choices=BACKENDS[1:], default="torchscript")
+    parser.add_argument("--quantize", action="store_true", help="INT8 dynamic")
+    parser.add_argument("--threads", type=int, help="intra-op thread count")
+    parser.add_argument("--images", help="directory of sample images for parity")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    registry = ModelRegistry(warmup=False)
+    for model_path in args.models:
+        model = registry.get(model_path)
+        runtime = load_runtime(
+            model_path,
+            model.network,
+            model.imgsz,
+            model.weights_hash,
+            args.backend,
+            args.quantize,
+            intra_op_threads=args.threads,
+        )
+        report = check_parity(
+            model.forward, runtime, parity_batch(model.imgsz, args.images)
+        )
+        print(
+            f"{model_path}: max_abs_diff={report['max_abs_diff']:.6f} "
+            f"top1_agreement={report['top1_agreement']:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Machine-readable performance reports shared by the benchmark tools.
+
+A report is a JSON document with the commit and configuration it was run
+with and nested metric dicts. compare() lines up the numeric metrics of two
+reports and flags regressions beyond a relative tolerance, so a run can be
+checked against a saved baseline from another commit.
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentiles(samples, scale=1.0):
+    """p50/p90/p95/p99/max/mean of samples (times scale), rounded; {} if empty"""
+    if len(samples) == 0:
+        return {"count": 0}
+    values = np.asarray(samples, dtype=float) * scale
+    summary = {
+        f"p{p}": round(float(v), 3)
+        for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))
+    }
+    summary.update(
+        count=len(values),
+        max=round(float(values.max()), 3),
+        mean=round(float(values.mean()), 3),
+    )
+    return summary
+
+
+def git_commit():
+    """Current commit hash, with "+dirty" if the tree has changes; None outside git"""
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{commit}+dirty" if dirty else commit
+
+
+def write_report(path, kind, config, metrics):
+    """Write a report and return it"""
+    report = {
+        "kind": kind,
+        "commit": git_commit(),
+        "created_at": datetime.now().isoformat(),
+        "config": config,
+        "metrics": metrics,
+    }
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    return report
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _flatten(metrics, prefix=""):
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}.")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield name, value
+
+
+def compare(baseline, current, tolerance=0.2, higher_is_better=(), ignore=()):
+    """Compare the metrics of two reports.
+
+    Returns [(metric, baseline, current, relative change, regressed)] for
+    every numeric metric present in both. Metrics are taken to be "lower is
+    better" (latencies, memory) unless their name contains one of the
+    higher_is_better substrings (throughputs); a metric regresses when it
+    moves the wrong way by more than tolerance. Sample counts and metrics
+    starting with one of the ignore prefixes are skipped.
+    """
+    before = dict(_flatten(baseline["metrics"]))
+    rows = []
+    for name, value in _flatten(current["metrics"]):
+        if (
+            name not in before
+            or name.endswith((".count", ".max"))
+            or name.startswith(ignore)
+        ):
+            continue
+        reference = before[name]
+        change = (value - reference) / reference if reference else 0.0
+        better_up = any(part in name for part in higher_is_better)
+        regressed = change < -tolerance if better_up else change > tolerance
+        rows.append((name, reference, value, change, regressed))
+    return rows
+
+
+def print_comparison(rows):
+    """Print a comparison table; returns the number of regressions"""
+    width = max((len(name) for name, *_ in rows), default=10)
+    for name, reference, value, change, regressed in rows:
+        flag = "REGRESSED" if regressed else ""
+        print(
+            f"{name:<{width}}  {reference:>12.3f}  {value:>12.3f}  {change:+8.1%}  {flag}"
+        )
+    return sum(regressed for *_, regressed in rows)
+
+
+class ResourceSampler:
+    """Samples CPU and resident memory of a process every interval seconds.
+
+    Uses psutil when available (any pid); otherwise falls back to /proc for
+    Linux, for this process only.
+    """
+
+    def __init__(self, pid=None, interval=0.5):
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.cpu_percent = []
+        self.rss_bytes = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def summary(self):
+        return {
+            "cpu_percent_mean": (
+                round(float(np.mean(self.cpu_percent)), 1) if self.cpu_percent else None
+            ),
+            "cpu_percent_max": max(self.cpu_percent, default=None),
+            "rss_mb_peak": round(max(self.rss_bytes, default=0) / 2**20, 1),
+        }
+
+    def _run(self):
+        if psutil is not None:
+            process = psutil.Process(self.pid)
+            process.cpu_percent()
+            sample = lambda: (process.cpu_percent(), process.memory_info().rss)
+        else:
+            sample = self._proc_sampler()
+        # One last sample after stop(), so even a window shorter than the
+        # interval is measured
+        while True:
+            stopped = self._stop.wait(self.interval)
+            try:
+                cpu, rss = sample()
+            except Exception:
+                # The process went away
+                return
+            self.cpu_percent.append(cpu)
+            self.rss_bytes.append(rss)
+            if stopped:
+                return
+
+    def _proc_sampler(self):
+        page_size = os.sysconf("SC_PAGE_SIZE")
+        last = [time.process_time(), time.monotonic()]
+
+        def sample():
+            with open("/proc/self/statm") as f:
+                rss = int(f.read().split()[1]) * page_size
+            cpu_time, now = time.process_time(), time.monotonic()
+            cpu = 100 * (cpu_time - last[0]) / max(now - last[1], 1e-9)
+            last[:] = [cpu_time, now]
+            return round(cpu, 1), rss
+
+        return sample
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """LRU + TTL cache of prediction dicts keyed by upload content and model.
+
+    Keys combine the SHA-256 of the uploaded bytes with the model identity
+    (checkpoint path and weights hash), so a retrained checkpoint never serves
+    stale predictions. With persist_path set, entries are mirrored to a SQLite
+    file and the most recent ones are loaded back on startup.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, persist_path=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {key: (stored_at, prediction)}
+        self._lock = threading.Lock()
+        self._db = None
+
+        if persist_path:
+            self.open(persist_path)
+
+    @staticmethod
+    def digest(data):
+        """Content hash of an upload; hash once and derive every model's key from it"""
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def key(digest, model_identity):
+        return f"{digest}:{model_identity}"
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl_seconds:
+                self._delete(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, prediction):
+        stored_at = time.time()
+        with self._lock:
+            self._entries[key] = (stored_at, prediction)
+            self._entries.move_to_end(key)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                    (key, stored_at, json.dumps(prediction)),
+                )
+            while len(self._entries) > self.max_entries:
+                self._delete(next(iter(self._entries)))
+            if self._db is not None:
+                self._db.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+    def _delete(self, key):
+        del self._entries[key]
+        if self._db is not None:
+            self._db.execute("DELETE FROM predictions WHERE key = ?", (key,))
+
+    def open(self, persist_path):
+        """Mirror entries to the SQLite file at persist_path, loading recent ones"""
+        directory = os.path.dirname(persist_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._db = sqlite3.connect(persist_path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS predictions "
+            "(key TEXT PRIMARY KEY, stored_at REAL, prediction TEXT)"
+        )
+        self._db.execute(
+            "DELETE FROM predictions WHERE stored_at < ?",
+            (time.time() - self.ttl_seconds,),
+        )
+        rows = self._db.execute(
+            "SELECT key, stored_at, prediction FROM predictions "
+            "ORDER BY stored_at DESC LIMIT ?",
+            (self.max_entries,),
+        ).fetchall()
+        for key, stored_at, prediction in reversed(rows):
+            self._entries[key] = (stored_at, json.loads(prediction))
+        # Drop rows that did not fit in the LRU so disk stays bounded too
+        self._db.execute(
+            "DELETE FROM predictions WHERE key NOT IN "
+            "(SELECT key FROM predictions ORDER BY stored_at DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self._db.commit()
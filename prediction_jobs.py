@@ -0,0 +1,66 @@
+import time
+import uuid
+from datetime import datetime
+
+
+class PredictionJobs:
+    """Asynchronous prediction jobs, kept in the state backend with a TTL.
+
+    A job is "queued" until its inference finishes, then "completed" with a
+    result or "failed" with an error. Records expire ttl_seconds after they
+    were last updated: expired jobs read as missing, and are swept from the
+    table at most once a minute.
+    """
+
+    def __init__(self, backend, ttl_seconds=3600):
+        self.backend = backend
+        self.ttl = ttl_seconds
+        self._next_sweep = 0
+
+    def create(self, filename):
+        """Queue a job for an uploaded file; returns the job record"""
+        self._sweep()
+        job = {
+            "job_id": str(uuid.uuid4()),
+            "filename": filename,
+            "status": "queued",
+            "created_at": datetime.now().isoformat(),
+            "expires_at": time.time() + self.ttl,
+        }
+        self.backend.put("prediction_jobs", job["job_id"], job)
+        return job
+
+    def get(self, job_id):
+        job = self.backend.get("prediction_jobs", job_id)
+        if job is None or job["expires_at"] < time.time():
+            return None
+        return job
+
+    def delete(self, job_id):
+        self.backend.delete("prediction_jobs", job_id)
+
+    def complete(self, job_id, result):
+        return self._finish(job_id, status="completed", result=result)
+
+    def fail(self, job_id, error):
+        return self._finish(job_id, status="failed", error=error)
+
+    def _finish(self, job_id, **fields):
+        return self.backend.patch(
+            "prediction_jobs",
+            job_id,
+            dict(
+                fields,
+                completed_at=datetime.now().isoformat(),
+                expires_at=time.time() + self.ttl,
+            ),
+        )
+
+    def _sweep(self):
+        now = time.time()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 60
+        for job_id, job in self.backend.items("prediction_jobs"):
+            if job["expires_at"] < now:
+                self.backend.delete("prediction_jobs", job_id)
@@ -0,0 +1,256 @@
+import threading
+
+import numpy as np
+
+from geo import location_arrays, pairwise_km
+
+# Costs at or above this are pairs that must not be matched
+UNMATCHABLE = 1e9
+
+
+def min_cost_assignment(cost):
+    """Optimal one-to-one assignment for a rows x cols cost matrix (Hungarian).
+
+    Returns (row, col) pairs, one per row or per column, whichever is fewer,
+    minimizing the total cost. O(n^2 m) with the inner loop vectorized.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+
+    # Potentials and matching, 1-based with column 0 as the sentinel
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    row_of = np.zeros(m + 1, dtype=int)
+    way = np.zeros(m + 1, dtype=int)
+    for row in range(1, n + 1):
+        row_of[0] = row
+        col = 0
+        min_slack = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[col] = True
+            current = row_of[col]
+            free = ~used[1:]
+            slack = cost[current - 1] - u[current] - v[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = col
+
+            candidates = np.where(free, min_slack[1:], np.inf)
+            next_col = int(np.argmin(candidates)) + 1
+            delta = candidates[next_col - 1]
+
+            used_cols = np.nonzero(used)[0]
+            u[row_of[used_cols]] += delta
+            v[used_cols] -= delta
+            min_slack[1:][free] -= delta
+            col = next_col
+            if row_of[col] == 0:
+                break
+
+        # Flip the augmenting path
+        while col:
+            previous = way[col]
+            row_of[col] = row_of[previous]
+            col = previous
+
+    pairs = [(row_of[col] - 1, col - 1) for col in range(1, m + 1) if row_of[col]]
+    if transposed:
+        pairs = [(row, col) for col, row in pairs]
+    return sorted(pairs)
+
+
+def greedy_assignment(cost):
+    """Repeatedly match the cheapest remaining pair; fast, not always optimal"""
+    cost = np.asarray(cost, dtype=float)
+    rows, cols = np.unravel_index(np.argsort(cost, axis=None), cost.shape)
+    taken_rows = set()
+    taken_cols = set()
+    pairs = []
+    for row, col in zip(rows.tolist(), cols.tolist()):
+        if row in taken_rows or col in taken_cols:
+            continue
+        taken_rows.add(row)
+        taken_cols.add(col)
+        pairs.append((row, col))
+        if len(pairs) == min(cost.shape):
+            break
+    return sorted(pairs)
+
+
+ASSIGNMENT_METHODS = {"hungarian": min_cost_assignment, "greedy": greedy_assignment}
+
+
+class QueueMatcher:
+    """Queue of requests no driver took, matched to drivers as they free up.
+
+    Queued requests are ordered by emergency type priority (lower is more
+    urgent, from priorities) and then by arrival. Changes in driver
+    availability only mark the queue dirty; every tick_ms a single batch
+    match takes as many queued requests, most urgent first, as there are
+    available drivers and assigns them to drivers minimizing the total
+    distance (pairwise_km matrix, Hungarian or greedy), or the total driving
+    time when an eta engine is given. Drivers who declined a request are
+    never assigned to it.
+
+    The queue is an index in the state backend; assign(request_id, driver_id)
+    is the app's callback that claims the request and notifies both sides,
+    returning False if the request or driver was taken in the meantime.
+    """
+
+    def __init__(
+        self,
+        requests,
+        drivers,
+        driver_index,
+        assign,
+        priorities=None,
+        default_priority=2,
+        method="hungarian",
+        tick_ms=250,
+        eta=None,
+    ):
+        self.requests = requests
+        self.drivers = drivers
+        self.driver_index = driver_index
+        self.assign = assign
+        self.priorities = priorities or {}
+        self.default_priority = default_priority
+        self.assignment = ASSIGNMENT_METHODS[method]
+        self.tick = tick_ms / 1000.0
+        self.eta = eta
+        self.assigned = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        return self.requests.backend
+
+    def __len__(self):
+        return self.backend.index_count("dispatch_queue")
+
+    def enqueue(self, request_id):
+        request_data = self.requests.get(request_id)
+        if request_data is None:
+            return
+        priority = self.priorities.get(
+            request_data.get("emergency_type"), self.default_priority
+        )
+        # Sorted by priority, then by creation order within a priority
+        score = priority * 10**12 + request_data["sequence"]
+        self.backend.index_add("dispatch_queue", request_id, score)
+        self._dirty = True
+
+    def remove(self, request_id):
+        self.backend.index_remove("dispatch_queue", request_id)
+
+    def position(self, request_id):
+        """1-based place of a request in the queue, or None if not queued"""
+        members = self.backend.index_members("dispatch_queue")
+        return members.index(request_id) + 1 if request_id in members else None
+
+    def availability_changed(self):
+        """A driver registered or freed up; rematch on the next tick"""
+        self._dirty = True
+
+    def run(self, sleep):
+        """Matching loop; sleep is the server's cooperative sleep function"""
+        while True:
+            sleep(self.tick)
+            if self._dirty:
+                self.match()
+
+    def match(self):
+        """Assign queued requests to available drivers; returns the number assigned"""
+        with self._lock:
+            self._dirty = False
+            queued = self._queued()
+            drivers = self.driver_index.positions()
+        if not queued or not drivers:
+            return 0
+
+        # Only the most urgent requests some driver can take compete for the
+        # drivers there are. Costs are computed without the lock; assign()
+        # rejects any pair that went stale meanwhile
+        driver_columns = {driver_id: i for i, (driver_id, _, _) in enumerate(drivers)}
+        candidates = [
+            (request_id, request_data)
+            for request_id, request_data in queued
+            if set(driver_columns) - set(request_data.get("declined", []))
+        ]
+        queued, rows = [], []
+        while candidates and len(queued) < len(drivers):
+            batch = candidates[: len(drivers) - len(queued)]
+            del candidates[: len(batch)]
+            for (request_id, request_data), row in zip(
+                batch, self._cost(batch, drivers)
+            ):
+                for driver_id in request_data.get("declined", []):
+                    if driver_id in driver_columns:
+                        row[driver_columns[driver_id]] = UNMATCHABLE
+                # Off the map for every driver left; give its slot to the next
+                if (row < UNMATCHABLE).any():
+                    queued.append((request_id, request_data))
+                    rows.append(row)
+        if not queued:
+            return 0
+        cost = np.array(rows)
+
+        with self._lock:
+            assigned = 0
+            for row, col in self.assignment(cost):
+                if cost[row, col] >= UNMATCHABLE:
+                    continue
+                request_id = queued[row][0]
+                if self.assign(request_id, drivers[col][0]):
+                    self.remove(request_id)
+                    assigned += 1
+                else:
+                    # Lost a race with an accept or a status change; retry
+                    self._dirty = True
+            self.assigned += assigned
+            return assigned
+
+    def _cost(self, queued, drivers):
+        """requests x drivers matrix of distances, or driving times with eta.
+
+        With eta each row takes one search out of the request's location
+        for all drivers at once (EtaEngine.seconds_many).
+        """
+        if self.eta is not None:
+            driver_locations = [{"lat": lat, "lng": lng} for _, lat, lng in drivers]
+            cost = np.array(
+                [
+                    self.eta.seconds_many(driver_locations, request_data["location"])
+                    for _, request_data in queued
+                ],
+                dtype=float,
+            )
+        else:
+            request_lats, request_lngs, _ = location_arrays(
+                [request_data["location"] for _, request_data in queued]
+            )
+            cost = pairwise_km(
+                request_lats,
+                request_lngs,
+                [lat for _, lat, _ in drivers],
+                [lng for _, _, lng in drivers],
+            )
+        return np.nan_to_num(cost, nan=UNMATCHABLE, posinf=UNMATCHABLE)
+
+    def _queued(self):
+        """[(request_id, request_data)] still pending, most urgent first"""
+        request_ids = self.backend.index_members("dispatch_queue")
+        queued = []
+        for request_id, request_data in zip(
+            request_ids, self.backend.get_many("requests", request_ids)
+        ):
+            if request_data is None or request_data["status"] != "pending":
+                self.remove(request_id)
+            else:
+                queued.append((request_id, request_data))
+        return queued
@@ -0,0 +1,98 @@
+from state_backend import InMemoryBackend, Table
+
+
+class RequestStore:
+    """Emergency requests indexed by status, with finished ones archived.
+
+    Live requests are kept in the state backend with one index per status,
+    so listing the pending requests only touches pending ones and counting
+    them is O(1). Requests that reach a final status move to a bounded
+    archive, oldest evicted first, so the live set doesn't grow over the
+    lifetime of the process.
+
+    Reads use the dict protocol over live requests (``request_id in store``,
+    ``store[request_id]``); ``get`` also looks in the archive. All writes go
+    through ``create``, ``update`` and ``transition`` so the indexes stay
+    consistent.
+    """
+
+    def __init__(self, backend=None, archive_size=1000, final_statuses=("arrived",)):
+        self.backend = backend or InMemoryBackend()
+        self.archive_size = archive_size
+        self.final_statuses = set(final_statuses)
+        self._live = Table(self.backend, "requests")
+
+    def __contains__(self, request_id):
+        return request_id in self._live
+
+    def __getitem__(self, request_id):
+        return self._live[request_id]
+
+    def __len__(self):
+        return len(self._live)
+
+    def __iter__(self):
+        return iter(self._live)
+
+    @property
+    def total_created(self):
+        return self.backend.counter("requests:created")
+
+    def get(self, request_id, default=None):
+        """Return a live or archived request"""
+        data = self._live.get(request_id)
+        if data is None:
+            data = self.backend.get("requests:archive", request_id)
+        return default if data is None else data
+
+    def create(self, request_id, data):
+        data["sequence"] = self.backend.incr("requests:created")
+        self._live[request_id] = data
+        self.backend.index_add(f"status:{data['status']}", request_id, data["sequence"])
+
+    def update(self, request_id, **fields):
+        """Update fields of a live request, re-indexing it on status changes"""
+        old_status = self._live[request_id]["status"]
+        if "status" in fields and fields["status"] != old_status:
+            return self.transition(
+                request_id, old_status, fields.pop("status"), **fields
+            )
+        return self._live.patch(request_id, **fields)
+
+    def transition(self, request_id, from_status, to_status, **fields):
+        """Atomically move a request from one status to another.
+
+        Returns the updated request, or None if it was no longer in
+        from_status (e.g. another driver accepted it first).
+        """
+        data = self._live.compare_and_set(
+            request_id, "status", from_status, status=to_status, **fields
+        )
+        if data is None:
+            return None
+
+        self.backend.index_remove(f"status:{from_status}", request_id)
+        if to_status in self.final_statuses:
+            self.backend.capped_put(
+                "requests:archive", request_id, data, self.archive_size
+            )
+            del self._live[request_id]
+        else:
+            self.backend.index_add(f"status:{to_status}", request_id, data["sequence"])
+        return data
+
+    def with_status(self, status):
+        """Return (request_id, data) pairs for live requests in status, oldest first"""
+        request_ids = self.backend.index_members(f"status:{status}")
+        records = self.backend.get_many("requests", request_ids)
+        return [
+            (request_id, data)
+            for request_id, data in zip(request_ids, records)
+            if data is not None
+        ]
+
+    def count(self, status):
+        return self.backend.index_count(f"status:{status}")
+
+    def archived_count(self):
+        return self.backend.count("requests:archive")
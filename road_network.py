@@ -0,0 +1,533 @@
+"""Road-network travel times for dispatch.
+
+A RoadGraph is the directed road graph of a region, built from an
+OpenStreetMap extract (.osm XML), with edges weighted by free-flow driving
+time. Point-to-point queries run A* with ALT lower bounds: shortest times
+from and to a few landmarks (spread far apart with farthest-point selection)
+are precomputed once, and the triangle inequality over them steers each
+search straight at the target, so it settles a small fraction of the
+nodes a plain Dijkstra would.
+
+Precomputing landmarks for a city takes seconds to minutes, so do it once
+and load the saved .npz at startup:
+
+Usage:
+    python road_network.py region.osm region.npz [--landmarks 16]
+"""
+
+import argparse
+import heapq
+import logging
+import math
+import threading
+import time
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+import numpy as np
+
+from geo import distance_km, haversine_km, parse_location
+
+logger = logging.getLogger(__name__)
+
+# Free-flow speeds in km/h by OSM highway type, for ways without a maxspeed.
+# Highway types not listed here (footways, tracks, ...) are not drivable
+HIGHWAY_SPEEDS_KMH = {
+    "motorway": 100,
+    "motorway_link": 60,
+    "trunk": 80,
+    "trunk_link": 50,
+    "primary": 60,
+    "primary_link": 40,
+    "secondary": 50,
+    "secondary_link": 40,
+    "tertiary": 40,
+    "tertiary_link": 30,
+    "unclassified": 30,
+    "residential": 25,
+    "living_street": 10,
+    "service": 15,
+    "road": 30,
+}
+ONEWAY_HIGHWAYS = ("motorway", "motorway_link")
+
+
+def _maxspeed_kmh(value):
+    """km/h from an OSM maxspeed tag ("50", "30 mph"), or None"""
+    if not value:
+        return None
+    number, _, unit = value.strip().partition(" ")
+    try:
+        speed = float(number)
+    except ValueError:
+        return None
+    return speed * 1.609344 if unit.strip() == "mph" else speed
+
+
+def _direction(tags):
+    """(forward, backward) drivability of an OSM way"""
+    oneway = tags.get("oneway")
+    if oneway in ("yes", "true", "1"):
+        return True, False
+    if oneway == "-1":
+        return False, True
+    if oneway == "no":
+        return True, True
+    if tags["highway"] in ONEWAY_HIGHWAYS or tags.get("junction") == "roundabout":
+        return True, False
+    return True, True
+
+
+def parse_osm(path, speeds=HIGHWAY_SPEEDS_KMH):
+    """Read an .osm XML extract into (lats, lngs, sources, targets, seconds).
+
+    Node arrays hold only nodes on drivable ways; edges join consecutive
+    nodes of each way, one per drivable direction.
+    """
+    coordinates = {}
+    ways = []
+    for _, element in ET.iterparse(path):
+        if element.tag == "node":
+            coordinates[element.get("id")] = (
+                float(element.get("lat")),
+                float(element.get("lon")),
+            )
+            element.clear()
+        elif element.tag == "way":
+            tags = {tag.get("k"): tag.get("v") for tag in element.iter("tag")}
+            if tags.get("highway") in speeds and tags.get("access") != "no":
+                speed = _maxspeed_kmh(tags.get("maxspeed")) or speeds[tags["highway"]]
+                refs = [nd.get("ref") for nd in element.iter("nd")]
+                ways.append((refs, speed, _direction(tags)))
+            element.clear()
+
+    index = {}
+    sources = []
+    targets = []
+    seconds = []
+    for refs, speed, (forward, backward) in ways:
+        refs = [ref for ref in refs if ref in coordinates]
+        for a, b in zip(refs, refs[1:]):
+            length_km = haversine_km(*coordinates[a], *coordinates[b])
+            travel = float(length_km) / speed * 3600
+            i = index.setdefault(a, len(index))
+            j = index.setdefault(b, len(index))
+            if forward:
+                sources.append(i)
+                targets.append(j)
+                seconds.append(travel)
+            if backward:
+                sources.append(j)
+                targets.append(i)
+                seconds.append(travel)
+
+    lats = np.empty(len(index))
+    lngs = np.empty(len(index))
+    for ref, i in index.items():
+        lats[i], lngs[i] = coordinates[ref]
+    return lats, lngs, np.array(sources), np.array(targets), np.array(seconds)
+
+
+def _csr(n, sources, targets, weights):
+    """Adjacency lists as (offsets, targets, weights) Python lists"""
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=n), out=offsets[1:])
+    return offsets.tolist(), targets[order].tolist(), weights[order].tolist()
+
+
+def _dijkstra(adjacency, source):
+    """Shortest times from source to every node (inf if unreachable)"""
+    offsets, targets, weights = adjacency
+    dist = [math.inf] * (len(offsets) - 1)
+    dist[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        d, node = heapq.heappop(heap)
+        if d > dist[node]:
+            continue
+        for i in range(offsets[node], offsets[node + 1]):
+            neighbor = targets[i]
+            candidate = d + weights[i]
+            if candidate < dist[neighbor]:
+                dist[neighbor] = candidate
+                heapq.heappush(heap, (candidate, neighbor))
+    return dist
+
+
+class RoadGraph:
+    """Directed road graph with ALT landmarks and nearest-node snapping.
+
+    Nodes are indexed 0..n-1; edges are stored as adjacency arrays in both
+    directions. from_landmarks[l, v] and to_landmarks[l, v] hold shortest
+    times from landmark l to v and from v to landmark l.
+    """
+
+    def __init__(
+        self,
+        lats,
+        lngs,
+        sources,
+        targets,
+        seconds,
+        from_landmarks=None,
+        to_landmarks=None,
+        cell_deg=0.005,
+    ):
+        self.lats = np.asarray(lats, dtype=float)
+        self.lngs = np.asarray(lngs, dtype=float)
+        self.sources = np.asarray(sources, dtype=np.int64)
+        self.targets = np.asarray(targets, dtype=np.int64)
+        self.seconds = np.asarray(seconds, dtype=float)
+        n = len(self.lats)
+        self.forward = _csr(n, self.sources, self.targets, self.seconds)
+        self.backward = _csr(n, self.targets, self.sources, self.seconds)
+        self.from_landmarks = None
+        self.to_landmarks = None
+        if from_landmarks is not None:
+            self.from_landmarks = np.asarray(from_landmarks, dtype=float)
+            self.to_landmarks = np.asarray(to_landmarks, dtype=float)
+
+        # Grid of cell_deg x cell_deg buckets for snapping locations to nodes
+        self.cell_deg = cell_deg
+        self._cells = {}
+        rows = np.floor(self.lats / cell_deg).astype(np.int64)
+        columns = np.floor(self.lngs / cell_deg).astype(np.int64)
+        for i, cell in enumerate(zip(rows.tolist(), columns.tolist())):
+            self._cells.setdefault(cell, []).append(i)
+
+    def __len__(self):
+        return len(self.lats)
+
+    @classmethod
+    def load(cls, path, landmarks=8):
+        """Load a saved .npz graph, or build one (with landmarks) from .osm XML"""
+        if path.endswith(".npz"):
+            with np.load(path) as arrays:
+                return cls(**{name: arrays[name] for name in arrays.files})
+        graph = cls(*parse_osm(path))
+        graph.select_landmarks(landmarks)
+        return graph
+
+    def save(self, path):
+        arrays = {
+            "lats": self.lats,
+            "lngs": self.lngs,
+            "sources": self.sources,
+            "targets": self.targets,
+            "seconds": self.seconds,
+        }
+        if self.from_landmarks is not None:
+            arrays["from_landmarks"] = self.from_landmarks.astype(np.float32)
+            arrays["to_landmarks"] = self.to_landmarks.astype(np.float32)
+        np.savez_compressed(path, **arrays)
+
+    def select_landmarks(self, count=8, seed=0):
+        """Precompute ALT tables for count landmarks chosen farthest-point first"""
+        count = min(count, len(self))
+        if count == 0:
+            return
+        start = np.random.default_rng(seed).integers(len(self))
+        reach = np.array(_dijkstra(self.forward, start))
+        landmark = int(np.argmax(np.where(np.isfinite(reach), reach, -1)))
+
+        from_rows = []
+        to_rows = []
+        closest = np.full(len(self), np.inf)
+        for _ in range(count):
+            from_rows.append(np.array(_dijkstra(self.forward, landmark)))
+            to_rows.append(np.array(_dijkstra(self.backward, landmark)))
+            # Next landmark: the reachable node farthest from all chosen so far
+            closest = np.minimum(closest, from_rows[-1])
+            landmark = int(np.argmax(np.where(np.isfinite(closest), closest, -1)))
+
+        self.from_landmarks = np.array(from_rows)
+        self.to_landmarks = np.array(to_rows)
+
+    def snap(self, lat, lng, max_km=1.0):
+        """(node, km) of the graph node nearest to a point, or None beyond max_km"""
+        row = math.floor(lat / self.cell_deg)
+        column = math.floor(lng / self.cell_deg)
+        cell_km = self.cell_deg * 111.0 * max(math.cos(math.radians(lat)), 0.01)
+        max_ring = int(max_km / cell_km) + 1
+
+        candidates = []
+        first_hit = None
+        # One more ring after the first hit: a node there may still be closer
+        for ring in range(max_ring + 1):
+            for dr in range(-ring, ring + 1):
+                for dc in range(-ring, ring + 1):
+                    if max(abs(dr), abs(dc)) == ring:
+                        candidates.extend(self._cells.get((row + dr, column + dc), ()))
+            if candidates and first_hit is None:
+                first_hit = ring
+            if first_hit is not None and ring > first_hit:
+                break
+        if not candidates:
+            return None
+
+        distances = haversine_km(lat, lng, self.lats[candidates], self.lngs[candidates])
+        best = int(np.argmin(distances))
+        if distances[best] > max_km:
+            return None
+        return candidates[best], float(distances[best])
+
+    def heuristic(self, target, nodes=None):
+        """ALT lower bounds on the time from every node (or just nodes) to target"""
+        if self.from_landmarks is None:
+            return np.zeros(len(self) if nodes is None else len(nodes))
+        to_target = self.to_landmarks[:, target, np.newaxis]
+        from_target = self.from_landmarks[:, target, np.newaxis]
+        to_landmarks = self.to_landmarks
+        from_landmarks = self.from_landmarks
+        if nodes is not None:
+            to_landmarks = to_landmarks[:, nodes]
+            from_landmarks = from_landmarks[:, nodes]
+        with np.errstate(invalid="ignore"):
+            # d(v, t) >= d(v, l) - d(t, l) and d(v, t) >= d(l, t) - d(l, v);
+            # a bound is skipped when its subtracted term is unreachable
+            via = np.where(np.isfinite(to_target), to_landmarks - to_target, 0)
+            back = np.where(
+                np.isfinite(from_landmarks), from_target - from_landmarks, 0
+            )
+        return np.maximum(np.maximum(via, back).max(axis=0), 0)
+
+    def route_seconds(self, source, target, heuristic=None):
+        """Shortest driving time between two nodes by A*, inf if unreachable"""
+        if source == target:
+            return 0.0
+        h = self.heuristic(target) if heuristic is None else heuristic
+        if not math.isfinite(h[source]):
+            return math.inf
+        offsets, targets, weights = self.forward
+        dist = {source: 0.0}
+        settled = set()
+        heap = [(h[source], source)]
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node == target:
+                return dist[node]
+            if node in settled:
+                continue
+            settled.add(node)
+            d = dist[node]
+            for i in range(offsets[node], offsets[node + 1]):
+                neighbor = targets[i]
+                candidate = d + weights[i]
+                if candidate < dist.get(neighbor, math.inf):
+                    dist[neighbor] = candidate
+                    heapq.heappush(heap, (candidate + h[neighbor], neighbor))
+        return math.inf
+
+    def seconds_to(self, target, sources):
+        """{source: shortest driving time to target} for many sources at once.
+
+        One Dijkstra runs backwards from target and stops as soon as every
+        source is settled, so a batch of nearby drivers costs about as much
+        as the farthest of them alone. Sources the landmarks prove cannot
+        reach target get inf without being searched for.
+        """
+        times = {}
+        remaining = set()
+        bounds = self.heuristic(target, list(sources)).tolist()
+        for source, bound in zip(sources, bounds):
+            if math.isfinite(bound):
+                remaining.add(source)
+            else:
+                times[source] = math.inf
+        if not remaining:
+            return times
+
+        offsets, targets, weights = self.backward
+        dist = {target: 0.0}
+        heap = [(0.0, target)]
+        while heap and remaining:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            if node in remaining:
+                remaining.discard(node)
+                times[node] = d
+            for i in range(offsets[node], offsets[node + 1]):
+                neighbor = targets[i]
+                candidate = d + weights[i]
+                if candidate < dist.get(neighbor, math.inf):
+                    dist[neighbor] = candidate
+                    heapq.heappush(heap, (candidate, neighbor))
+        for source in remaining:
+            times[source] = math.inf
+        return times
+
+
+class EtaEngine:
+    """Driving time estimates between {"lat", "lng"} locations.
+
+    With a road graph, both ends are snapped to their nearest road node
+    (within max_snap_km, covered at access_speed_kmh) and the road time is
+    looked up in an LRU cache of recent node pairs or computed by A* (one
+    pair) or a single backward search (several origins, one destination).
+    Without a graph, or when a location is off the network, the estimate is
+    the straight-line distance times detour_factor at fallback_speed_kmh.
+    """
+
+    def __init__(
+        self,
+        graph=None,
+        cache_size=10000,
+        fallback_speed_kmh=40,
+        detour_factor=1.3,
+        access_speed_kmh=20,
+        max_snap_km=1.0,
+    ):
+        self.graph = graph
+        self.cache_size = cache_size
+        self.fallback_speed = fallback_speed_kmh
+        self.detour_factor = detour_factor
+        self.access_speed = access_speed_kmh
+        self.max_snap_km = max_snap_km
+        self.hits = 0
+        self.misses = 0
+        self._routes = OrderedDict()  # {(source, target): seconds}
+        self._heuristics = OrderedDict()  # {target: lower bounds}, a few at a time
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, path=None, landmarks=8, **options):
+        engine = cls(**options)
+        if path:
+            engine.load_graph(path, landmarks)
+        return engine
+
+    def load_graph(self, path, landmarks=8):
+        """Load the road graph at path, replacing the current one and its caches"""
+        started = time.perf_counter()
+        graph = RoadGraph.load(path, landmarks=landmarks)
+        with self._lock:
+            self.graph = graph
+            self._routes.clear()
+            self._heuristics.clear()
+        logger.info(
+            "Loaded road graph %s: %d nodes in %.1fs",
+            path,
+            len(graph),
+            time.perf_counter() - started,
+        )
+
+    def seconds(self, origin, destination):
+        """Estimated driving seconds from origin to destination, None if invalid"""
+        return self.seconds_many([origin], destination)[0]
+
+    def seconds_many(self, origins, destination):
+        """Estimated driving seconds from each origin to one destination.
+
+        Road times for all origins not in the cache come from one search
+        out of the destination rather than one search per origin.
+        """
+        end = parse_location(destination)
+        if end is None:
+            return [None] * len(origins)
+        target = self._snap(end)
+        starts = [parse_location(origin) for origin in origins]
+        sources = [
+            self._snap(start) if start is not None and target is not None else None
+            for start in starts
+        ]
+        roads = {}
+        if target is not None:
+            roads = self._road_seconds(
+                {source[0] for source in sources if source is not None}, target[0]
+            )
+
+        estimates = []
+        for origin, start, source in zip(origins, starts, sources):
+            if start is None:
+                estimates.append(None)
+                continue
+            if source is not None and math.isfinite(roads[source[0]]):
+                access_km = source[1] + target[1]
+                estimates.append(
+                    roads[source[0]] + access_km / self.access_speed * 3600
+                )
+                continue
+            km = distance_km(origin, destination)
+            estimates.append(km * self.detour_factor / self.fallback_speed * 3600)
+        return estimates
+
+    def stats(self):
+        return {
+            "road_graph_nodes": len(self.graph) if self.graph is not None else 0,
+            "cached_routes": len(self._routes),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _snap(self, point):
+        if self.graph is None:
+            return None
+        return self.graph.snap(*point, max_km=self.max_snap_km)
+
+    def _road_seconds(self, sources, target):
+        """{source: road seconds to target}, computing only the uncached ones"""
+        roads = {}
+        missing = []
+        with self._lock:
+            for source in sources:
+                key = (source, target)
+                if key in self._routes:
+                    self._routes.move_to_end(key)
+                    roads[source] = self._routes[key]
+                else:
+                    missing.append(source)
+            self.hits += len(roads)
+            self.misses += len(missing)
+            heuristic = self._heuristics.get(target)
+            if heuristic is not None:
+                self._heuristics.move_to_end(target)
+        if not missing:
+            return roads
+
+        if len(missing) == 1:
+            # A single pair is cheaper by A*, which heads straight at target
+            if heuristic is None:
+                heuristic = self.graph.heuristic(target).tolist()
+            roads[missing[0]] = self.graph.route_seconds(missing[0], target, heuristic)
+        else:
+            roads.update(self.graph.seconds_to(target, missing))
+
+        with self._lock:
+            if heuristic is not None:
+                self._heuristics[target] = heuristic
+                while len(self._heuristics) > 16:
+                    self._heuristics.popitem(last=False)
+            for source in missing:
+                self._routes[(source, target)] = roads[source]
+            while len(self._routes) > self.cache_size:
+                self._routes.popitem(last=False)
+        return roads
+
+
+def format_eta(seconds):
+    """Human-readable ETA for patients, such as 7 minutes"""
+    if seconds is None:
+        return "unknown"
+    minutes = max(1, round(seconds / 60))
+    return "1 minute" if minutes == 1 else f"{minutes} minutes"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute a road graph for ETAs")
+    parser.add_argument("osm", help="OpenStreetMap XML extract of the region")
+    parser.add_argument("output", help=".npz file to write")
+    parser.add_argument("--landmarks", type=int, default=8)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    graph = RoadGraph(*parse_osm(args.osm))
+    print(f"Parsed {len(graph)} nodes, {len(graph.sources)} edges")
+    graph.select_landmarks(args.landmarks)
+    graph.save(args.output)
+    print(f"Saved {args.output} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+"""Low-overhead sampling profiler for the running server.
+
+A background thread wakes every interval, grabs the current stack of every
+other thread with sys._current_frames() and counts each distinct stack. The
+profiled threads are never traced or paused, so the cost is one stack walk
+per thread per sample, and only while a window is open.
+
+Stacks are written in the collapsed format (one "root;...;leaf count" line
+per stack), which flamegraph.pl, speedscope and inferno render directly.
+Every stack is rooted at its thread name, so inference workers
+("inference_0", ...) and the request/event threads are told apart, and
+socket handlers show up by function name (handle_location_update, ...).
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+# Leaf functions of threads that are blocked rather than working; left out of
+# the top_functions summary (the profile file keeps every stack)
+IDLE_FUNCTIONS = frozenset(
+    (
+        "sleep",
+        "wait",
+        "select",
+        "poll",
+        "accept",
+        "recv",
+        "recv_into",
+        "readinto",
+        "_wait_for_tstate_lock",
+    )
+)
+
+
+class ProfilerBusy(Exception):
+    """Raised when a profile is requested while another one is running"""
+
+
+def _positive(value, name):
+    """value if it is a positive number or None, else ValueError"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+        raise ValueError(f"{name} must be a positive number")
+    return value
+
+
+class SamplingProfiler:
+    """Samples every thread's stack for at most max_seconds at a time"""
+
+    def __init__(self, output_dir="profiles", interval_ms=5, max_seconds=120):
+        self.output_dir = output_dir
+        self.interval = interval_ms / 1000.0
+        self.max_seconds = max_seconds
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._session = None
+        self._labels = {}  # {code object: frame label}
+        self.last_profile = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds=None, interval_ms=None):
+        """Start sampling for seconds (capped at max_seconds); returns the status.
+
+        Raises ValueError if seconds or interval_ms is given but not a
+        positive number, ProfilerBusy if a profile is already running.
+        """
+        seconds = min(
+            _positive(seconds, "seconds") or self.max_seconds, self.max_seconds
+        )
+        interval_ms = _positive(interval_ms, "interval_ms")
+        interval = interval_ms / 1000.0 if interval_ms else self.interval
+        with self._lock:
+            if self.running:
+                raise ProfilerBusy("A profile is already running")
+            self._stop.clear()
+            self._session = {
+                "started_at": datetime.now(),
+                "started": time.monotonic(),
+                "seconds": seconds,
+                "interval": interval,
+                "stacks": collections.Counter(),
+                "samples": 0,
+            }
+            self._thread = threading.Thread(
+                target=self._run, args=(self._session,), name="sampling-profiler"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+        return self.status()
+
+    def stop(self):
+        """End the running window early; returns the last written profile, or None"""
+        with self._lock:
+            thread = self._thread
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+        return self.last_profile
+
+    def status(self):
+        session = self._session
+        status = {"running": self.running, "last_profile": self.last_profile}
+        if self.running and session is not None:
+            status.update(
+                elapsed_seconds=round(time.monotonic() - session["started"], 1),
+                seconds=session["seconds"],
+                samples=session["samples"],
+            )
+        return status
+
+    def _run(self, session):
+        own_id = threading.get_ident()
+        deadline = session["started"] + session["seconds"]
+        stacks = session["stacks"]
+        while not self._stop.wait(session["interval"]):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stacks[self._collapse(names.get(thread_id, thread_id), frame)] += 1
+            session["samples"] += 1
+            if time.monotonic() >= deadline:
+                break
+        self.last_profile = self._write(session)
+        with self._lock:
+            self._thread = None
+
+    def _collapse(self, thread_name, frame):
+        labels = []
+        while frame is not None:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = (
+                    f"{code.co_name} ({os.path.basename(code.co_filename)}:"
+                    f"{code.co_firstlineno})"
+                ).replace(";", ":")
+            labels.append(label)
+            frame = frame.f_back
+        labels.append(f"thread {thread_name}".replace(";", ":"))
+        return ";".join(reversed(labels))
+
+    def _write(self, session):
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Microseconds keep back-to-back sessions from overwriting each other
+        name = session["started_at"].strftime("profile-%Y%m%d-%H%M%S-%f.collapsed")
+        path = os.path.join(self.output_dir, name)
+        stacks = session["stacks"]
+        with open(path, "w") as f:
+            for stack, count in stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        # Inclusive sample counts per function of busy threads, for a quick
+        # look without a viewer
+        inclusive = collections.Counter()
+        busy = 0
+        for stack, count in stacks.items():
+            labels = stack.split(";")[1:]
+            if not labels or labels[-1].split(" ", 1)[0] in IDLE_FUNCTIONS:
+                continue
+            busy += count
+            for label in set(labels):
+                inclusive[label] += count
+        return {
+            "path": path,
+            "started_at": session["started_at"].isoformat(),
+            "seconds": round(time.monotonic() - session["started"], 1),
+            "samples": session["samples"],
+            "busy_thread_samples": busy,
+            "top_functions": [
+                {"function": label, "samples": count}
+                for label, count in inclusive.most_common(20)
+            ],
+        }
@@ -0,0 +1,79 @@
+"""Post-processing for the chest X-ray screening models.
+
+The three models run as a cascade: the chest model first decides whether an
+upload is a chest X-ray at all, and only then are the COVID and 4-class
+models consulted. Every stage turns the model's Classification (its full
+probability vector) into the prediction dict the API returns with the same
+build_prediction().
+"""
+
+# Classification models, loaded once per process by the model registry
+CHEST_MODEL_PATH = "models/only_chest.pt"
+COVID_MODEL_PATH = "models/is_covid.pt"
+FOUR_CLASS_MODEL_PATH = "models/four_classes.pt"
+MODEL_PATHS = [CHEST_MODEL_PATH, COVID_MODEL_PATH, FOUR_CLASS_MODEL_PATH]
+
+# Bump when build_prediction's output changes, so predictions cached by an
+# older version are not served
+PREDICTION_FORMAT = 2
+
+# Summary fields of a prediction, each the total of the classes mapped to it
+PREDICTION_FIELDS = ("covid", "normal", "pneumonia")
+
+
+def prediction_field(label):
+    """The summary field a class label counts towards, or None.
+
+    Covers the labels of the bundled models: "COVID-19 Positive"/"Negative"
+    (COVID model) and "COVID", "Normal", "Viral Pneumonia" (4-class model).
+    """
+    label = label.lower()
+    if "negative" in label or "normal" in label:
+        return "normal"
+    if "covid" in label:
+        return "covid"
+    if "pneumonia" in label:
+        return "pneumonia"
+    return None
+
+
+def build_prediction(classification):
+    """Build the prediction dict for any of the screening models.
+
+    class and confidence describe the top class; covid, normal and pneumonia
+    are the percentages of the classes mapped to them (0 for models without
+    such classes, like the chest model), and scores holds the exact
+    probability of every class.
+    """
+    if classification is None or len(classification) == 0:
+        return None
+
+    prediction = {
+        "class": classification.label,
+        "confidence": int(classification.confidence * 100),  # Convert to percentage
+    }
+    totals = dict.fromkeys(PREDICTION_FIELDS, 0.0)
+    scores = classification.scores()
+    for label, probability in scores.items():
+        field = prediction_field(label)
+        if field is not None:
+            totals[field] += probability
+    prediction.update((field, int(total * 100)) for field, total in totals.items())
+    prediction["scores"] = scores
+    return prediction
+
+
+def is_chest_xray(prediction):
+    """The chest model labels chest X-rays "chest_image" and others "not_chest" """
+    class_name = prediction["class"].lower()
+    return "chest_image" in class_name or (
+        "chest" in class_name and "not_chest" not in class_name
+    )
+
+
+# (result key, model) in cascade order
+CASCADE = [
+    ("chest", CHEST_MODEL_PATH),
+    ("covid", COVID_MODEL_PATH),
+    ("prediction", FOUR_CLASS_MODEL_PATH),
+]
@@ -0,0 +1,200 @@
+import math
+import threading
+
+import numpy as np
+from geopy.distance import geodesic
+
+from geo import EARTH_RADIUS_KM, HAVERSINE_SLACK, haversine_km, parse_location
+
+KM_PER_DEGREE_LAT = math.pi * EARTH_RADIUS_KM / 180
+
+
+class DriverIndex:
+    """Grid index over driver positions for k-nearest and radius queries.
+
+    Positions are bucketed into cells of cell_deg x cell_deg degrees. Queries
+    scan rings of cells outward from the query cell and stop as soon as no
+    unscanned cell can hold a closer driver, so cost depends on local density
+    rather than fleet size. Candidates are ranked with haversine and only the
+    final few are measured with the exact geodesic.
+    """
+
+    def __init__(self, cell_deg=0.05):
+        self.cell_deg = cell_deg
+        self._positions = {}  # {driver_id: (lat, lng, cell)}
+        self._cells = {}  # {cell: set(driver_id)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __contains__(self, driver_id):
+        return driver_id in self._positions
+
+    def upsert(self, driver_id, location):
+        """Add or move a driver; drivers without a valid location are removed"""
+        point = parse_location(location)
+        if point is None:
+            self.remove(driver_id)
+            return
+
+        cell = self._cell(*point)
+        with self._lock:
+            previous = self._positions.get(driver_id)
+            if previous is not None and previous[2] != cell:
+                self._discard(driver_id, previous[2])
+            self._positions[driver_id] = (point[0], point[1], cell)
+            self._cells.setdefault(cell, set()).add(driver_id)
+
+    def remove(self, driver_id):
+        with self._lock:
+            previous = self._positions.pop(driver_id, None)
+            if previous is not None:
+                self._discard(driver_id, previous[2])
+
+    def rebuild(self, drivers):
+        """Replace the whole index with (driver_id, location) pairs"""
+        positions = {}
+        cells = {}
+        for driver_id, location in drivers:
+            point = parse_location(location)
+            if point is not None:
+                cell = self._cell(*point)
+                positions[driver_id] = (point[0], point[1], cell)
+                cells.setdefault(cell, set()).add(driver_id)
+
+        with self._lock:
+            self._positions = positions
+            self._cells = cells
+
+    def nearest(self, location, k=1, exclude=(), max_radius_km=None):
+        """Return up to k (driver_id, distance_km) pairs sorted by geodesic distance"""
+        point = parse_location(location)
+        if point is None or k <= 0:
+            return []
+
+        with self._lock:
+            candidates = self._scan(point, k, exclude, max_radius_km)
+
+        if max_radius_km is not None:
+            limit = max_radius_km * HAVERSINE_SLACK
+            candidates = [c for c in candidates if c[0] <= limit]
+        if not candidates:
+            return []
+
+        # Exact geodesic only for candidates that could still rank in the top k
+        cutoff = candidates[min(k, len(candidates)) - 1][0] * HAVERSINE_SLACK
+        finalists = []
+        for approx_km, driver_id, lat, lng in candidates:
+            if approx_km > cutoff:
+                break
+            finalists.append((geodesic(point, (lat, lng)).kilometers, driver_id))
+        finalists.sort()
+
+        return [
+            (driver_id, distance)
+            for distance, driver_id in finalists[:k]
+            if max_radius_km is None or distance <= max_radius_km
+        ]
+
+    def within(self, location, radius_km, exclude=()):
+        """Return (driver_id, distance_km) for all drivers within radius_km"""
+        return self.nearest(
+            location, k=len(self._positions), exclude=exclude, max_radius_km=radius_km
+        )
+
+    def positions(self):
+        """Snapshot of every indexed driver as (driver_id, lat, lng)"""
+        with self._lock:
+            return [
+                (driver_id, lat, lng)
+                for driver_id, (lat, lng, _) in self._positions.items()
+            ]
+
+    def _cell(self, lat, lng):
+        columns = int(round(360 / self.cell_deg))
+        return (
+            math.floor(lat / self.cell_deg),
+            math.floor(lng / self.cell_deg) % columns,
+        )
+
+    def _discard(self, driver_id, cell):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(driver_id)
+            if not members:
+                del self._cells[cell]
+
+    def _ring(self, center, radius):
+        row, col = center
+        if radius == 0:
+            yield center
+            return
+        for dc in range(-radius, radius + 1):
+            yield (row - radius, col + dc)
+            yield (row + radius, col + dc)
+        for dr in range(-radius + 1, radius):
+            yield (row + dr, col - radius)
+            yield (row + dr, col + radius)
+
+    def _scan(self, point, k, exclude, max_radius_km):
+        """Collect haversine-sorted candidates ring by ring under the lock"""
+        lat, lng = point
+        center = self._cell(lat, lng)
+        columns = int(round(360 / self.cell_deg))
+        cell_lat_km = self.cell_deg * KM_PER_DEGREE_LAT
+
+        candidates = []
+        visited = set()
+        seen = 0
+        radius = 0
+        while seen < len(self._positions):
+            ring = {(row, col % columns) for row, col in self._ring(center, radius)}
+            ring -= visited
+            exhaustive = len(ring) > len(self._cells)
+            if exhaustive:
+                # Sparse fleet: sweeping the occupied cells is cheaper
+                ring = [cell for cell in self._cells if cell not in visited]
+
+            ring_ids = []
+            ring_points = []
+            for cell in ring:
+                visited.add(cell)
+                for driver_id in self._cells.get(cell, ()):
+                    seen += 1
+                    if driver_id not in exclude:
+                        ring_ids.append(driver_id)
+                        ring_points.append(self._positions[driver_id][:2])
+            if ring_ids:
+                points = np.array(ring_points)
+                approx = haversine_km(lat, lng, points[:, 0], points[:, 1])
+                candidates.extend(
+                    zip(
+                        approx.tolist(),
+                        ring_ids,
+                        points[:, 0].tolist(),
+                        points[:, 1].tolist(),
+                    )
+                )
+            if exhaustive:
+                break
+
+            # Anything outside the scanned rings is at least this far away,
+            # measured with the narrowest cell width inside the scanned box
+            edge_lat = min(89.9, abs(lat) + (radius + 1) * self.cell_deg)
+            cell_lng_km = cell_lat_km * math.cos(math.radians(edge_lat))
+            guaranteed_km = radius * min(cell_lat_km, cell_lng_km)
+
+            if (
+                max_radius_km is not None
+                and guaranteed_km > max_radius_km * HAVERSINE_SLACK
+            ):
+                break
+            if len(candidates) >= k:
+                candidates.sort()
+                if candidates[k - 1][0] * HAVERSINE_SLACK <= guaranteed_km:
+                    break
+            radius += 1
+
+        candidates.sort()
+        return candidates
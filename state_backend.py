@@ -0,0 +1,308 @@
+"""Shared state for the dispatch server.
+
+Patients, drivers, sessions and emergency requests live in a state backend
+instead of module-level dicts, so several gunicorn workers (or nodes) can
+serve the same fleet. Two implementations share one interface:
+
+- InMemoryBackend: plain dicts behind a lock, for a single process.
+- RedisBackend: one JSON string per record plus sets / sorted sets for
+  enumeration and indexes. Works with anything that speaks the Redis
+  protocol, including fakeredis for local testing.
+
+Records are JSON-serializable dicts. Callers never mutate a record in place;
+they write through put/patch/compare_and_set so the Redis backend sees every
+change.
+"""
+
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class InMemoryBackend:
+    """State backend for a single process"""
+
+    shared = False
+
+    def __init__(self):
+        self._tables = {}  # {table: {key: record}}
+        self._counters = {}  # {name: int}
+        self._indexes = {}  # {name: {member: score}}
+        self._lock = threading.RLock()
+
+    def _table(self, table):
+        return self._tables.setdefault(table, {})
+
+    def get(self, table, key):
+        return self._tables.get(table, {}).get(key)
+
+    def get_many(self, table, keys):
+        records = self._tables.get(table, {})
+        return [records.get(key) for key in keys]
+
+    def put(self, table, key, record):
+        with self._lock:
+            self._table(table)[key] = record
+
+    def delete(self, table, key):
+        with self._lock:
+            return self._table(table).pop(key, None) is not None
+
+    def keys(self, table):
+        return list(self._tables.get(table, {}))
+
+    def items(self, table):
+        return list(self._tables.get(table, {}).items())
+
+    def count(self, table):
+        return len(self._tables.get(table, {}))
+
+    def patch(self, table, key, fields):
+        """Update fields of a record; returns the record or None if missing"""
+        with self._lock:
+            record = self._table(table).get(key)
+            if record is not None:
+                record.update(fields)
+            return record
+
+    def compare_and_set(self, table, key, field, expected, fields):
+        """Apply fields only if record[field] == expected; returns the record or None"""
+        with self._lock:
+            record = self._table(table).get(key)
+            if record is None or record.get(field) != expected:
+                return None
+            record.update(fields)
+            return record
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def index_add(self, name, member, score):
+        with self._lock:
+            self._indexes.setdefault(name, {})[member] = score
+
+    def index_remove(self, name, member):
+        with self._lock:
+            self._indexes.get(name, {}).pop(member, None)
+
+    def index_members(self, name):
+        """Members ordered by score"""
+        with self._lock:
+            members = self._indexes.get(name, {})
+            return sorted(members, key=members.get)
+
+    def index_count(self, name):
+        return len(self._indexes.get(name, ()))
+
+    def capped_put(self, table, key, record, max_len):
+        """Put into a table that keeps only the max_len most recent records"""
+        with self._lock:
+            records = self._tables.get(table)
+            if records is None:
+                records = self._tables[table] = OrderedDict()
+            records[key] = record
+            records.move_to_end(key)
+            while len(records) > max_len:
+                records.popitem(last=False)
+
+
+class RedisBackend:
+    """State backend over a Redis-protocol server shared by all workers"""
+
+    shared = True
+
+    def __init__(self, client, prefix="medai"):
+        self.client = client
+        self.prefix = prefix
+
+    def _record_key(self, table, key):
+        return f"{self.prefix}:{table}:{key}"
+
+    def _members_key(self, table):
+        return f"{self.prefix}:{table}"
+
+    def get(self, table, key):
+        raw = self.client.get(self._record_key(table, key))
+        return None if raw is None else json.loads(raw)
+
+    def get_many(self, table, keys):
+        if not keys:
+            return []
+        raws = self.client.mget([self._record_key(table, key) for key in keys])
+        return [None if raw is None else json.loads(raw) for raw in raws]
+
+    def put(self, table, key, record):
+        pipe = self.client.pipeline()
+        pipe.set(self._record_key(table, key), json.dumps(record))
+        pipe.sadd(self._members_key(table), key)
+        pipe.execute()
+
+    def delete(self, table, key):
+        pipe = self.client.pipeline()
+        pipe.delete(self._record_key(table, key))
+        pipe.srem(self._members_key(table), key)
+        deleted, _ = pipe.execute()
+        return bool(deleted)
+
+    def keys(self, table):
+        return [_text(key) for key in self.client.smembers(self._members_key(table))]
+
+    def items(self, table):
+        keys = self.keys(table)
+        return [
+            (key, record)
+            for key, record in zip(keys, self.get_many(table, keys))
+            if record is not None
+        ]
+
+    def count(self, table):
+        return self.client.scard(self._members_key(table))
+
+    def _modify(self, table, key, change):
+        """Optimistic read-modify-write of one record with WATCH/MULTI"""
+        record_key = self._record_key(table, key)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(record_key)
+                    raw = pipe.get(record_key)
+                    record = None if raw is None else change(json.loads(raw))
+                    if record is None:
+                        pipe.unwatch()
+                        return None
+                    pipe.multi()
+                    pipe.set(record_key, json.dumps(record))
+                    pipe.execute()
+                    return record
+                except redis.WatchError:
+                    continue
+
+    def patch(self, table, key, fields):
+        def change(record):
+            record.update(fields)
+            return record
+
+        return self._modify(table, key, change)
+
+    def compare_and_set(self, table, key, field, expected, fields):
+        def change(record):
+            if record.get(field) != expected:
+                return None
+            record.update(fields)
+            return record
+
+        return self._modify(table, key, change)
+
+    def incr(self, name):
+        return self.client.incr(f"{self.prefix}:counter:{name}")
+
+    def counter(self, name):
+        return int(self.client.get(f"{self.prefix}:counter:{name}") or 0)
+
+    def index_add(self, name, member, score):
+        self.client.zadd(f"{self.prefix}:index:{name}", {member: score})
+
+    def index_remove(self, name, member):
+        self.client.zrem(f"{self.prefix}:index:{name}", member)
+
+    def index_members(self, name):
+        return [
+            _text(m) for m in self.client.zrange(f"{self.prefix}:index:{name}", 0, -1)
+        ]
+
+    def index_count(self, name):
+        return self.client.zcard(f"{self.prefix}:index:{name}")
+
+    def capped_put(self, table, key, record, max_len):
+        order_key = f"{self.prefix}:order:{table}"
+        pipe = self.client.pipeline()
+        pipe.set(self._record_key(table, key), json.dumps(record))
+        pipe.sadd(self._members_key(table), key)
+        pipe.rpush(order_key, key)
+        pipe.llen(order_key)
+        length = pipe.execute()[-1]
+
+        for _ in range(length - max_len):
+            oldest = self.client.lpop(order_key)
+            if oldest is None:
+                break
+            self.delete(table, _text(oldest))
+
+
+def _text(value):
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class Table:
+    """Mapping-style view of one backend table.
+
+    Supports the read side of the dict protocol; writes are whole-record
+    assignment, ``patch`` and ``compare_and_set``.
+    """
+
+    def __init__(self, backend, name):
+        self.backend = backend
+        self.name = name
+
+    def __contains__(self, key):
+        return key is not None and self.backend.get(self.name, key) is not None
+
+    def __getitem__(self, key):
+        record = self.backend.get(self.name, key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def __setitem__(self, key, record):
+        self.backend.put(self.name, key, record)
+
+    def __delitem__(self, key):
+        if not self.backend.delete(self.name, key):
+            raise KeyError(key)
+
+    def __len__(self):
+        return self.backend.count(self.name)
+
+    def __iter__(self):
+        return iter(self.backend.keys(self.name))
+
+    def get(self, key, default=None):
+        if key is None:
+            return default
+        record = self.backend.get(self.name, key)
+        return default if record is None else record
+
+    def get_many(self, keys):
+        """Records for keys, None for missing ones"""
+        return self.backend.get_many(self.name, list(keys))
+
+    def items(self):
+        return self.backend.items(self.name)
+
+    def patch(self, key, **fields):
+        """Update fields of a record; returns it, or None if it doesn't exist"""
+        return self.backend.patch(self.name, key, fields)
+
+    def compare_and_set(self, key, field, expected, **fields):
+        """Atomically apply fields if record[field] == expected"""
+        return self.backend.compare_and_set(self.name, key, field, expected, fields)
+
+
+def create_backend(url=None):
+    """InMemoryBackend when url is empty, otherwise a RedisBackend for url"""
+    if not url:
+        return InMemoryBackend()
+
+    if redis is None:
+        raise RuntimeError("The redis package is required for a shared state backend")
+    return RedisBackend(redis.Redis.from_url(url))
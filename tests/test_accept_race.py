@@ -0,0 +1,84 @@
+import os
+import sys
+import tempfile
+import threading
+import uuid
+
+os.environ.setdefault("YOLO_CONFIG_DIR", tempfile.mkdtemp())
+os.environ.setdefault("EVENT_LOG_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+LOCATION = {"lat": 41.3111, "lng": 69.2797}
+
+
+def connect():
+    return app_module.socketio.test_client(app_module.app)
+
+
+def received(client, name):
+    return [
+        event["args"][0] for event in client.get_received() if event["name"] == name
+    ]
+
+
+def test_only_one_of_many_racing_drivers_wins_a_request():
+    patient_id = f"patient-{uuid.uuid4().hex[:8]}"
+    patient = connect()
+    patient.emit("register_patient", {"patient_id": patient_id, "location": LOCATION})
+
+    drivers = {}
+    for i in range(8):
+        driver_id = f"driver-{uuid.uuid4().hex[:8]}"
+        location = {"lat": LOCATION["lat"] + i / 1000, "lng": LOCATION["lng"]}
+        drivers[driver_id] = connect()
+        drivers[driver_id].emit(
+            "register_driver", {"driver_id": driver_id, "location": location}
+        )
+
+    patient.get_received()
+    patient.emit(
+        "emergency_request",
+        {"patient_id": patient_id, "location": LOCATION, "emergency_type": "general"},
+    )
+    (sent,) = received(patient, "request_sent")
+    request_id = sent["request_id"]
+
+    # Every driver accepts at once, whether or not it was alerted
+    start = threading.Barrier(len(drivers))
+
+    def accept(driver_id, client):
+        client.get_received()
+        start.wait()
+        client.emit(
+            "accept_request", {"driver_id": driver_id, "request_id": request_id}
+        )
+
+    threads = [threading.Thread(target=accept, args=item) for item in drivers.items()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    winners = [
+        driver_id
+        for driver_id, client in drivers.items()
+        if received(client, "request_accepted")
+    ]
+    assert len(winners) == 1
+
+    request_data = app_module.emergency_requests[request_id]
+    assert request_data["status"] == "accepted"
+    assert request_data["driver_id"] == winners[0]
+    for driver_id in drivers:
+        driver_data = app_module.active_drivers[driver_id]
+        if driver_id == winners[0]:
+            assert driver_data["status"] == "en_route"
+            assert driver_data["current_request"] == request_id
+        else:
+            # Losing the request must not leave a driver claimed
+            assert driver_data["status"] == "available"
+
+    for client in [patient, *drivers.values()]:
+        client.disconnect()
@@ -0,0 +1,30 @@
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ.setdefault("YOLO_CONFIG_DIR", tempfile.mkdtemp())
+os.environ.setdefault("EVENT_LOG_DIR", tempfile.mkdtemp())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # The batch_size check comes before any model is used
+    monkeypatch.setattr(app_module, "XRAY_CLASSIFICATION_AVAILABLE", True)
+    return app_module.app.test_client()
+
+
+@pytest.mark.parametrize("batch_size", ["0", "-3"])
+def test_bulk_screening_rejects_non_positive_batch_size(client, batch_size):
+    response = client.post(
+        f"/api/screening/bulk?batch_size={batch_size}",
+        data={"file": (io.BytesIO(b"not an image"), "scan.png")},
+        content_type="multipart/form-data",
+    )
+    assert response.status_code == 400
+    assert "batch_size" in response.get_json()["error"]
@@ -0,0 +1,109 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import event_log as event_log_module  # noqa: E402
+from event_log import EventLog, EventLogLocked  # noqa: E402
+
+
+def open_log(directory):
+    # Segments of a few hundred bytes, so a handful of flushes rotate
+    log = EventLog(str(directory), segment_bytes=400, keep_segments=1)
+    return log, log.recover()
+
+
+def create(log, request_id, patient_id):
+    log.append(
+        "created",
+        request_id,
+        data={
+            "patient_id": patient_id,
+            "status": "pending",
+            "location": {"lat": 41.3, "lng": 69.2},
+        },
+    )
+
+
+def files(directory, prefix):
+    return sorted(name for name in os.listdir(directory) if name.startswith(prefix))
+
+
+def test_recovers_across_snapshot_rotation_and_segment_boundaries(tmp_path):
+    log, recovered = open_log(tmp_path)
+    assert recovered == {}
+
+    # One flush per request: each lands where the previous one left off,
+    # some in a fresh segment after a rotation
+    for i in range(12):
+        create(log, f"r{i}", f"p{i}")
+        log.append("alerted", f"r{i}", drivers=["d1", "d2"], round=0)
+        log.flush()
+    log.append("declined", "r0", driver_id="d1")
+    log.append("accepted", "r0", driver_id="d2")
+    log.append("location", "r0", role="patient", location={"lat": 41.4, "lng": 69.3})
+    for i in range(1, 5):
+        log.append("arrived", f"r{i}")
+    log.close()
+
+    snapshots = files(tmp_path, "snapshot-")
+    assert len(snapshots) == 1 and snapshots[0] != "snapshot-000000000000.json"
+    # Rotation compacted the older segments away
+    assert len(files(tmp_path, "events-")) == 2
+
+    log, recovered = open_log(tmp_path)
+    assert sorted(recovered) == sorted(f"r{i}" for i in [0] + list(range(5, 12)))
+    assert recovered["r0"]["status"] == "accepted"
+    assert recovered["r0"]["driver_id"] == "d2"
+    assert recovered["r0"]["declined"] == ["d1"]
+    assert recovered["r0"]["location"] == {"lat": 41.4, "lng": 69.3}
+    assert recovered["r7"]["status"] == "pending"
+    assert recovered["r7"]["alerted"] == ["d1", "d2"]
+    # Creation order survives for re-queueing
+    order = sorted(
+        recovered, key=lambda request_id: recovered[request_id]["created_lsn"]
+    )
+    assert order == ["r0"] + [f"r{i}" for i in range(5, 12)]
+
+    # Events written after a recovery are replayed on top of its snapshot
+    log.append("arrived", "r0")
+    create(log, "r12", "p12")
+    log.close()
+    log, recovered = open_log(tmp_path)
+    assert sorted(recovered) == sorted(f"r{i}" for i in range(5, 13))
+    log.close()
+
+
+def test_replays_up_to_a_torn_record(tmp_path):
+    log, _ = open_log(tmp_path)
+    create(log, "r0", "p0")
+    log.append("accepted", "r0", driver_id="d1")
+    log.close()
+
+    # A crash in the middle of the next write
+    (segment,) = files(tmp_path, "events-")[-1:]
+    with open(tmp_path / segment, "ab") as f:
+        f.write(b'0badc0de {"lsn":3,"type":"arrived","id":"r0"')
+
+    log, recovered = open_log(tmp_path)
+    assert recovered["r0"]["status"] == "accepted"
+    create(log, "r1", "p1")
+    log.close()
+
+    # The torn tail is left behind and never hides later events
+    log, recovered = open_log(tmp_path)
+    assert sorted(recovered) == ["r0", "r1"]
+    log.close()
+
+
+@pytest.mark.skipif(event_log_module.fcntl is None, reason="needs fcntl")
+def test_second_writer_is_refused_until_the_first_closes(tmp_path):
+    log, _ = open_log(tmp_path)
+    with pytest.raises(EventLogLocked):
+        open_log(tmp_path)
+    log.close()
+
+    log, _ = open_log(tmp_path)
+    log.close()
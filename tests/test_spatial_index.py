@@ -0,0 +1,103 @@
+import os
+import random
+import sys
+
+import pytest
+from geopy.distance import geodesic
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from spatial_index import DriverIndex  # noqa: E402
+
+
+def brute_force(drivers, location, k, exclude=(), max_radius_km=None):
+    distances = sorted(
+        (geodesic((location["lat"], location["lng"]), (lat, lng)).kilometers, driver_id)
+        for driver_id, (lat, lng) in drivers.items()
+        if driver_id not in exclude
+    )
+    if max_radius_km is not None:
+        distances = [item for item in distances if item[0] <= max_radius_km]
+    return [(driver_id, distance) for distance, driver_id in distances[:k]]
+
+
+def fleet(seed, center, count=300, spread_deg=0.3):
+    """A dense cluster around center plus a few stragglers far away"""
+    rng = random.Random(seed)
+    drivers = {}
+    for i in range(count):
+        lng = center[1] + rng.gauss(0, spread_deg / 3)
+        # Wrap across the antimeridian
+        drivers[f"d{i}"] = (
+            center[0] + rng.gauss(0, spread_deg / 3),
+            (lng + 180) % 360 - 180,
+        )
+    for i in range(10):
+        drivers[f"far{i}"] = (rng.uniform(-60, 60), rng.uniform(-180, 180))
+    return drivers
+
+
+def index_of(drivers, cell_deg=0.05):
+    index = DriverIndex(cell_deg=cell_deg)
+    for driver_id, (lat, lng) in drivers.items():
+        index.upsert(driver_id, {"lat": lat, "lng": lng})
+    return index
+
+
+def assert_same(found, expected):
+    assert [driver_id for driver_id, _ in found] == [d for d, _ in expected]
+    for (_, distance), (_, expected_distance) in zip(found, expected):
+        assert distance == pytest.approx(expected_distance, abs=1e-9)
+
+
+@pytest.mark.parametrize(
+    "center", [(41.31, 69.28), (-33.87, 151.21), (64.15, -21.94), (0.0, 179.98)]
+)
+@pytest.mark.parametrize("k", [1, 5, 25])
+def test_nearest_matches_brute_force(center, k):
+    drivers = fleet(repr(center), center)
+    index = index_of(drivers)
+    rng = random.Random(k)
+    for _ in range(8):
+        lng = center[1] + rng.uniform(-0.4, 0.4)
+        location = {
+            "lat": center[0] + rng.uniform(-0.4, 0.4),
+            "lng": (lng + 180) % 360 - 180,
+        }
+        assert_same(index.nearest(location, k=k), brute_force(drivers, location, k))
+
+
+def test_nearest_with_exclusions_and_radius_matches_brute_force():
+    center = (41.31, 69.28)
+    drivers = fleet(7, center)
+    index = index_of(drivers, cell_deg=0.02)
+    location = {"lat": center[0], "lng": center[1]}
+    exclude = {driver_id for driver_id, _ in brute_force(drivers, location, 10)[::2]}
+
+    assert_same(
+        index.nearest(location, k=10, exclude=exclude),
+        brute_force(drivers, location, 10, exclude),
+    )
+    assert_same(
+        index.within(location, 3.0, exclude=exclude),
+        brute_force(drivers, location, len(drivers), exclude, max_radius_km=3.0),
+    )
+
+
+def test_moved_and_removed_drivers_are_not_returned():
+    center = (41.31, 69.28)
+    drivers = fleet(3, center, count=50)
+    index = index_of(drivers)
+    location = {"lat": center[0], "lng": center[1]}
+    nearest_id, _ = index.nearest(location)[0]
+
+    drivers[nearest_id] = (center[0] + 1.0, center[1] + 1.0)
+    index.upsert(
+        nearest_id, {"lat": drivers[nearest_id][0], "lng": drivers[nearest_id][1]}
+    )
+    removed_id, _ = index.nearest(location)[0]
+    del drivers[removed_id]
+    index.remove(removed_id)
+
+    assert_same(index.nearest(location, k=5), brute_force(drivers, location, 5))
+    assert len(index) == len(drivers)
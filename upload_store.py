@@ -0,0 +1,122 @@
+import hashlib
+import logging
+import os
+import re
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+_NAME_PATTERN = re.compile(r"^([0-9a-f]{64})\.(png|jpg)$")
+
+
+class UploadStore:
+    """Uploaded images stored once per content, in sharded directories.
+
+    A file is named after the SHA-256 of its bytes and lives two directory
+    levels down (root/ab/cd/abcd....jpg), so identical uploads share one file
+    and no directory grows past a few thousand entries. Stored files never
+    change, which makes the name a perfect ETag.
+
+    collect_garbage() deletes files not uploaded again for max_age_seconds,
+    then the least recently uploaded ones until the store fits in
+    max_total_bytes. run() calls it every gc_interval_seconds.
+    """
+
+    def __init__(
+        self,
+        root,
+        max_age_seconds=7 * 24 * 3600,
+        max_total_bytes=20 * 1024**3,
+        gc_interval_seconds=3600,
+    ):
+        self.root = root
+        self.max_age = max_age_seconds
+        self.max_total_bytes = max_total_bytes
+        self.gc_interval = gc_interval_seconds
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, digest, extension):
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+    def save(self, data, extension):
+        """Store data unless identical content is already stored; returns its name"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._path(digest, extension)
+        try:
+            # Already stored: just mark it as recently uploaded for the GC
+            os.utime(path)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        return f"{digest}.{extension}"
+
+    def path(self, name):
+        """Path of a stored file by name, or None if it's not a stored name or is gone"""
+        match = _NAME_PATTERN.match(name or "")
+        if match is None:
+            return None
+        path = self._path(*match.groups())
+        return path if os.path.isfile(path) else None
+
+    def etag(self, name):
+        return _NAME_PATTERN.match(name).group(1)
+
+    def _scan(self, directory):
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._scan(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield entry.path, stat.st_mtime, stat.st_size
+
+    def collect_garbage(self, now=None):
+        """Apply the retention policy; returns (files deleted, bytes freed)"""
+        now = time.time() if now is None else now
+        deleted = freed = 0
+        kept = []
+        total = 0
+        for path, mtime, size in self._scan(self.root):
+            if now - mtime > self.max_age:
+                deleted, freed = deleted + 1, freed + size
+                _remove(path)
+            else:
+                kept.append((mtime, size, path))
+                total += size
+
+        if total > self.max_total_bytes:
+            kept.sort()
+            for mtime, size, path in kept:
+                if total <= self.max_total_bytes:
+                    break
+                _remove(path)
+                total -= size
+                deleted, freed = deleted + 1, freed + size
+        return deleted, freed
+
+    def run(self, sleep):
+        """Garbage collector loop; sleep is the server's cooperative sleep function"""
+        while True:
+            sleep(self.gc_interval)
+            try:
+                deleted, freed = self.collect_garbage()
+            except OSError as e:
+                logger.warning("Upload garbage collection failed: %s", e)
+                continue
+            if deleted:
+                logger.info(
+                    "Upload garbage collection removed %d files (%d bytes)",
+                    deleted,
+                    freed,
+                )
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass